@@ -0,0 +1,179 @@
+import math
+import sys
+import calc_air_density
+import calc_power
+import calc_velocity
+
+# Barometric altitude and grade estimator
+# Copyright (c) 2020 Manu Konchady
+#
+# Live barometer samples (time, pressure, temperature, distance) are turned into an altitude
+# with calc_air_density.get_altitude, and a straight line of altitude against distance is fit
+# with weights that decay exponentially with the distance ridden since each sample. The slope
+# is the grade and the line at the current distance is the filtered altitude. The fit is kept
+# as five running sums, so every sample costs O(1) and the state does not grow with the ride.
+# Samples at a standstill do not decay the older ones.
+#
+# Pressure in hecto pascals, temperature in centigrade, distance and altitude in meters,
+# grade in percent.
+#
+
+SMOOTHING_DISTANCE = 50.0  # meters for the weights to fall to 1/e
+MIN_SPREAD = 5.0           # meters of weighted distance spread before a grade is given
+
+class AltitudeEstimator:
+
+    __slots__ = ("smoothing_distance", "min_spread", "sea_level_pressure", "samples", "time", "pressure", \
+                 "temp", "distance", "raw_altitude", "base_altitude", "s_w", "s_x", "s_y", "s_xx", "s_xy", \
+                 "altitude", "grade")
+
+    def __init__(self, smoothing_distance = SMOOTHING_DISTANCE, min_spread = MIN_SPREAD, \
+                 sea_level_pressure = calc_air_density.PRESSURE_SEA):
+        self.smoothing_distance = smoothing_distance
+        self.min_spread = min_spread
+        self.sea_level_pressure = sea_level_pressure
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.time = self.pressure = self.temp = self.distance = None
+        self.raw_altitude = self.base_altitude = None
+        # weighted sums of 1, x, y, x^2 and x*y, where x is the distance before the current
+        # sample (zero or negative) and y the altitude above the first sample
+        self.s_w = self.s_x = self.s_y = self.s_xx = self.s_xy = 0.0
+        self.altitude = None
+        self.grade = 0.0
+
+    #*------------------------------------------------------------------------------
+    #*- add a sample and return the filtered altitude and grade. The distance is
+    #*- cumulative over the ride, a distance that goes back starts a new fit.
+    #*------------------------------------------------------------------------------
+    def update(self, time, pressure, temp, distance):
+        raw_altitude = calc_air_density.get_altitude(pressure * calc_air_density.PRESSURE_SEA / \
+                                                     self.sea_level_pressure, temp)
+        if (self.samples > 0 and distance < self.distance):
+            self.reset()
+        if (self.samples == 0):
+            self.base_altitude = raw_altitude
+            self.distance = distance
+
+        # move the origin to the new distance and decay the older samples
+        delta = distance - self.distance
+        if (delta > 0):
+            decay = math.exp(-delta / self.smoothing_distance)
+            self.s_xx = decay * (self.s_xx - 2.0 * delta * self.s_x + delta * delta * self.s_w)
+            self.s_xy = decay * (self.s_xy - delta * self.s_y)
+            self.s_x = decay * (self.s_x - delta * self.s_w)
+            self.s_w *= decay
+            self.s_y *= decay
+
+        y = raw_altitude - self.base_altitude
+        self.s_w += 1.0
+        self.s_y += y
+
+        # keep the last grade until the samples are spread over enough distance
+        determinant = self.s_w * self.s_xx - self.s_x * self.s_x
+        if (determinant > (self.min_spread * self.s_w) ** 2):
+            self.grade = 100.0 * (self.s_w * self.s_xy - self.s_x * self.s_y) / determinant
+        self.altitude = self.base_altitude + (self.s_y - self.grade / 100.0 * self.s_x) / self.s_w
+
+        self.samples += 1
+        self.time = time
+        self.pressure = pressure
+        self.temp = temp
+        self.distance = distance
+        self.raw_altitude = raw_altitude
+        return self.altitude, self.grade
+
+    #*-- resistances and power at the current estimate, weights in Newtons, velocities in kmph
+    def get_grade_res(self, total_wt):
+        return total_wt * self.grade / 100.0
+
+    def get_other_resistance(self, total_wt, roll_v):
+        return roll_v * total_wt + self.get_grade_res(total_wt)
+
+    def get_density(self, rh):
+        return calc_air_density.get_density(self.altitude, self.temp, rh, self.pressure)
+
+    def get_power(self, K_A, v_bike, v_wind, wind_d, total_wt, roll_v):
+        total_res = self.get_other_resistance(total_wt, roll_v) + calc_power.calc_air_res(K_A, v_bike, v_wind, wind_d)
+        return calc_power.calc_power(total_res, v_bike)
+
+    # velocity in m/s for a power, wind_deg in the degrees of calc_wind
+    def get_velocity(self, K_A, wind_mag, wind_deg, total_wt, roll_v, power):
+        return calc_velocity.calc_velocity_exact(K_A, wind_mag, wind_deg, self.get_other_resistance(total_wt, roll_v), \
+                                                 power)
+
+def test_estimator():
+    TEMP = 20
+    SPEED = 5.0  # m/s
+    import random
+    rng = random.Random(3)
+
+    # flat for 500 m, 6 % climb for 1 km, stop for a minute, then 4 % descent
+    def altitude_at(d):
+        if (d < 500):
+            return 200.0
+        if (d < 1500):
+            return 200.0 + 0.06 * (d - 500)
+        return 260.0 - 0.04 * (d - 1500)
+
+    estimator = AltitudeEstimator()
+    distance = 0.0
+    results = []
+    states = []
+    for t in range(0, 700):
+        if (not 300 <= t < 360):
+            distance += SPEED
+        true_altitude = altitude_at(distance)
+        pressure = calc_air_density.get_pressure(true_altitude, TEMP) + rng.gauss(0, 0.05)
+        results.append((distance, true_altitude) + estimator.update(float(t), pressure, TEMP, distance))
+        if (t in (10, 699)):
+            states.append([(type(getattr(estimator, name)), sys.getsizeof(getattr(estimator, name))) \
+                           for name in AltitudeEstimator.__slots__])
+
+    # the noise of 0.05 hPa is about 0.4 m of altitude
+    for d, true_altitude, altitude, grade in results:
+        if (300 <= d < 480 or 1200 <= d < 1480):
+            assert abs(grade) < 1.5 if d < 480 else abs(grade - 6.0) < 1.0, "1: Grade " + str(grade) + " at " + str(d)
+            assert abs(altitude - true_altitude) < 1.5, "2: Altitude " + str(altitude) + " at " + str(d)
+        if (d >= 1800):
+            assert abs(grade + 4.0) < 1.0, "3: Grade " + str(grade) + " at " + str(d)
+    # the state after 10 and 700 updates is the same scalars
+    assert states[0] == states[1] and all(kind in (int, float) for kind, _ in states[1]) and \
+           not hasattr(estimator, "__dict__"), "4: Expected bounded state " + str(states[1])
+
+    # the running sums match a weighted least squares fit over the whole history
+    fit = AltitudeEstimator(min_spread = 0.0)
+    samples = [(float(i), calc_air_density.get_pressure(100 + 0.03 * 7 * i + rng.gauss(0, 2), TEMP), 7.0 * i) \
+               for i in range(0, 60)]
+    for sample in samples:
+        fit.update(sample[0], sample[1], TEMP, sample[2])
+    points = [(d - samples[-1][2], calc_air_density.get_altitude(p, TEMP)) for _, p, d in samples]
+    w = [math.exp(x / SMOOTHING_DISTANCE) for x, _ in points]
+    s_w = sum(w)
+    s_x = sum(wi * x for wi, (x, _) in zip(w, points))
+    s_y = sum(wi * y for wi, (_, y) in zip(w, points))
+    s_xx = sum(wi * x * x for wi, (x, _) in zip(w, points))
+    s_xy = sum(wi * x * y for wi, (x, y) in zip(w, points))
+    slope = (s_w * s_xy - s_x * s_y) / (s_w * s_xx - s_x * s_x)
+    assert abs(fit.grade - 100 * slope) < 1e-9, "5: Expected grade " + str(100 * slope) + " " + str(fit.grade)
+    assert abs(fit.altitude - (s_y - slope * s_x) / s_w) < 1e-9, "6: Expected altitude"
+
+    # the estimate feeds the resistance, power and velocity calculators
+    TOTAL_WT = 80 * 9.8
+    ROLL_V = 0.005
+    K_A = 0.5 * 0.388 * fit.get_density(50)
+    expected = calc_power.calc_power(ROLL_V * TOTAL_WT + TOTAL_WT * fit.grade / 100 + \
+                                     calc_power.calc_air_res(K_A, 20, 0, 0), 20)
+    power = fit.get_power(K_A, 20, 0, 0, TOTAL_WT, ROLL_V)
+    assert abs(power - expected) < 1e-9, "7: Expected power " + str(expected)
+    velocity = fit.get_velocity(K_A, 0, 0, TOTAL_WT, ROLL_V, power)
+    assert abs(velocity - 20 / 3.6) < 0.01, "8: Expected velocity " + str(velocity)
+
+    # a distance that goes back starts again
+    fit.update(61.0, calc_air_density.get_pressure(300, TEMP), TEMP, 0.0)
+    assert fit.samples == 1 and abs(fit.altitude - 300) < 1e-6 and fit.grade == 0.0, "9: Expected a reset"
+
+if __name__ == "__main__":
+    test_estimator()
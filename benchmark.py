@@ -0,0 +1,308 @@
+#
+# Benchmarks of the calculators
+# Copyright (c) 2020 Manu Konchady
+#
+# Throughput of the scalar calculators, their array versions and end to end workloads.
+# Each benchmark is timed over enough loops to run for min_time seconds, and the best of
+# the repeats is kept as ns per item (a call for the scalar functions, an element for the
+# array functions and a point or cell for the workloads).
+#
+#   python benchmark.py run [-o results.json] [-k name] [--min-time 0.2]
+#   python benchmark.py compare baseline.json results.json [--threshold 10]
+#   python benchmark.py run -o results.json --baseline baseline.json --threshold 10
+#
+# compare exits with 1 when a benchmark of the baseline is slower by more than threshold percent.
+#
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import calc_air_density
+import calc_stopping_distance
+import calc_velocity
+import calc_wind
+import common
+import moments
+import ride_stream
+import route_simulator
+
+SCALAR = "scalar"
+BATCH = "batch"
+WORKLOAD = "workload"
+
+MIN_TIME = 0.2      # seconds per repeat
+REPEATS = 5
+THRESHOLD = 10.0    # percent slower than the baseline
+BATCH_SIZE = 100000
+
+# rider and weather of the benchmarks
+K_A = 0.5 * 0.388 * 1.18
+OTHER_RESISTANCE = 0.005 * 80 * 9.81
+
+# name -> (group, setup), setup returns the function to time and the number of items per call
+BENCHMARKS = {}
+
+def benchmark(name, group):
+    def register(setup):
+        BENCHMARKS[name] = (group, setup)
+        return setup
+    return register
+
+@benchmark("calc_wind.get_head_wind2", SCALAR)
+def head_wind2():
+    return (lambda: calc_wind.get_head_wind2(8.0, 3.0, 30, 0)), 1
+
+@benchmark("calc_wind.get_head_wind2_array", BATCH)
+def head_wind2_array():
+    rng = np.random.default_rng(1)
+    bike, wind, deg = rng.uniform(1, 15, BATCH_SIZE), rng.uniform(0, 10, BATCH_SIZE), rng.uniform(0, 360, BATCH_SIZE)
+    return (lambda: calc_wind.get_head_wind2_array(bike, wind, deg, 0)), BATCH_SIZE
+
+@benchmark("calc_velocity.calc_velocity", SCALAR)
+def velocity():
+    return (lambda: calc_velocity.calc_velocity(K_A, 3.0, 30, OTHER_RESISTANCE, 200)), 1
+
+@benchmark("calc_velocity.calc_velocity_exact", SCALAR)
+def velocity_exact():
+    return (lambda: calc_velocity.calc_velocity_exact(K_A, 3.0, 0, OTHER_RESISTANCE, 200)), 1
+
+@benchmark("calc_velocity.calc_velocity_array", BATCH)
+def velocity_array():
+    rng = np.random.default_rng(2)
+    wind, deg, power = rng.uniform(0, 8, BATCH_SIZE), rng.uniform(0, 360, BATCH_SIZE), rng.uniform(50, 500, BATCH_SIZE)
+    return (lambda: calc_velocity.calc_velocity_array(K_A, wind, deg, OTHER_RESISTANCE, power)), BATCH_SIZE
+
+@benchmark("calc_stopping_distance.calc_dist", SCALAR)
+def stopping_euler():
+    config = calc_stopping_distance.default_config()
+    return (lambda: calc_stopping_distance.dist1(40, 0, 0, 0.5, False, config = config)), 1
+
+@benchmark("calc_stopping_distance.calc_dist_rk45", SCALAR)
+def stopping_rk45():
+    config = calc_stopping_distance.default_config()
+    return (lambda: calc_stopping_distance.dist1(40, 0, 0, 0.5, False, method = calc_stopping_distance.RK45, \
+                                                 config = config)), 1
+
+@benchmark("calc_stopping_distance.calc_dist_exact", SCALAR)
+def stopping_exact():
+    config = calc_stopping_distance.default_config()
+    return (lambda: calc_stopping_distance.dist1(40, 0, 0, 0.5, False, method = calc_stopping_distance.EXACT, \
+                                                 config = config)), 1
+
+@benchmark("calc_stopping_distance.dist4", SCALAR)
+def stopping_energy():
+    config = calc_stopping_distance.default_config()
+    return (lambda: calc_stopping_distance.dist4(40, 0, 0, 0.5, False, 0.7, config = config)), 1
+
+@benchmark("calc_air_density.get_density", SCALAR)
+def density():
+    return (lambda: calc_air_density.get_density(500, 25, 50)), 1
+
+@benchmark("calc_air_density.get_density_array", BATCH)
+def density_array():
+    rng = np.random.default_rng(3)
+    alt, temp, rh = rng.uniform(0, 3000, BATCH_SIZE), rng.uniform(-5, 35, BATCH_SIZE), rng.uniform(10, 90, BATCH_SIZE)
+    return (lambda: calc_air_density.get_density_array(alt, temp, rh)), BATCH_SIZE
+
+@benchmark("moments.get_critical_g_1", SCALAR)
+def critical_g():
+    return (lambda: moments.get_critical_g_1(calc_stopping_distance.WHEEL_BASE, \
+                                             calc_stopping_distance.REAR_CRANK_DISTANCE, \
+                                             calc_stopping_distance.COM_HEIGHT, 80)), 1
+
+@benchmark("moments.get_critical_g_array", BATCH)
+def critical_g_array():
+    rng = np.random.default_rng(4)
+    wheel_base, crank, height = rng.uniform(0.9, 1.1, BATCH_SIZE), rng.uniform(0.3, 0.5, BATCH_SIZE), \
+                                rng.uniform(0.9, 1.2, BATCH_SIZE)
+    return (lambda: moments.get_critical_g_array(wheel_base, crank, height)), BATCH_SIZE
+
+# stream and compute a ride of 10000 points from a CSV file
+@benchmark("workload.ride_stream", WORKLOAD)
+def full_ride():
+    POINTS = 10000
+    directory = tempfile.TemporaryDirectory()  # removed with the function
+    file_name = os.path.join(directory.name, "ride.csv")
+    ride_stream.write_test_ride(file_name, POINTS, 28.0, 1.5)
+    def ride():
+        for _ in ride_stream.stream_ride(file_name, wind_mag = 3.0, wind_bearing = 45.0):
+            pass
+    ride.directory = directory
+    return ride, POINTS
+
+# a 100k segment route with the kinetic energy carried over between segments
+@benchmark("workload.route_simulator", WORKLOAD)
+def route():
+    SEGMENTS = 100000
+    rng = np.random.default_rng(5)
+    course = route_simulator.Route(rng.uniform(10, 100, SEGMENTS), np.clip(np.cumsum(rng.normal(0, 0.5, SEGMENTS)), \
+                                   -10, 12), rng.uniform(0, 360, SEGMENTS))
+    power = rng.uniform(100, 350, SEGMENTS)
+    return (lambda: course.simulate(power, K_A, 3.0, 200, kinetic = True)), SEGMENTS
+
+# stopping distances over speed x grade x brake g x friction
+@benchmark("workload.stopping_grid_euler", WORKLOAD)
+def stopping_grid_euler():
+    axes = (np.linspace(10, 60, 11), np.linspace(-10, 10, 11), np.linspace(0.1, 0.5, 9), (0.5, 0.7, 0.9))
+    cells = 11 * 11 * 9 * 3
+    return (lambda: calc_stopping_distance.sweep_stopping(*axes)), cells
+
+@benchmark("workload.stopping_grid_exact", WORKLOAD)
+def stopping_grid_exact():
+    axes = (np.linspace(10, 60, 11), np.linspace(-10, 10, 11), np.linspace(0.1, 0.5, 9), (0.5, 0.7, 0.9))
+    cells = 11 * 11 * 9 * 3
+    return (lambda: calc_stopping_distance.sweep_stopping(*axes, method = calc_stopping_distance.EXACT)), cells
+
+#*-- best time per call in seconds, with the loops per repeat and the repeats
+def time_function(function, min_time = MIN_TIME, repeats = REPEATS):
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(0, loops):
+            function()
+        elapsed = time.perf_counter() - start
+        if (elapsed >= min_time / 4):
+            break
+        loops *= 2
+    best = elapsed / loops
+    loops = max(1, int(loops * min_time / max(elapsed, 1e-9)))
+    for _ in range(0, repeats):
+        start = time.perf_counter()
+        for _ in range(0, loops):
+            function()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best, loops, repeats
+
+#*------------------------------------------------------------------------------
+#*- run the benchmarks whose names contain one of the keywords (all if none)
+#*- and return the results keyed by name
+#*------------------------------------------------------------------------------
+def run_benchmarks(keywords = None, min_time = MIN_TIME, repeats = REPEATS, verbose = False):
+    results = {}
+    for name, (group, setup) in BENCHMARKS.items():
+        if (keywords and not any(keyword in name for keyword in keywords)):
+            continue
+        function, items = setup()
+        seconds, loops, repeats = time_function(function, min_time, repeats)
+        ns_per_item = seconds * 1e9 / items
+        results[name] = dict(group = group, items = items, ns_per_item = ns_per_item, \
+                             items_per_sec = items / seconds, calls_per_sec = 1.0 / seconds, loops = loops, \
+                             repeats = repeats)
+        if (verbose):
+            print ("%-45s %-8s %14.1f ns/item %16.0f items/s" % (name, group, ns_per_item, items / seconds))
+    return results
+
+def save_results(results, file_name):
+    report = dict(python = platform.python_version(), numpy = np.__version__, machine = platform.machine(), \
+                  platform = platform.platform(), time = time.time(), results = results)
+    with open(file_name, "w") as output:
+        json.dump(report, output, indent = 2, sort_keys = True)
+
+def load_results(file_name):
+    with open(file_name) as data:
+        return json.load(data)["results"]
+
+#*------------------------------------------------------------------------------
+#*- compare the benchmarks of the baseline with the current results, returns
+#*- (name, baseline ns, current ns, percent change, regressed) for each, regressed
+#*- when slower by more than threshold percent. A benchmark missing from the
+#*- current results has None for the current ns and change and is regressed.
+#*------------------------------------------------------------------------------
+def compare_results(baseline, current, threshold = THRESHOLD):
+    rows = []
+    for name in baseline:
+        before = baseline[name]["ns_per_item"]
+        if (name not in current):
+            rows.append((name, before, None, None, True))
+            continue
+        after = current[name]["ns_per_item"]
+        change = 100.0 * (after - before) / before
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+def print_comparison(rows, threshold):
+    for name, before, after, change, regressed in rows:
+        if (after is None):
+            print ("%-45s %14.1f -> %14s ns/item %9s  MISSING" % (name, before, "-", ""))
+            continue
+        print ("%-45s %14.1f -> %14.1f ns/item %+8.1f%%%s" % (name, before, after, change, \
+               "  REGRESSION" if regressed else ""))
+    missing = sum(1 for row in rows if row[2] is None)
+    regressions = sum(1 for row in rows if row[4]) - missing
+    print (str(regressions) + " of " + str(len(rows)) + " benchmarks slower by more than " + str(threshold) + "%" + \
+           (", " + str(missing) + " missing" if missing else ""))
+    return regressions + missing
+
+def main(args):
+    parser = argparse.ArgumentParser(prog = "benchmark.py", description = "Benchmarks of the calculators")
+    commands = parser.add_subparsers(dest = "command", required = True)
+    run = commands.add_parser("run", help = "run the benchmarks")
+    run.add_argument("-o", "--output", help = "JSON file for the results")
+    run.add_argument("-k", "--keyword", action = "append", help = "run benchmarks with the keyword in the name")
+    run.add_argument("--min-time", type = float, default = MIN_TIME, help = "seconds per repeat")
+    run.add_argument("--repeats", type = int, default = REPEATS)
+    run.add_argument("--baseline", help = "JSON results to compare against")
+    run.add_argument("--threshold", type = float, default = THRESHOLD, help = "percent slower to fail")
+    compare = commands.add_parser("compare", help = "compare two JSON results")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type = float, default = THRESHOLD, help = "percent slower to fail")
+    options = parser.parse_args(args)
+
+    if (options.command == "run"):
+        results = run_benchmarks(options.keyword, options.min_time, options.repeats, verbose = True)
+        if (options.output):
+            save_results(results, options.output)
+        if (not options.baseline):
+            return 0
+        # only the selected benchmarks of the baseline are expected
+        baseline = dict((name, result) for name, result in load_results(options.baseline).items() \
+                        if not options.keyword or any(keyword in name for keyword in options.keyword))
+    else:
+        baseline = load_results(options.baseline)
+        results = load_results(options.current)
+    return 1 if print_comparison(compare_results(baseline, results, options.threshold), options.threshold) else 0
+
+def test_benchmark():
+    results = run_benchmarks(["get_head_wind2", "get_density"], min_time = 0.001, repeats = 1)
+    assert set(results) == set(["calc_wind.get_head_wind2", "calc_wind.get_head_wind2_array", \
+                                "calc_air_density.get_density", "calc_air_density.get_density_array"]), \
+           "1: Expected benchmarks " + str(list(results))
+    assert results["calc_wind.get_head_wind2_array"]["items"] == BATCH_SIZE, "2: Expected batch size"
+    assert all(result["ns_per_item"] > 0 for result in results.values()), "3: Expected times"
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "results.json")
+        save_results(results, file_name)
+        assert load_results(file_name) == results, "4: Expected the saved results"
+
+    slower = json.loads(json.dumps(results))
+    slower["calc_air_density.get_density"]["ns_per_item"] *= 1.2
+    rows = dict((row[0], row) for row in compare_results(results, slower, threshold = 10.0))
+    assert rows["calc_air_density.get_density"][4] and abs(rows["calc_air_density.get_density"][3] - 20) < 1e-6, \
+           "5: Expected a regression"
+    assert not rows["calc_wind.get_head_wind2"][4], "6: Expected no regression"
+    assert not any(row[4] for row in compare_results(results, slower, threshold = 25.0)), "7: Within threshold"
+
+    # a benchmark dropped from the current results fails the comparison
+    del slower["calc_wind.get_head_wind2"]
+    rows = dict((row[0], row) for row in compare_results(results, slower, threshold = 25.0))
+    assert rows["calc_wind.get_head_wind2"] == ("calc_wind.get_head_wind2", \
+           results["calc_wind.get_head_wind2"]["ns_per_item"], None, None, True), "8: Expected a missing row"
+    with tempfile.TemporaryDirectory() as directory:
+        names = []
+        for name, data in (("baseline.json", results), ("current.json", slower)):
+            names.append(os.path.join(directory, name))
+            save_results(data, names[-1])
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            status = main(["compare"] + names + ["--threshold", "25"])
+        assert status == 1 and "MISSING" in output.getvalue(), "9: Expected the CLI to fail " + str(status)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,8 @@
 import math
 import sys
+import common
+
+np = common.lazy_import("numpy")
 
 # Altitude, Pressure and Air Density Calculators
 # 
@@ -171,8 +174,84 @@ def test_density():
     alt = 1000 # altitude in meters
     assert abs(get_density(alt, temp, rh) - expected) < TOLERANCE, "3: Did not match expected value of " + str(expected)
 
-# Main
+#*-----------------------------------------------------------------------------
+#*- Array versions of get_altitude, get_pressure, get_dew_point, get_density and
+#*- get_density1. Accept numpy arrays (or scalars) that broadcast against each
+#*- other. A pressure of LARGE_NEGATIVE or nan is computed from the altitude.
+#*-----------------------------------------------------------------------------
+def get_altitude_array(pressure, temp):
+    kelvin = np.asarray(temp, dtype = np.float64) + 273.15
+    pval = np.power(PRESSURE_SEA / np.asarray(pressure, dtype = np.float64), ALT_DENSITY_POWER) - 1.0
+    return (pval * kelvin) / 0.0065
+
+def get_pressure_array(alt, temp):
+    kelvin = np.asarray(temp, dtype = np.float64) + 273.15
+    lhs = 1.0 + (np.asarray(alt, dtype = np.float64) * 0.0065) / kelvin
+    return PRESSURE_SEA / np.power(lhs, 1.0 / ALT_DENSITY_POWER)
+
+# fill in the pressure from the altitude where it is not given
+def fill_pressure(alt, temp, pressure):
+    if (pressure is None):
+        return get_pressure_array(alt, temp)
+    pressure = np.asarray(pressure, dtype = np.float64)
+    missing = (pressure == LARGE_NEGATIVE) | np.isnan(pressure)
+    if (not missing.any()):
+        return pressure
+    return np.where(missing, get_pressure_array(alt, temp), pressure)
 
-#test_dew_point()
-#test_pressure()
-#test_density()
+def get_dew_point_array(temp, rh):
+    temp = np.asarray(temp, dtype = np.float64)
+    a = np.log(np.asarray(rh, dtype = np.float64) / 100.0) + (DEW_A * temp) / (DEW_B + temp)
+    return (DEW_B * a) / (DEW_A - a)
+
+def get_density_array(alt, temp, rh, pressure = None):
+    temp = np.asarray(temp, dtype = np.float64)
+    rh = np.asarray(rh, dtype = np.float64)
+    kelvin = temp + 273.15
+    pressure = fill_pressure(alt, temp, pressure)
+
+    dew_point = get_dew_point_array(temp, rh)
+    pval = (7.5 * dew_point) / (237.3 + dew_point)
+
+    # saturated and actual pressure in pascals
+    actual_pressure = 610.78 * np.power(10.0, pval) * (rh / 100.0)
+    dry_pressure = pressure * 100.0 - actual_pressure
+    return (dry_pressure / RD + actual_pressure / RV) / kelvin
+
+def get_density1_array(alt, temp, rh, pressure = None):
+    temp = np.asarray(temp, dtype = np.float64)
+    kelvin = temp + 273.15
+    pressure = fill_pressure(alt, temp, pressure)
+    # teten's constants above and below freezing
+    freezing = temp < 0
+    a = np.where(freezing, 21.875, 17.270)
+    b = np.where(freezing, 265.5, 237.3)
+    saturated_pressure = 0.61078 * np.exp((a * temp) / (temp + b))
+    actual_pressure = np.asarray(rh, dtype = np.float64) * saturated_pressure
+    return (0.0034848 / kelvin) * (pressure * 100 - 0.0037960 * actual_pressure)
+
+def test_arrays():
+    rng = np.random.default_rng(3)
+    alt = rng.uniform(-100, 4000, 500)
+    temp = rng.uniform(-20, 40, 500)
+    rh = rng.uniform(5, 100, 500)
+    pressure = np.where(rng.uniform(0, 1, 500) < 0.5, rng.uniform(700, 1050, 500), LARGE_NEGATIVE)
+
+    altitude = get_altitude_array(pressure.clip(700), temp)
+    density = get_density_array(alt, temp, rh, pressure)
+    density1 = get_density1_array(alt, temp, rh, pressure)
+    dew_point = get_dew_point_array(temp, rh)
+    for i in range(0, alt.size):
+        assert abs(altitude[i] - get_altitude(max(pressure[i], 700), temp[i])) < 1e-9, "1: Altitude " + str(i)
+        assert abs(dew_point[i] - get_dew_point(temp[i], rh[i])) < 1e-9, "2: Dew point " + str(i)
+        assert abs(density[i] - get_density(alt[i], temp[i], rh[i], pressure[i])) < 1e-12, "3: Density " + str(i)
+        assert abs(density1[i] - get_density1(alt[i], temp[i], rh[i], pressure[i])) < 1e-12, "4: Density1 " + str(i)
+        assert abs(get_pressure_array(alt[i], temp[i]) - get_pressure(alt[i], temp[i])) < 1e-9, "5: Pressure " + str(i)
+    assert np.array_equal(get_density_array(alt, temp, rh), get_density_array(alt, temp, rh, np.nan)), "6: Missing"
+
+# Main
+if __name__ == "__main__":
+    test_dew_point()
+    test_pressure()
+    test_density()
+    test_arrays()
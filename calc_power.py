@@ -102,4 +102,5 @@ def test_cases():
     power = math.ceil(calc_power(GRADE_RES + ROLLING_RES + AIR_RES, V_BIKE))
     assert abs(power - expected) <= TOLERANCE, "6: Expected " + str(power)
 
-test_cases()
\ No newline at end of file
+if __name__ == "__main__":
+    test_cases()
\ No newline at end of file
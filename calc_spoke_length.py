@@ -1,4 +1,4 @@
-# 
+#
 # Spoke length Calculator
 # Copyright (c) 2020 Manu Konchady
 #
@@ -7,33 +7,187 @@
 # All parameters in mm.
 
 import math
+import common
+
+np = common.lazy_import("numpy")
+
+# the length of a spoke from the flange offset (half the hub length less the side hub length),
+# the flange diameter, the rim diameter, the number of spokes and the crossings
+def get_spoke_length(internal_rim_diameter, hub_diameter, flange_offset, num_spokes, crossings, rim_thickness = 0):
+    temp = (    math.pow(internal_rim_diameter / 2, 2) +
+                math.pow(hub_diameter / 2, 2) +
+                math.pow(flange_offset, 2) ) - \
+                (internal_rim_diameter * (hub_diameter / 2) *
+                (math.cos(math.radians( ( 720 * crossings) / num_spokes))))
+    return math.sqrt(temp) + rim_thickness
+
+def get_spoke_length_array(internal_rim_diameter, hub_diameter, flange_offset, num_spokes, crossings, rim_thickness = 0):
+    temp = (internal_rim_diameter / 2) ** 2 + (hub_diameter / 2) ** 2 + flange_offset ** 2 - \
+           internal_rim_diameter * (hub_diameter / 2) * np.cos(np.radians(720.0 * crossings / num_spokes))
+    return np.sqrt(temp) + rim_thickness
+
+# a pattern is valid while the spokes of a flange cross at less than half a turn
+def valid_crossings(num_spokes, crossings):
+    return (crossings >= 0) & (720.0 * crossings < 180.0 * num_spokes)
+
+#*------------------------------------------------------------------------------------------
+#*- Catalogs are dicts of equal length columns (lists or arrays):
+#*-   hubs:    name, total_length, non_gear_length, gear_length, non_gear_diameter,
+#*-            gear_diameter, spokes
+#*-   rims:    name, diameter (internal / effective rim diameter), thickness, spokes
+#*-   lacings: name, spokes, non_gear_crossings, gear_crossings
+#*- A build is a hub, rim and lacing with the same number of spokes and valid crossings.
+#*------------------------------------------------------------------------------------------
+HUB_COLUMNS = ("name", "total_length", "non_gear_length", "gear_length", "non_gear_diameter", "gear_diameter", \
+               "spokes")
+RIM_COLUMNS = ("name", "diameter", "thickness", "spokes")
+LACING_COLUMNS = ("name", "spokes", "non_gear_crossings", "gear_crossings")
+
+def get_table(catalog, columns):
+    table = {}
+    for column in columns:
+        if (column not in catalog):
+            raise KeyError("Catalog is missing the column " + column)
+        table[column] = np.asarray(catalog[column], dtype = object if column == "name" else np.float64)
+    return table
+
+#*------------------------------------------------------------------------------------------
+#*- spoke lengths of every build, with the builds sorted by each side's length so that a
+#*- length range is two binary searches
+#*------------------------------------------------------------------------------------------
+class SpokeLengths:
+
+    def __init__(self, hubs, rims, lacings, hub, rim, lacing, non_gear, gear):
+        self.hubs = hubs
+        self.rims = rims
+        self.lacings = lacings
+        self.hub = hub
+        self.rim = rim
+        self.lacing = lacing
+        self.non_gear = non_gear
+        self.gear = gear
+        self.non_gear_order = np.argsort(non_gear, kind = 'stable')
+        self.gear_order = np.argsort(gear, kind = 'stable')
+        self.non_gear_sorted = non_gear[self.non_gear_order]
+        self.gear_sorted = gear[self.gear_order]
+
+    def __len__(self):
+        return self.hub.size
+
+    #*-- indices of the builds needing a spoke within length +- tolerance on side
+    #*-- "non_gear", "gear" or "either"
+    def find(self, length, tolerance = 1.0, side = "either"):
+        found = []
+        for name, order, lengths in (("non_gear", self.non_gear_order, self.non_gear_sorted), \
+                                     ("gear", self.gear_order, self.gear_sorted)):
+            if (side in (name, "either")):
+                low = np.searchsorted(lengths, length - tolerance, side = 'left')
+                high = np.searchsorted(lengths, length + tolerance, side = 'right')
+                found.append(order[low:high])
+        if (not found):
+            raise ValueError("side must be non_gear, gear or either: " + str(side))
+        return np.unique(np.concatenate(found))
+
+    #*-- the builds at indices as a dict of columns, lengths rounded to whole mm for ordering
+    def builds(self, indices):
+        return dict(hub = self.hubs["name"][self.hub[indices]], rim = self.rims["name"][self.rim[indices]], \
+                    lacing = self.lacings["name"][self.lacing[indices]], non_gear = self.non_gear[indices], \
+                    gear = self.gear[indices], non_gear_rounded = np.round(self.non_gear[indices]), \
+                    gear_rounded = np.round(self.gear[indices]))
+
+#*-- compute the spoke lengths of every build in the catalogs
+def get_spoke_lengths(hubs, rims, lacings):
+    hubs = get_table(hubs, HUB_COLUMNS)
+    rims = get_table(rims, RIM_COLUMNS)
+    lacings = get_table(lacings, LACING_COLUMNS)
+
+    # pair the catalogs one spoke count at a time
+    hub_index, rim_index, lacing_index = [], [], []
+    for spokes in np.intersect1d(np.intersect1d(hubs["spokes"], rims["spokes"]), lacings["spokes"]):
+        valid = (lacings["spokes"] == spokes) & valid_crossings(spokes, lacings["non_gear_crossings"]) & \
+                valid_crossings(spokes, lacings["gear_crossings"])
+        h, r, l = np.meshgrid(np.flatnonzero(hubs["spokes"] == spokes), np.flatnonzero(rims["spokes"] == spokes), \
+                              np.flatnonzero(valid), indexing = 'ij')
+        hub_index.append(h.ravel())
+        rim_index.append(r.ravel())
+        lacing_index.append(l.ravel())
+    hub = np.concatenate(hub_index) if hub_index else np.zeros(0, dtype = np.intp)
+    rim = np.concatenate(rim_index) if rim_index else np.zeros(0, dtype = np.intp)
+    lacing = np.concatenate(lacing_index) if lacing_index else np.zeros(0, dtype = np.intp)
+
+    half = hubs["total_length"][hub] / 2
+    lengths = []
+    for side in ("non_gear", "gear"):
+        lengths.append(get_spoke_length_array(rims["diameter"][rim], hubs[side + "_diameter"][hub], \
+                                              half - hubs[side + "_length"][hub], lacings["spokes"][lacing], \
+                                              lacings[side + "_crossings"][lacing], rims["thickness"][rim]))
+    return SpokeLengths(hubs, rims, lacings, hub, rim, lacing, lengths[0], lengths[1])
+
+def test_lengths():
+    # the sapim values of the original script
+    assert round(get_spoke_length(622, 16, 120 / 2 - 16, 32, 0, 0)) + 5 == 311, "1: Expected non gear length 311"
+    assert round(get_spoke_length(622, 16, 120 / 2 - 30, 32, 0, 0)) + 5 == 309, "2: Expected gear length 309"
+
+    rng = np.random.default_rng(2)
+    n_hubs, n_rims = 60, 80
+    hubs = dict(name = ["hub" + str(i) for i in range(0, n_hubs)], total_length = rng.choice([100, 130, 135, 142], n_hubs), \
+                non_gear_length = rng.uniform(14, 40, n_hubs), gear_length = rng.uniform(14, 40, n_hubs), \
+                non_gear_diameter = rng.uniform(30, 60, n_hubs), gear_diameter = rng.uniform(30, 60, n_hubs), \
+                spokes = rng.choice([24, 28, 32, 36], n_hubs))
+    rims = dict(name = ["rim" + str(i) for i in range(0, n_rims)], diameter = rng.uniform(530, 610, n_rims), \
+                thickness = rng.choice([0, 2, 5], n_rims), spokes = rng.choice([24, 28, 32, 36], n_rims))
+    patterns = [(s, x, y) for s in (24, 28, 32, 36) for x in range(0, 6) for y in range(0, 6)]
+    lacings = dict(name = ["%d %dx/%dx" % p for p in patterns], spokes = [p[0] for p in patterns], \
+                   non_gear_crossings = [p[1] for p in patterns], gear_crossings = [p[2] for p in patterns])
+    result = get_spoke_lengths(hubs, rims, lacings)
+
+    # every build against the scalar formula and the matching rules
+    expected = 0
+    for h in range(0, n_hubs):
+        for r in range(0, n_rims):
+            for s, x, y in patterns:
+                if (hubs["spokes"][h] == rims["spokes"][r] == s and 4 * x < s and 4 * y < s):
+                    expected += 1
+    assert len(result) == expected, "3: Expected " + str(expected) + " builds, got " + str(len(result))
+    for i in rng.integers(0, len(result), 50):
+        h, r, l = result.hub[i], result.rim[i], result.lacing[i]
+        non_gear = get_spoke_length(rims["diameter"][r], hubs["non_gear_diameter"][h], \
+                                    hubs["total_length"][h] / 2 - hubs["non_gear_length"][h], patterns[l][0], \
+                                    patterns[l][1], rims["thickness"][r])
+        assert abs(result.non_gear[i] - non_gear) < 1e-9, "4: Expected length " + str(non_gear)
+
+    # length queries against a scan
+    for length, tolerance, side in ((290.0, 1.0, "either"), (270.5, 0.5, "gear"), (300.0, 2.0, "non_gear")):
+        found = result.find(length, tolerance, side)
+        near_non_gear = np.abs(result.non_gear - length) <= tolerance
+        near_gear = np.abs(result.gear - length) <= tolerance
+        scan = {"either": near_non_gear | near_gear, "gear": near_gear, "non_gear": near_non_gear}[side]
+        assert np.array_equal(found, np.flatnonzero(scan)), "5: Query " + str((length, tolerance, side))
+    builds = result.builds(result.find(290.0))
+    assert all(name.startswith("hub") for name in builds["hub"]), "6: Expected hub names"
+    assert np.all(np.minimum(np.abs(builds["non_gear"] - 290), np.abs(builds["gear"] - 290)) <= 1), "7: Lengths"
+    assert np.array_equal(builds["gear_rounded"], np.round(builds["gear"])), "8: Rounded lengths"
+
+if __name__ == "__main__":
+    test_lengths()
+
+    total_hub_length = 120
+    non_gear_side_hub_length = 16
+    gear_side_hub_length = 30
+    non_gear_side_hub_diameter = 16
+    gear_side_hub_diameter = 16
+    internal_rim_diameter = 622
+    rim_thickness = 5
+    num_spokes = 32
+    non_gear_side_crossings = 0
+    gear_side_crossings = 0
+
+    non_gear_length = (total_hub_length / 2) - non_gear_side_hub_length;
+    spoke_length = round(get_spoke_length(internal_rim_diameter, non_gear_side_hub_diameter, non_gear_length, \
+                                          num_spokes, non_gear_side_crossings)) + rim_thickness
+    print ("Non-gear side length: " + str(spoke_length))
 
-total_hub_length = 120
-non_gear_side_hub_length = 16
-gear_side_hub_length = 30
-non_gear_side_hub_diameter = 16
-gear_side_hub_diameter = 16
-internal_rim_diameter = 622
-rim_thickness = 5
-num_spokes = 32
-non_gear_side_crossings = 0
-gear_side_crossings = 0
-
-non_gear_length = (total_hub_length / 2) - non_gear_side_hub_length;
-non_gear_temp = (    math.pow(internal_rim_diameter / 2, 2) + 
-                            math.pow(non_gear_side_hub_diameter / 2, 2) +
-							math.pow(non_gear_length, 2) ) - \
-							(internal_rim_diameter * (non_gear_side_hub_diameter / 2) * 
-                            (math.cos(math.radians( ( 720 * non_gear_side_crossings) / num_spokes))))
-spoke_length = round(math.sqrt(non_gear_temp)) + rim_thickness
-print ("Non-gear side length: " + str(spoke_length))
-
-
-gear = (total_hub_length / 2) - gear_side_hub_length;
-gear_temp = (    math.pow(internal_rim_diameter / 2, 2) + 
-                            math.pow(gear_side_hub_diameter / 2, 2) +
-							math.pow(gear, 2) ) - \
-							(internal_rim_diameter * (gear_side_hub_diameter / 2) * 
-                            (math.cos(math.radians( ( 720 * gear_side_crossings) / num_spokes))))
-spoke_length = round(math.sqrt(gear_temp)) + rim_thickness
-print ("Gear side length: " + str(spoke_length))
+    gear = (total_hub_length / 2) - gear_side_hub_length;
+    spoke_length = round(get_spoke_length(internal_rim_diameter, gear_side_hub_diameter, gear, num_spokes, \
+                                          gear_side_crossings)) + rim_thickness
+    print ("Gear side length: " + str(spoke_length))
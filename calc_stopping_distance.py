@@ -4,9 +4,13 @@
 
 import math
 import sys
+import bisect
 import calc_wind
 import moments
 import common
+import instrumentation
+
+np = common.lazy_import("numpy")
 
 # Density calculation
 TEMP = 25 # centigrade
@@ -28,10 +32,27 @@ WHEEL_CIRCUM = 2.0 * math.pi * WHEEL_RADIUS # in meters
 REAR_CRANK_DISTANCE = 0.43
 COM_HEIGHT = 1.15
 
+# Rolling resistance
+# Clinchers: 0.005, Tubular: 0.004, MTB: 0.012
+ROLL_V = 0.005
+
+# K_A: aerodynamic drag factor
+# C_D_Area Hoods: 0.388  Bartops: 0.445  Barends: 0.42  Drops: 0.3 Aerobar: 0.233
+FRONTAL_AREA = 0.5   # m^2
+C_D = 1.15
+C_D_AREA = C_D * FRONTAL_AREA
+C_D_AREA = 0.388
+K_A = 0.5 * C_D_AREA * DENSITY
+
 BIG_NUMBER = 10000
 SMALL_NEGATIVE_NUMBER = -0.00000000000000000000001
 INVALID_REAR_FRAC = -1
 
+# integration methods for calc_dist
+EULER = 'euler'     # fixed time step, the reference method
+RK45 = 'rk45'       # adaptive Dormand-Prince 5(4) with error control
+EXACT = 'exact'     # closed form, falls back to RK45 when a tail wind overtakes the bike
+
 #*-- get the maximum fraction of rear brake for a given braking g force
 def get_rear_frac(G_FRAC):
     if (G_FRAC < 0 or G_FRAC > 0.56):
@@ -49,6 +70,19 @@ def calc_power(total_res, v_bike):
     EFFICIENCY = 0.95
     return common.meter_per_second(v_bike) * total_res / EFFICIENCY
 
+#*--------------------------------------------------------------------
+# Find the max. brake force on the rear tyre from moments, returns True
+# when the rear brake force exceeds the static friction force
+# coefficient of static friction 0.35 for wet, and 0.7 for dry
+#*--------------------------------------------------------------------
+def rear_brake_slips(GRADE, G_FRAC, rear_frac, C_SF):
+    COS_THETA = 1.0 - GRADE / 100.0 # approximately
+    f_nf, f_nr = moments.get_normal_forces_1(WHEEL_BASE, REAR_CRANK_DISTANCE, COM_HEIGHT, \
+                TOTAL_MASS * COS_THETA, G_FRAC)
+    f_rear_max = C_SF * f_nr         # max. rear wheel braking force
+    f_rear_brake = G_FRAC * G_ACCEL * rear_frac * TOTAL_MASS
+    return f_rear_brake > f_rear_max
+
 #*--------------------------------------------------
 # calculate the total of all drag forces
 # V_BIKE and V_WIND in kmph, grade in percent
@@ -58,38 +92,21 @@ def get_total_res(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac, C_SF = 0.7):
     # Calculate grade resistance
     GRADE_V = GRADE / 100.0
     GRADE_RES = GRADE_V * TOTAL_WT
-    COS_THETA = 1.0 - GRADE_V # approximately 
     if (debug):
         print ("Slope Resistance: " + str(GRADE_RES))
 
     # Calculate rolling resistance
-    # Clinchers: 0.005, Tubular: 0.004, MTB: 0.012
-    ROLL_V = 0.005
     ROLLING_RES = ROLL_V * TOTAL_WT
     if (debug):
         print ("Rolling resistance: " + str(ROLLING_RES))
 
-    # calculate K_A: aerodynamic drag factor
-    # C_D_Area Hoods: 0.388  Bartops: 0.445  Barends: 0.42  Drops: 0.3 Aerobar: 0.233
-    FRONTAL_AREA = 0.5   # m^2
-    C_D = 1.15
-    C_D_AREA = C_D * FRONTAL_AREA
-    C_D_AREA = 0.388
-    K_A = 0.5 * C_D_AREA * DENSITY 
-
     # calculate air drag
     V_DEG = 0   # direction (bearing of head wind)
     AIR_RES = calc_air_res(K_A, V_BIKE, V_WIND, V_DEG)
     if (debug):
         print ("Air Drag: " + str(AIR_RES))
 
-    # Find the max. brake force on the rear tyre from moments
-    # coefficient of static friction 0.35 for wet, and 0.7 for dry
-    f_nf, f_nr = moments.get_normal_forces_1(WHEEL_BASE, REAR_CRANK_DISTANCE, COM_HEIGHT, \
-                TOTAL_MASS * COS_THETA, G_FRAC)
-    f_rear_max = C_SF * f_nr         # max. rear wheel braking force
-    f_rear_brake = G_FRAC * G_ACCEL * rear_frac * TOTAL_MASS
-    if (f_rear_brake > f_rear_max): # rear brake force exceeds static friction force
+    if (rear_brake_slips(GRADE, G_FRAC, rear_frac, C_SF)):
         return -1
 
     # set the brake resistance
@@ -99,28 +116,135 @@ def get_total_res(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac, C_SF = 0.7):
 
     return (BRAKE_RES + AIR_RES + ROLLING_RES + GRADE_RES)
 
+#*-----------------------------------------------------------------------------------------------------
+#*-- Immutable rider and bike configuration. The module globals are the defaults, the velocity
+#*-- independent terms (masses, weight, K_A, rolling resistance) are computed once.
+#*-- braking() returns the drag forces of get_total_res for one braking scenario with the
+#*-- brake, rolling and grade resistance and the rear brake friction check precomputed.
+#*-----------------------------------------------------------------------------------------------------
+class RiderBike:
+    # the constructor arguments, the other slots are derived from them
+    FIELDS = ('rider_mass', 'bicycle_mass', 'wheel_mass', 'wheel_base', 'wheel_radius', 'rear_crank_distance', \
+              'com_height', 'density', 'roll_v', 'c_d_area')
+    __slots__ = FIELDS + ('total_mass', 'total_wt', 'K_A', 'rolling_res', 'ke_mass')
+
+    def __init__(self, rider_mass = RIDER_MASS, bicycle_mass = BICYCLE_MASS, wheel_mass = WHEEL_MASS, \
+                 wheel_base = WHEEL_BASE, wheel_radius = WHEEL_RADIUS, rear_crank_distance = REAR_CRANK_DISTANCE, \
+                 com_height = COM_HEIGHT, density = DENSITY, roll_v = ROLL_V, c_d_area = C_D_AREA):
+        values = dict(rider_mass = rider_mass, bicycle_mass = bicycle_mass, wheel_mass = wheel_mass, \
+                      wheel_base = wheel_base, wheel_radius = wheel_radius, rear_crank_distance = rear_crank_distance, \
+                      com_height = com_height, density = density, roll_v = roll_v, c_d_area = c_d_area)
+        values['total_mass'] = rider_mass + bicycle_mass
+        values['total_wt'] = values['total_mass'] * G_ACCEL
+        values['K_A'] = 0.5 * c_d_area * density
+        values['rolling_res'] = roll_v * values['total_wt']
+        # kinetic energy of the mass and rotational energy of the wheel, w = v / r
+        values['ke_mass'] = 0.5 * (values['total_mass'] + wheel_mass)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RiderBike is immutable, use replace()")
+
+    def __repr__(self):
+        return "RiderBike(" + ", ".join(name + "=" + str(getattr(self, name)) for name in self.FIELDS) + ")"
+
+    # the immutable __setattr__ breaks the default pickling of slots, e.g. for a process pool
+    def __reduce__(self):
+        return (RiderBike, tuple(getattr(self, name) for name in self.FIELDS))
+
+    # return a copy with some of the parameters changed
+    def replace(self, **changes):
+        values = dict((name, getattr(self, name)) for name in self.FIELDS)
+        values.update(changes)
+        return RiderBike(**values)
+
+    # change in ke + re from v_i to v_f in m/s
+    def get_delta_ke(self, v_i, v_f):
+        return self.ke_mass * (v_i * v_i - v_f * v_f)
+
+    def braking(self, V_WIND, GRADE, G_FRAC, rear_frac, C_SF = 0.7):
+        return Braking(self, V_WIND, GRADE, G_FRAC, rear_frac, C_SF)
+
+class Braking:
+    __slots__ = ('config', 'v_wind', 'K_A', 'grade_res', 'brake_res', 'constant_res', 'slips')
+
+    def __init__(self, config, V_WIND, GRADE, G_FRAC, rear_frac, C_SF):
+        cos_theta = 1.0 - GRADE / 100.0 # approximately
+        f_nf, f_nr = moments.get_normal_forces_1(config.wheel_base, config.rear_crank_distance, config.com_height, \
+                                                 config.total_mass * cos_theta, G_FRAC)
+        values = dict(config = config, v_wind = common.meter_per_second(V_WIND), K_A = config.K_A)
+        values['grade_res'] = GRADE / 100.0 * config.total_wt
+        values['brake_res'] = G_FRAC * config.total_wt
+        values['constant_res'] = values['brake_res'] + config.rolling_res + values['grade_res']
+        values['slips'] = G_FRAC * G_ACCEL * rear_frac * config.total_mass > C_SF * f_nr
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Braking is immutable")
+
+    #*-- total of all drag forces at V_BIKE in kmph, -1 when the rear brake slips
+    def resistance(self, V_BIKE, debug = False):
+        if (self.slips):
+            return -1
+        u = V_BIKE * 0.2777777777777777778 + self.v_wind
+        air_res = self.K_A * u * abs(u)
+        if (debug):
+            print ("Slope Resistance: " + str(self.grade_res))
+            print ("Rolling resistance: " + str(self.config.rolling_res))
+            print ("Air Drag: " + str(air_res))
+            print ("Brake Drag: " + str(self.brake_res))
+        return self.constant_res + air_res
+
+#*-- the configuration from the current module globals
+def default_config():
+    return RiderBike(RIDER_MASS, BICYCLE_MASS, WHEEL_MASS, WHEEL_BASE, WHEEL_RADIUS, REAR_CRANK_DISTANCE, \
+                     COM_HEIGHT, DENSITY, ROLL_V, C_D_AREA)
+
 #*--------------------------------------------------
 # calculate stopping distance using drag forces
 #*--------------------------------------------------
-def dist1(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac = 0.0, C_SF = 0.7):
-    return calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, True, rear_frac, C_SF)
+def dist1(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac = 0.0, C_SF = 0.7, method = EULER, tolerance = 1e-6, \
+          config = None):
+    return calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, True, rear_frac, C_SF, method, tolerance, config)
 
-def time1(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac = 0.0, C_SF = 0.7):
-    return calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, False, rear_frac, C_SF)
+def time1(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac = 0.0, C_SF = 0.7, method = EULER, tolerance = 1e-6, \
+          config = None):
+    return calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, False, rear_frac, C_SF, method, tolerance, config)
 
-def calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, return_dist, rear_frac, C_SF):
+def calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, return_dist, rear_frac, C_SF, method = EULER, tolerance = 1e-6, \
+              config = None):
     if (rear_frac == INVALID_REAR_FRAC):
         rear_frac = get_rear_frac(G_FRAC)
-    TOTAL_RES = get_total_res(V_BIKE, V_WIND, GRADE, G_FRAC, debug, rear_frac, C_SF)
+    if (config is None):
+        config = default_config()
+    if (method == EXACT):
+        exact = get_exact_stop(V_BIKE, V_WIND, GRADE, G_FRAC, rear_frac, C_SF, config = config)
+        if (exact is not None):
+            return exact[0] if return_dist else exact[1]
+        method = RK45
+    if (method == RK45):
+        trajectory = get_trajectory(V_BIKE, V_WIND, GRADE, G_FRAC, rear_frac, C_SF, tolerance, config = config)
+        if (trajectory is None):
+            return -1
+        if (return_dist):
+            return trajectory.stop_dist
+        return trajectory.stop_time
+    braking = config.braking(V_WIND, GRADE, G_FRAC, rear_frac, C_SF)
+    TOTAL_MASS = config.total_mass
     DELTA_TIME = 0.05 # seconds
+    start = instrumentation.start()
     total_time = 0
     velocity = V_BIKE
     iter = 0
     stopping_dist = 0
     while (velocity > 1):
         # calculate the drag force, new acceleration, new velocity, and cumulative stopping distance
-        TOTAL_RES = get_total_res(velocity, V_WIND, GRADE, G_FRAC, debug, rear_frac, C_SF)
+        TOTAL_RES = braking.resistance(velocity, debug)
         if (TOTAL_RES < 0):
+            if (instrumentation.enabled):
+                instrumentation.record("calc_dist.euler", start, iter, "negative_drag")
             return -1
         accel = TOTAL_RES / TOTAL_MASS
         new_velocity = velocity - common.kmph(accel) * DELTA_TIME  # convert accel from m/s to kmph
@@ -129,11 +253,201 @@ def calc_dist(V_BIKE, V_WIND, GRADE, G_FRAC, debug, return_dist, rear_frac, C_SF
         iter = iter + 1
         total_time += DELTA_TIME
         if (iter > 10000):
+           if (instrumentation.enabled):
+               instrumentation.record("calc_dist.euler", start, iter, "max_steps")
            return -1
+    if (instrumentation.enabled):
+        instrumentation.record("calc_dist.euler", start, iter, "stopped")
     if (return_dist):
         return stopping_dist
     return total_time
 
+#*-----------------------------------------------------------------------------------------------------
+#*-- Braking trajectory from the adaptive Dormand-Prince 5(4) integrator
+#*-- times in seconds, velocities in m/s and distances in meters. The steps are kept for dense
+#*-- output: the velocity and distance at any time are cubic Hermite interpolants between steps.
+#*-- The last step ends at the stopping velocity.
+#*-----------------------------------------------------------------------------------------------------
+class BrakingTrajectory:
+
+    def __init__(self, times, velocities, distances, accels):
+        self.times = times
+        self.velocities = velocities
+        self.distances = distances
+        self.accels = accels
+        self.steps = len(times) - 1
+        self.stop_time = times[-1]
+        self.stop_dist = distances[-1]
+
+    # return the step index and the Hermite basis at time t
+    def basis(self, t):
+        t = min(max(t, self.times[0]), self.times[-1])
+        i = min(max(bisect.bisect_right(self.times, t) - 1, 0), self.steps - 1)
+        h = self.times[i + 1] - self.times[i]
+        x = (t - self.times[i]) / h
+        return i, h, (2 * x ** 3 - 3 * x ** 2 + 1, x ** 3 - 2 * x ** 2 + x, -2 * x ** 3 + 3 * x ** 2, x ** 3 - x ** 2)
+
+    def velocity(self, t):
+        i, h, (h00, h10, h01, h11) = self.basis(t)
+        return h00 * self.velocities[i] + h10 * h * self.accels[i] + h01 * self.velocities[i + 1] + \
+               h11 * h * self.accels[i + 1]
+
+    def distance(self, t):
+        i, h, (h00, h10, h01, h11) = self.basis(t)
+        return h00 * self.distances[i] + h10 * h * self.velocities[i] + h01 * self.distances[i + 1] + \
+               h11 * h * self.velocities[i + 1]
+
+# Dormand-Prince 5(4) tableau
+DP_C = (0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1)
+DP_A = ((),
+        (1 / 5,),
+        (3 / 40, 9 / 40),
+        (44 / 45, -56 / 15, 32 / 9),
+        (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+        (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+        (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+DP_B = (35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0)
+DP_E = (71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40)  # 5th minus 4th order
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- integrate the deceleration dv/dt = -total_res(v) / TOTAL_MASS from V_BIKE (kmph) until the
+#*-- velocity drops to 1 kmph, the stopping velocity of calc_dist. The step size is chosen so that
+#*-- the local error of the velocity (m/s) and distance (m) is below tolerance.
+#*-- Returns None when the rear brake exceeds static friction or the drag forces are negative.
+#*-----------------------------------------------------------------------------------------------------
+def get_trajectory(V_BIKE, V_WIND, GRADE, G_FRAC, rear_frac, C_SF, tolerance = 1e-6, max_steps = BIG_NUMBER, \
+                   config = None):
+    if (config is None):
+        config = default_config()
+    braking = config.braking(V_WIND, GRADE, G_FRAC, rear_frac, C_SF)
+    mass = config.total_mass
+    v_stop = common.meter_per_second(1)
+    failed = []
+    start = instrumentation.start()
+
+    def accel(v):
+        total_res = braking.resistance(common.kmph(v))
+        if (total_res < 0):
+            failed.append(total_res)
+        return -total_res / mass
+
+    # one Dormand-Prince step of (velocity, distance), the derivative of the distance is the
+    # velocity. The last stage is the acceleration at the end of the step.
+    def step(v, s, a, h):
+        k_v = [a]
+        k_s = [v]
+        for stage in range(1, 7):
+            v_stage = v + h * sum(c * k for c, k in zip(DP_A[stage], k_v))
+            k_v.append(accel(v_stage))
+            k_s.append(v_stage)
+        v_new = v + h * sum(b * k for b, k in zip(DP_B, k_v))
+        s_new = s + h * sum(b * k for b, k in zip(DP_B, k_s))
+        error = h * max(abs(sum(e * k for e, k in zip(DP_E, k_v))), abs(sum(e * k for e, k in zip(DP_E, k_s))))
+        return v_new, s_new, k_v[6], error
+
+    v = common.meter_per_second(V_BIKE)
+    a = accel(v)
+    times = [0.0]
+    velocities = [v]
+    distances = [0.0]
+    accels = [a]
+    if (failed):
+        if (instrumentation.enabled):
+            instrumentation.record("get_trajectory", start, 0, "negative_drag")
+        return None
+    if (v <= v_stop):
+        return BrakingTrajectory([0.0, 0.0], [v, v], [0.0, 0.0], [a, a])
+
+    t = 0.0
+    s = 0.0
+    h = min(1.0, 0.1 * v / max(abs(a), 1e-9))
+    for attempt in range(0, max_steps):
+        v_new, s_new, a_new, error = step(v, s, a, h)
+        if (failed):
+            if (instrumentation.enabled):
+                instrumentation.record("get_trajectory", start, attempt + 1, "negative_drag")
+            return None
+        if (error > tolerance):
+            h = h * max(0.2, 0.9 * (tolerance / error) ** 0.2)
+            continue
+
+        if (v_new <= v_stop):
+            # shorten the last step until it ends at the stopping velocity, starting from the
+            # linear estimate and correcting with the acceleration at the end of the step
+            h_stop = h * (v - v_stop) / (v - v_new)
+            for _ in range(0, 10):
+                v_new, s_new, a_new, error = step(v, s, a, h_stop)
+                correction = (v_new - v_stop) / a_new
+                h_stop = h_stop - correction
+                if (abs(correction * a_new) < tolerance):
+                    break
+            v_new, s_new, a_new, error = step(v, s, a, h_stop)
+            times.append(t + h_stop)
+            velocities.append(v_new)
+            distances.append(s_new)
+            accels.append(a_new)
+            if (instrumentation.enabled):
+                instrumentation.record("get_trajectory", start, attempt + 1, "stopped")
+            return BrakingTrajectory(times, velocities, distances, accels)
+
+        t = t + h
+        v = v_new
+        s = s_new
+        a = a_new
+        times.append(t)
+        velocities.append(v)
+        distances.append(s)
+        accels.append(a)
+        h = h * min(5.0, 0.9 * (tolerance / max(error, 1e-300)) ** 0.2)
+    if (instrumentation.enabled):
+        instrumentation.record("get_trajectory", start, max_steps, "max_steps")
+    return None
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- Closed form stopping distance (m) and time (s) for the drag forces of get_total_res.
+#*-- With u = v + v_wind the air speed and C the constant brake, rolling and grade resistance
+#*--      M du/dt = -(C + K_A u^2),   ds = (u - v_wind) dt
+#*-- so that between air speeds u0 and u1
+#*--      C > 0:  t = M / sqrt(C K_A) * (atan(u0 / a) - atan(u1 / a)),        a = sqrt(C / K_A)
+#*--      C < 0:  t = M / (2 K_A b) * ln((u0 - b)(u1 + b) / ((u0 + b)(u1 - b))),  b = sqrt(-C / K_A)
+#*--      C = 0:  t = M / K_A * (1 / u1 - 1 / u0)
+#*--      s = M / (2 K_A) * ln((C + K_A u0^2) / (C + K_A u1^2)) - v_wind * t
+#*-- V_BIKE, V_WIND and V_STOP in kmph. Returns -1, -1 when the rear brake slips or the bike does
+#*-- not slow down to V_STOP, and None when a tail wind overtakes the bike before it stops and
+#*-- the drag changes sign.
+#*-----------------------------------------------------------------------------------------------------
+def get_exact_stop(V_BIKE, V_WIND, GRADE, G_FRAC, rear_frac = 0.0, C_SF = 0.7, V_STOP = 1.0, mass = None, \
+                   config = None):
+    if (config is None):
+        config = default_config()
+    if (mass is None):
+        mass = config.total_mass
+    braking = config.braking(V_WIND, GRADE, G_FRAC, rear_frac, C_SF)
+    if (braking.slips):
+        return -1, -1
+    v_wind = common.meter_per_second(V_WIND)
+    u0 = common.meter_per_second(V_BIKE) + v_wind
+    u1 = common.meter_per_second(V_STOP) + v_wind
+    if (V_BIKE <= V_STOP):
+        return 0.0, 0.0
+    if (u1 < 0):
+        return None
+    C = braking.constant_res
+    K_A = braking.K_A
+    if (C + K_A * u1 * u1 <= 0):   # drag forces are negative at the stopping velocity
+        return -1, -1
+
+    if (C > 0):
+        a = math.sqrt(C / K_A)
+        stop_time = mass / math.sqrt(C * K_A) * (math.atan(u0 / a) - math.atan(u1 / a))
+    elif (C < 0):
+        b = math.sqrt(-C / K_A)
+        stop_time = mass / (2.0 * K_A * b) * math.log((u0 - b) * (u1 + b) / ((u0 + b) * (u1 - b)))
+    else:
+        stop_time = mass / K_A * (1.0 / u1 - 1.0 / u0)
+    stop_dist = mass / (2.0 * K_A) * math.log((C + K_A * u0 * u0) / (C + K_A * u1 * u1)) - v_wind * stop_time
+    return stop_dist, stop_time
+
 #*-----------------------------------------------------------------------------------------------------
 #*-- return stopping distance from formula in pg 246 of Bicycling Science
 #*-- velocity in kmph. and c_a, c_r in fractions are coefficients of adhesion and rolling resistance
@@ -174,21 +488,30 @@ def dist3(t, v, g, f):
 # calculate stopping distance using kinetic energy
 # V_BIKE and V_WIND in kmph., GRADE in percent, and g_frac as a fraction of g
 #*--------------------------------------------------
-def dist4(V_BIKE, V_WIND, GRADE, G_FRAC, debug, C_SF):
+def dist4(V_BIKE, V_WIND, GRADE, G_FRAC, debug, C_SF, config = None):
+    if (config is None):
+        config = default_config()
+    braking = config.braking(V_WIND, GRADE, G_FRAC, get_rear_frac(G_FRAC), C_SF)
+    TOTAL_MASS = config.total_mass
     total_s = 0
     DELTA_V = 0.05              # m/sec
     v_i = common.meter_per_second(V_BIKE)  # convert from kmph to m/sec.
-    delta_e = get_delta_ke(v_i, v_i - DELTA_V)
-    drag_forces = get_total_res(common.kmph(v_i), V_WIND, GRADE, G_FRAC, debug, get_rear_frac(G_FRAC), C_SF)
+    delta_e = config.get_delta_ke(v_i, v_i - DELTA_V)
+    drag_forces = braking.resistance(common.kmph(v_i), debug)
     delta_s = delta_e / drag_forces
+    start = instrumentation.start()
+    steps = 0
     while (v_i > 1.0):      # repeat till velocity is 1 m/s
         v_f = v_i - DELTA_V
         v_a = (v_f + v_i) / 2.0     # average velocity
         delta_t = delta_s / (v_a)   # time interval
-        drag_forces = get_total_res(common.kmph(v_f), V_WIND, GRADE, G_FRAC, debug, get_rear_frac(G_FRAC), C_SF)
+        drag_forces = braking.resistance(common.kmph(v_f), debug)
+        steps += 1
         if (drag_forces < 0):
+            if (instrumentation.enabled):
+                instrumentation.record("dist4", start, steps, "negative_drag")
             return -1
-        delta_ke = get_delta_ke(v_i, v_f) 
+        delta_ke = config.get_delta_ke(v_i, v_f)
         # calculate delta pe using delta s, positive when gradient is uphill and negative for downhill
         delta_pe = TOTAL_MASS * G_ACCEL * (GRADE / 100.0) * v_a * delta_t
         #delta_pe = TOTAL_MASS * G_ACCEL * (GRADE / 100.0) * delta_s
@@ -204,6 +527,8 @@ def dist4(V_BIKE, V_WIND, GRADE, G_FRAC, debug, C_SF):
                    " PE: " + common.nice_s(delta_pe) + " Drag Forces: " + common.nice_s(drag_forces) + \
                    " DS: " + common.nice_s(delta_s) + " DT: " + common.nice_s(delta_t))
        
+    if (instrumentation.enabled):
+        instrumentation.record("dist4", start, steps, "stopped")
     return total_s
 
 #*-------------------------------------------------
@@ -216,3 +541,263 @@ def get_delta_ke(v_i, v_f):
      delta_re = 0.5 * WHEEL_MASS * WHEEL_RADIUS * WHEEL_RADIUS * (w_i * w_i - w_f * w_f)
      return (delta_ke + delta_re)
 
+#*-----------------------------------------------------------------------------------------------------
+#*-- Stopping distances and times over a grid, labelled by the names of the swept parameters.
+#*-- distance (m), time (s) and steps are arrays with one axis per name in dims, invalid cells
+#*-- (rear brake slips, negative drag forces or no stop) are nan with valid set to False.
+#*-----------------------------------------------------------------------------------------------------
+class StoppingSweep:
+
+    def __init__(self, dims, coords, distance, time, valid, steps):
+        self.dims = dims
+        self.coords = coords
+        self.distance = distance
+        self.time = time
+        self.valid = valid
+        self.steps = steps
+
+    #*-- select cells by coordinate value, e.g. sel(V_BIKE = 40, C_SF = 0.7), dropping those axes
+    def sel(self, **labels):
+        index = []
+        dims = []
+        for dim in self.dims:
+            if (dim in labels):
+                matches = np.flatnonzero(np.isclose(self.coords[dim], labels[dim]))
+                if (matches.size == 0):
+                    raise KeyError(dim + " = " + str(labels[dim]) + " is not in the sweep")
+                index.append(matches[0])
+            else:
+                index.append(slice(None))
+                dims.append(dim)
+        index = tuple(index)
+        coords = dict((dim, self.coords[dim]) for dim in dims)
+        return StoppingSweep(tuple(dims), coords, self.distance[index], self.time[index], self.valid[index], \
+                             self.steps[index])
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- get_exact_stop as arrays, u0 and u1 are the air speeds (m/s) at the start and stopping velocity,
+#*-- C the constant drag forces. K_A and mass may be scalars or arrays. Cells where the bike slips,
+#*-- is overtaken by a tail wind or has negative drag at u1 are not checked and must be masked out.
+#*-----------------------------------------------------------------------------------------------------
+def get_exact_stops(u0, u1, v_wind, C, K_A, mass):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        a = np.sqrt(np.abs(C) / K_A)
+        positive = mass / np.sqrt(np.abs(C) * K_A) * (np.arctan(u0 / a) - np.arctan(u1 / a))
+        negative = mass / (2.0 * K_A * a) * np.log((u0 - a) * (u1 + a) / ((u0 + a) * (u1 - a)))
+        zero = mass / K_A * (1.0 / u1 - 1.0 / u0)
+        time = np.where(C > 0, positive, np.where(C < 0, negative, zero))
+        distance = mass / (2.0 * K_A) * np.log((C + K_A * u0 * u0) / (C + K_A * u1 * u1)) - v_wind * time
+    return distance, time
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- get_exact_stops where a tail wind overtakes the bike, u1 < 0. The drag C + K_A * u * |u| is
+#*-- integrated in closed form down to an air speed of 0 and then from 0 to u1 where the air pushes
+#*-- the bike. Cells are valid when C > 0 and the drag at u1 is positive, the others must be masked.
+#*-----------------------------------------------------------------------------------------------------
+def get_overtaken_stops(u0, u1, v_wind, C, K_A, mass):
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        a = np.sqrt(C / K_A)
+        head = np.maximum(u0, 0.0)
+        tail = np.maximum(-u0, 0.0)
+        time = mass / np.sqrt(C * K_A) * (np.arctan(head / a) + np.arctanh(-u1 / a) - np.arctanh(tail / a))
+        distance = mass / (2.0 * K_A) * (np.log((C + K_A * head * head) / C) + \
+                                         np.log((C - K_A * u1 * u1) / (C - K_A * tail * tail))) - v_wind * time
+    return distance, time
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- sweep the stopping distance and time over V_BIKE (kmph), GRADE (percent), G_FRAC and C_SF arrays.
+#*-- EULER integrates all cells together with the time step of calc_dist, a cell is masked out once
+#*-- it stops or becomes invalid. EXACT evaluates get_exact_stop as arrays, and get_overtaken_stops
+#*-- for the cells where a tail wind overtakes the bike.
+#*-----------------------------------------------------------------------------------------------------
+def sweep_stopping(V_BIKE, GRADE, G_FRAC, C_SF = 0.7, V_WIND = 0, rear_frac = 0.0, method = EULER, config = None):
+    if (config is None):
+        config = default_config()
+    dims = ('V_BIKE', 'GRADE', 'G_FRAC', 'C_SF')
+    coords = dict((dim, np.atleast_1d(np.asarray(value, dtype = np.float64))) for dim, value in \
+                  zip(dims, (V_BIKE, GRADE, G_FRAC, C_SF)))
+    v_bike, grade, g_frac, c_sf = np.meshgrid(*[coords[dim] for dim in dims], indexing = 'ij')
+    shape = v_bike.shape
+
+    # velocity independent terms of Braking for every cell
+    cos_theta = 1.0 - grade / 100.0
+    f_nf, f_nr = moments.get_normal_forces_1(config.wheel_base, config.rear_crank_distance, config.com_height, \
+                                             config.total_mass * cos_theta, g_frac)
+    valid = ~(g_frac * G_ACCEL * rear_frac * config.total_mass > c_sf * f_nr)
+    constant_res = (g_frac + grade / 100.0) * config.total_wt + config.rolling_res
+    v_wind = common.meter_per_second(V_WIND)
+    K_A = config.K_A
+    mass = config.total_mass
+
+    distance = np.zeros(shape)
+    time = np.zeros(shape)
+    steps = np.zeros(shape, dtype = np.int32)
+    if (method == EXACT):
+        u0 = common.meter_per_second(v_bike) + v_wind
+        u1 = common.meter_per_second(1.0) + v_wind + np.zeros(shape)
+        overtaken = u1 < 0
+        valid &= np.where(overtaken, (constant_res > 0) & (constant_res - K_A * u1 * u1 > 0), \
+                          constant_res + K_A * u1 * u1 > 0)
+        C = np.where(valid, constant_res, 1.0)
+        distance, time = get_exact_stops(u0, np.where(overtaken, 1.0, u1), v_wind, C, K_A, mass)
+        if (overtaken.any()):
+            tail_distance, tail_time = get_overtaken_stops(u0, u1, v_wind, C, K_A, mass)
+            distance = np.where(overtaken, tail_distance, distance)
+            time = np.where(overtaken, tail_time, time)
+        stopped = v_bike <= 1.0
+        distance = np.where(stopped, 0.0, distance)
+        time = np.where(stopped, 0.0, time)
+    else:
+        DELTA_TIME = 0.05 # seconds
+        velocity = v_bike.ravel().copy()
+        constant_res = constant_res.ravel()
+        valid = valid.ravel()
+        distance = distance.ravel()
+        time = time.ravel()
+        steps = steps.ravel()
+        active = np.flatnonzero(valid & (velocity > 1))
+        while (active.size > 0):
+            u = common.meter_per_second(velocity[active]) + v_wind
+            total_res = constant_res[active] + K_A * u * np.abs(u)
+            negative = total_res < 0
+            valid[active[negative]] = False
+            active = active[~negative]
+            total_res = total_res[~negative]
+
+            new_velocity = velocity[active] - common.kmph(total_res / mass) * DELTA_TIME
+            distance[active] += common.meter_per_second(DELTA_TIME * new_velocity)
+            velocity[active] = new_velocity
+            steps[active] += 1
+            time[active] += DELTA_TIME
+            too_long = steps[active] > BIG_NUMBER
+            valid[active[too_long]] = False
+            active = active[(new_velocity > 1) & ~too_long]
+        valid = valid.reshape(shape)
+        distance = distance.reshape(shape)
+        time = time.reshape(shape)
+        steps = steps.reshape(shape)
+
+    distance = np.where(valid, distance, np.nan)
+    time = np.where(valid, time, np.nan)
+    return StoppingSweep(dims, coords, distance, time, valid, steps)
+
+def test_integrators():
+    # adaptive steps against the fixed step Euler reference
+    for V_BIKE, GRADE, G_FRAC in ((20, 0, 0.5), (40, -5, 0.3), (30, 5, 0.2), (50, 0, 0.4)):
+        euler = dist1(V_BIKE, 0, GRADE, G_FRAC, False)
+        rk = dist1(V_BIKE, 0, GRADE, G_FRAC, False, method = RK45)
+        fine = dist1(V_BIKE, 0, GRADE, G_FRAC, False, method = RK45, tolerance = 1e-10)
+        assert abs(rk - fine) < 1e-4, "1: Expected dist: " + str(fine) + " " + str(rk)
+        assert abs(euler - rk) < 0.06 * rk, "2: Expected dist: " + str(euler) + " " + str(rk)
+        euler = time1(V_BIKE, 0, GRADE, G_FRAC, False)
+        rk = time1(V_BIKE, 0, GRADE, G_FRAC, False, method = RK45)
+        assert abs(euler - rk) < 0.06, "3: Expected time: " + str(euler) + " " + str(rk)
+
+        trajectory = get_trajectory(V_BIKE, 0, GRADE, G_FRAC, 0.0, 0.7)
+        assert trajectory.steps < 50, "4: Too many steps " + str(trajectory.steps)
+        assert abs(trajectory.velocity(0) - common.meter_per_second(V_BIKE)) < 1e-9, "5: Dense output at 0"
+        assert abs(trajectory.distance(trajectory.stop_time) - trajectory.stop_dist) < 1e-9, "6: Dense output at stop"
+
+    # rear brake beyond static friction
+    assert dist1(30, 0, 0, 0.5, False, 1.0, method = RK45) == -1, "7: Expected -1"
+
+def test_exact():
+    # closed form against the adaptive integrator, head winds, tail winds and steep descents
+    for V_BIKE, V_WIND, GRADE, G_FRAC in ((20, 0, 0, 0.5), (40, 10, -5, 0.3), (30, -0.5, 5, 0.2), \
+                                          (50, 0, -10, 0.1), (45, 40, -10, 0.09), (60, 20, 0, 0.4)):
+        exact_dist, exact_time = get_exact_stop(V_BIKE, V_WIND, GRADE, G_FRAC)
+        rk_dist = dist1(V_BIKE, V_WIND, GRADE, G_FRAC, False, method = RK45, tolerance = 1e-10)
+        rk_time = time1(V_BIKE, V_WIND, GRADE, G_FRAC, False, method = RK45, tolerance = 1e-10)
+        assert abs(exact_dist - rk_dist) < 1e-6, "1: Expected dist: " + str(rk_dist) + " " + str(exact_dist)
+        assert abs(exact_time - rk_time) < 1e-6, "2: Expected time: " + str(rk_time) + " " + str(exact_time)
+        assert dist1(V_BIKE, V_WIND, GRADE, G_FRAC, False, method = EXACT) == exact_dist, "3: Expected exact dist"
+
+        # Euler reference is within its step error
+        euler_dist = dist1(V_BIKE, V_WIND, GRADE, G_FRAC, False)
+        assert abs(euler_dist - exact_dist) < 0.06 * exact_dist, "4: Expected dist: " + str(euler_dist)
+
+    # dist4 stops at 1 m/s and includes the wheel inertia, on level ground
+    for V_BIKE, G_FRAC in ((20, 0.5), (40, 0.3), (50, 0.1)):
+        expected = get_exact_stop(V_BIKE, 0, 0, G_FRAC, get_rear_frac(G_FRAC), 0.7, common.kmph(1.0), \
+                                  TOTAL_MASS + WHEEL_MASS)[0]
+        distance = dist4(V_BIKE, 0, 0, G_FRAC, False, 0.7)
+        assert abs(distance - expected) < 0.01 * expected, "5: Expected dist: " + str(expected) + " " + str(distance)
+
+    # no stop, rear brake slips, and a tail wind faster than the stopping velocity
+    assert get_exact_stop(40, 0, -30, 0.0) == (-1, -1), "6: Expected -1"
+    assert get_exact_stop(30, 0, 0, 0.5, 1.0) == (-1, -1), "7: Expected -1"
+    assert get_exact_stop(30, -10, 0, 0.5) is None, "8: Expected no closed form"
+    assert abs(dist1(30, -10, 0, 0.5, False, method = EXACT) - dist1(30, -10, 0, 0.5, False, method = RK45)) < 1e-9, \
+           "9: Expected RK45 fall back"
+
+def test_config():
+    config = RiderBike()
+    braking = config.braking(10, 3, 0.4, 0.2)
+    for V_BIKE in (5, 20, 45):
+        expected = get_total_res(V_BIKE, 10, 3, 0.4, False, 0.2)
+        assert abs(braking.resistance(V_BIKE) - expected) < 1e-9, "1: Expected res: " + str(expected)
+    assert config.braking(0, 0, 0.5, 1.0).resistance(30) == -1, "2: Expected -1"
+    try:
+        config.com_height = 1.0
+        assert False, "3: Expected immutable configuration"
+    except AttributeError:
+        pass
+
+    # riders side by side, the default configuration matches the module globals
+    heavy = config.replace(rider_mass = 100)
+    aero = config.replace(c_d_area = 0.233)
+    assert dist1(40, 0, 0, 0.3, False) == dist1(40, 0, 0, 0.3, False, config = config), "4: Expected default"
+    assert dist4(40, 0, 0, 0.3, False, 0.7) == dist4(40, 0, 0, 0.3, False, 0.7, config = config), "5: Expected default"
+    assert dist1(40, 0, 0, 0.3, False, config = heavy) > dist1(40, 0, 0, 0.3, False), "6: Expected longer stop"
+    assert dist1(40, 0, 0, 0.3, False, config = aero) > dist1(40, 0, 0, 0.3, False), "7: Expected longer stop"
+    assert abs(dist1(40, 0, 0, 0.3, False, method = EXACT, config = heavy) - \
+               dist1(40, 0, 0, 0.3, False, method = RK45, config = heavy)) < 1e-4, "8: Expected exact dist"
+    assert dist4(40, 0, 0, 0.3, False, 0.7, config = heavy) > dist4(40, 0, 0, 0.3, False, 0.7), "9: Expected longer stop"
+
+def test_sweep():
+    V_BIKE = [10, 25, 40, 60]
+    GRADE = [-10, 0, 5]
+    G_FRAC = [0.05, 0.3, 0.5, 0.6]
+    C_SF = [0.35, 0.7]
+    for V_WIND in (0, 10):
+        sweep = sweep_stopping(V_BIKE, GRADE, G_FRAC, C_SF, V_WIND, 0.3)
+        exact = sweep_stopping(V_BIKE, GRADE, G_FRAC, C_SF, V_WIND, 0.3, EXACT)
+        assert sweep.distance.shape == (4, 3, 4, 2) and sweep.dims == ('V_BIKE', 'GRADE', 'G_FRAC', 'C_SF'), "1: Shape"
+        for index in np.ndindex(sweep.distance.shape):
+            args = (V_BIKE[index[0]], V_WIND, GRADE[index[1]], G_FRAC[index[2]], False, 0.3, C_SF[index[3]])
+            expected = dist1(*args)
+            if (expected == -1):
+                assert not sweep.valid[index] and np.isnan(sweep.distance[index]), "2: Expected invalid " + str(args)
+                assert not exact.valid[index], "3: Expected invalid " + str(args)
+                continue
+            assert abs(sweep.distance[index] - expected) < 1e-9, "4: Expected dist: " + str(expected) + " " + str(args)
+            assert abs(sweep.time[index] - time1(*args)) < 1e-9, "5: Expected time " + str(args)
+            expected = get_exact_stop(*(args[:4] + args[5:]))
+            assert abs(exact.distance[index] - expected[0]) < 1e-9, "6: Expected dist: " + str(expected) + " " + str(args)
+            assert abs(exact.time[index] - expected[1]) < 1e-9, "7: Expected time " + str(args)
+
+    # labelled selection
+    sweep = sweep_stopping(V_BIKE, GRADE, G_FRAC, C_SF)
+    cut = sweep.sel(V_BIKE = 40, C_SF = 0.7)
+    assert cut.dims == ('GRADE', 'G_FRAC') and cut.distance.shape == (3, 4), "8: Selection " + str(cut.dims)
+    assert cut.distance[1, 1] == dist1(40, 0, 0, 0.3, False), "9: Selection value"
+
+    # a tail wind overtaking the bike in closed form against RK45
+    for V_WIND in (-10, -25):
+        exact = sweep_stopping(V_BIKE, GRADE, G_FRAC, C_SF, V_WIND, 0.3, EXACT)
+        for index in np.ndindex(exact.distance.shape):
+            args = (V_BIKE[index[0]], V_WIND, GRADE[index[1]], G_FRAC[index[2]], 0.3, C_SF[index[3]])
+            # the RK45 of dist1 and time1
+            trajectory = get_trajectory(*args, tolerance = 1e-10)
+            if (trajectory is None):
+                assert not exact.valid[index], "10: Expected invalid " + str(args)
+                continue
+            assert exact.valid[index] and abs(exact.distance[index] - trajectory.stop_dist) < 1e-6, \
+                   "11: Tail wind dist " + str(args) + " " + str(exact.distance[index])
+            assert abs(exact.time[index] - trajectory.stop_time) < 1e-6, "12: Tail wind time " + str(args)
+
+if __name__ == "__main__":
+    test_integrators()
+    test_exact()
+    test_config()
+    test_sweep()
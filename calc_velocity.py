@@ -1,6 +1,10 @@
 import math
 import sys
 import calc_wind
+import common
+import instrumentation
+
+np = common.lazy_import("numpy")
 
 # Velocity Calculator from Power and Bike Parameters
 # Copyright (c) 2020 Manu Konchady
@@ -15,7 +19,8 @@ def calc_velocity(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg = 0
     TOLERANCE = 0.05
     if (wind_mag > 28):
         TOLERANCE = 0.02 * wind_mag
-    for _ in range(0, MAX_ITERATIONS):
+    start = instrumentation.start()
+    for iteration in range(0, MAX_ITERATIONS):
         W_A = calc_wind.get_head_wind2(bike_mag, wind_mag, wind_deg, bike_deg)
         head_mag = calc_wind.get_head_wind(bike_mag, wind_mag, wind_deg, bike_deg)
         if (W_A < 0):
@@ -24,10 +29,169 @@ def calc_velocity(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg = 0
         fprime = K_A * (3.0 * bike_mag + wind_mag) * head_mag + other_resistance
         new_bike_mag = bike_mag - (f / fprime)
         if (abs(new_bike_mag - bike_mag) < TOLERANCE):
+            if (instrumentation.enabled):
+                instrumentation.record("calc_velocity", start, iteration + 1, "converged")
             return new_bike_mag
         bike_mag = new_bike_mag
+    if (instrumentation.enabled):
+        instrumentation.record("calc_velocity", start, MAX_ITERATIONS, "max_iterations")
     return 0.0
 
+# cube root of a negative or positive number
+def cube_root(x):
+    return math.copysign(abs(x) ** (1.0 / 3.0), x)
+
+#*-------------------------------------------------------------------------
+# return the real roots of a * x^3 + b * x^2 + c * x + d using Cardano's
+# formula, or the trigonometric form when there are three real roots
+#*-------------------------------------------------------------------------
+def solve_cubic(a, b, c, d):
+    if (a == 0):
+        if (b == 0):
+            return [] if c == 0 else [-d / c]
+        disc = c * c - 4.0 * b * d
+        if (disc < 0):
+            return []
+        return [(-c + math.sqrt(disc)) / (2.0 * b), (-c - math.sqrt(disc)) / (2.0 * b)]
+    p = b / a
+    q = c / a
+    r = d / a
+    # depressed cubic t^3 + P * t + Q = 0 with x = t - p / 3
+    P = q - p * p / 3.0
+    Q = 2.0 * p * p * p / 27.0 - p * q / 3.0 + r
+    shift = -p / 3.0
+    disc = Q * Q / 4.0 + P * P * P / 27.0
+    if (disc > 0):
+        root = math.sqrt(disc)
+        return [cube_root(-Q / 2.0 + root) + cube_root(-Q / 2.0 - root) + shift]
+    if (P == 0):
+        return [shift]
+    m = 2.0 * math.sqrt(-P / 3.0)
+    theta = math.acos(max(-1.0, min(1.0, 3.0 * Q / (P * m)))) / 3.0
+    return [m * math.cos(theta - 2.0 * math.pi * k / 3.0) + shift for k in range(0, 3)]
+
+#*-------------------------------------------------------------------------------------------------
+# calculate the bike velocity without iterating when the wind is a pure head or tail wind.
+# With head_wind = v + a, where a is wind_mag for a head wind and -wind_mag for a tail wind,
+# the steady state equation  v * (K_A * head_wind * |head_wind| + other_resistance) = 0.95 * power
+# is a cubic on either side of head_wind = 0:
+#       head_wind >= 0:   K_A * v^3 + 2 K_A a v^2 + (K_A a^2 + other_resistance) v - 0.95 power = 0
+#       head_wind <  0:  -K_A * v^3 - 2 K_A a v^2 + (other_resistance - K_A a^2) v - 0.95 power = 0
+# The largest non-negative root consistent with its side is the velocity, the same root the
+# Newton iteration approaches from above, and nan when there is none. A cross wind falls back
+# to calc_velocity, which keeps returning 0.0 when it does not converge.
+#*-------------------------------------------------------------------------------------------------
+def calc_velocity_exact(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg = 0):
+    relative = (wind_deg - bike_deg) % 360
+    if (wind_mag != 0 and relative != 0 and relative != 180):
+        return calc_velocity(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg)
+    a = wind_mag if relative == 0 else -wind_mag
+    drive = 0.95 * power
+
+    candidates = [v for v in solve_cubic(K_A, 2 * K_A * a, K_A * a * a + other_resistance, -drive) \
+                  if v >= 0 and v + a >= 0]
+    if (a < 0):
+        candidates += [v for v in solve_cubic(-K_A, -2 * K_A * a, other_resistance - K_A * a * a, -drive) \
+                       if v >= 0 and v + a < 0]
+    if (drive == 0):
+        candidates.append(0.0)   # standing still, the rounded roots may be just below 0
+    if (not candidates):
+        return math.nan   # no physical velocity, as in calc_velocity_array
+
+    # polish the root with a Newton step on the residual to remove rounding in the formula
+    v = max(candidates)
+    head = v + a
+    f = v * (K_A * head * abs(head) + other_resistance) - drive
+    fprime = K_A * head * abs(head) + other_resistance + 2.0 * K_A * v * abs(head)
+    if (fprime > 0):
+        v = v - f / fprime
+    return v
+
+#*-------------------------------------------------------------------------------------------------
+# Batch version of calc_velocity. K_A, wind_mag, wind_deg, other_resistance, power and bike_deg
+# are numpy arrays (or scalars) broadcast against each other. All elements are iterated together
+# and an element is masked out once its Newton step is below the tolerance.
+#
+# The wind is split once into the components along and across the bike heading
+# (see calc_wind.get_wind_components), so that with v the bike velocity
+#       head_wind = v + wind_along,   W_A = head_wind^3 / |v_app|
+#       f  = v * (K_A * W_A + other_resistance) - 0.95 * power
+#       f' = K_A * W_A + other_resistance + v * K_A * dW_A/dv
+#       dW_A/dv = head_wind^2 * (2 * head_wind^2 + 3 * wind_across^2) / |v_app|^3
+#
+# The iteration starts from an upper bound of the velocity instead of a fixed 1000 m/s.
+# Returns the velocities in m/s, the number of iterations per element, and a converged flag.
+# Velocities of elements that did not converge are nan.
+#*-------------------------------------------------------------------------------------------------
+def calc_velocity_array(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg = 0, \
+                        max_iterations = 100, tolerance = 0.05):
+    start = instrumentation.start()
+    K_A, wind_mag, wind_deg, other_resistance, power, bike_deg = np.broadcast_arrays( \
+        *[np.asarray(x, dtype = np.float64) for x in (K_A, wind_mag, wind_deg, other_resistance, power, bike_deg)])
+    shape = K_A.shape
+    K_A = K_A.ravel()
+    other_resistance = other_resistance.ravel()
+    drive = 0.95 * power.ravel()
+    relative = np.radians(wind_deg.ravel() - bike_deg.ravel())
+    wind_along = wind_mag.ravel() * np.cos(relative)
+    wind_across2 = np.square(wind_mag.ravel() * np.sin(relative))
+
+    def residual(v, k_a, along, across2, res, drv):
+        head = v + along
+        app2 = head * head + across2
+        app = np.sqrt(app2)
+        safe = np.where(app > 0, app, 1.0)
+        W_A = np.where(app > 0, head * head * head / safe, 0.0)
+        dW_A = np.where(app > 0, head * head * (2.0 * head * head + 3.0 * across2) / (safe * safe * safe), 0.0)
+        f = v * (k_a * W_A + res) - drv
+        fprime = k_a * W_A + res + v * k_a * dW_A
+        return f, fprime
+
+    # start above the largest root: no drag from wind or resistance gives an upper bound of
+    # the still air velocity, push it out until the residual is positive
+    velocity = np.cbrt(np.maximum(drive, 0.0) / np.where(K_A > 0, K_A, 1.0)) + np.abs(wind_along) + 1.0
+    for _ in range(0, 64):
+        f = residual(velocity, K_A, wind_along, wind_across2, other_resistance, drive)[0]
+        low = f < 0
+        if (not low.any()):
+            break
+        velocity = np.where(low, 2.0 * velocity, velocity)
+
+    # the root is bracketed by [0, velocity] since f(0) = -0.95 * power, a Newton step that leaves
+    # the bracket (a strong tail wind makes f concave) is replaced by bisection
+    low_v = np.zeros(velocity.size)
+    high_v = velocity.copy()
+    iterations = np.zeros(velocity.size, dtype = np.int32)
+    converged = np.zeros(velocity.size, dtype = bool)
+    active = np.arange(velocity.size)
+    for _ in range(0, max_iterations):
+        if (active.size == 0):
+            break
+        v = velocity[active]
+        f, fprime = residual(v, K_A[active], wind_along[active], wind_across2[active], \
+                             other_resistance[active], drive[active])
+        low = np.where(f < 0, v, low_v[active])
+        high = np.where(f > 0, v, high_v[active])
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            new_v = v - f / fprime
+        outside = ~((new_v > low) & (new_v < high))
+        new_v = np.where(outside, 0.5 * (low + high), new_v)
+        low_v[active] = low
+        high_v[active] = high
+        velocity[active] = new_v
+        iterations[active] += 1
+        done = (np.abs(new_v - v) < tolerance) | (f == 0)
+        converged[active[done]] = True
+        active = active[~done]
+
+    velocity = np.where(converged, velocity, np.nan)
+    if (instrumentation.enabled and velocity.size > 0):
+        values, counts = np.unique(iterations, return_counts = True)
+        done = int(converged.sum())
+        instrumentation.record("calc_velocity_array", start, dict(zip(values.tolist(), counts.tolist())), \
+                               {"converged": done, "max_iterations": velocity.size - done}, velocity.size)
+    return velocity.reshape(shape), iterations.reshape(shape), converged.reshape(shape)
+
 #*--- MAIN SECTION
 def test_cases():
 
@@ -111,4 +275,73 @@ def test_cases():
     expected = 5
     assert abs(math.ceil(velocity) - expected) <= TOLERANCE, "6: Expected vel: " + str(expected) 
 
-test_cases()
\ No newline at end of file
+def test_arrays():
+    DENSITY = 1.293 - 0.00426 * 25
+    TOTAL_WT = 80 * 9.8
+    K_A = 0.5 * 0.388 * DENSITY
+    TOLERANCE = 0.1
+
+    # power x grade x wind grid against the scalar solver
+    power = np.array([50, 100, 200, 400, 600]).reshape(-1, 1, 1)
+    grade = np.array([-0.02, 0.0, 0.03, 0.07]).reshape(1, -1, 1)
+    wind = np.array([-5.0, 0.0, 2.8, 5.6]).reshape(1, 1, -1)
+    other_resistance = 0.005 * TOTAL_WT + grade * TOTAL_WT
+    velocity, iterations, converged = calc_velocity_array(K_A, np.abs(wind), np.where(wind < 0, 180, 0), \
+                                                          other_resistance, power)
+    assert velocity.shape == (5, 4, 4) and converged.all(), "1: Not converged " + str(converged)
+    assert iterations.max() < 20, "2: Too many iterations " + str(iterations.max())
+    for index in np.ndindex(velocity.shape):
+        w = wind[0, 0, index[2]]
+        expected = calc_velocity(K_A, abs(w), 180 if w < 0 else 0, other_resistance[0, index[1], 0], \
+                                 power[index[0], 0, 0])
+        if (expected == 0.0):   # the scalar solver did not converge
+            continue
+        assert abs(velocity[index] - expected) <= TOLERANCE, "3: Expected vel: " + str(expected) + " " + str(velocity[index])
+
+    # cross winds
+    for wind_deg in (30, 90, 135):
+        velocity = calc_velocity_array(K_A, 5.6, wind_deg, 0.005 * TOTAL_WT, [100, 200, 300])[0]
+        for i, p in enumerate([100, 200, 300]):
+            expected = calc_velocity(K_A, 5.6, wind_deg, 0.005 * TOTAL_WT, p)
+            assert abs(velocity[i] - expected) <= TOLERANCE, "4: Expected vel: " + str(expected) + " " + str(velocity[i])
+
+    # non-convergence is flagged, not returned as 0.0
+    velocity, iterations, converged = calc_velocity_array(K_A, 0, 0, 0.005 * TOTAL_WT, 200, max_iterations = 2)
+    assert not converged and np.isnan(velocity) and iterations == 2, "5: Expected non-convergence flag"
+
+def test_exact():
+    DENSITY = 1.293 - 0.00426 * 25
+    TOTAL_WT = 80 * 9.8
+    K_A = 0.5 * 0.388 * DENSITY
+    TOLERANCE = 1e-6
+
+    # roots of (x - 1)(x - 2)(x - 3) and x^3 - 8
+    roots = sorted(solve_cubic(1, -6, 11, -6))
+    assert all(abs(x - y) < TOLERANCE for x, y in zip(roots, [1, 2, 3])), "1: Expected roots 1, 2, 3 " + str(roots)
+    assert abs(solve_cubic(1, 0, 0, -8)[0] - 2) < TOLERANCE, "2: Expected root 2"
+
+    # head and tail winds, including winds above 28 m/s and tail winds faster than the bike
+    for power in (0, 50, 100, 200, 600):
+        for grade in (-0.05, 0.0, 0.03, 0.10):
+            for wind_mag in (0.0, 2.8, 5.6, 12.0, 30.0):
+                for wind_deg, bike_deg in ((0, 0), (180, 0), (270, 90), (45, 225)):
+                    other_resistance = 0.005 * TOTAL_WT + grade * TOTAL_WT
+                    v = calc_velocity_exact(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg)
+                    expected = calc_velocity_array(K_A, wind_mag, wind_deg, other_resistance, power, bike_deg, \
+                                                   tolerance = 1e-9)[0]
+                    assert abs(v - expected) < 1e-4, "3: Expected vel: " + str(expected) + " " + str(v)
+                    head = v + calc_wind.get_head_wind_array(0, wind_mag, wind_deg, bike_deg)
+                    f = v * (K_A * head * abs(head) + other_resistance) - 0.95 * power
+                    assert abs(f) < 1e-6, "4: Residual " + str(f)
+
+    # cross wind uses the Newton iteration
+    v = calc_velocity_exact(K_A, 5.6, 90, 0.005 * TOTAL_WT, 200)
+    assert v == calc_velocity(K_A, 5.6, 90, 0.005 * TOTAL_WT, 200), "5: Expected Newton velocity"
+
+    # no non-negative velocity for a negative power on the flat
+    assert math.isnan(calc_velocity_exact(K_A, 0, 0, 0.005 * TOTAL_WT, -50)), "6: Expected nan without a root"
+
+if __name__ == "__main__":
+    test_cases()
+    test_arrays()
+    test_exact()
\ No newline at end of file
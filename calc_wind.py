@@ -1,5 +1,8 @@
 import math
 import sys
+import common
+
+np = common.lazy_import("numpy")
 
 # Wind Calculator
 # Copyright (c) 2020 Manu Konchady
@@ -23,6 +26,7 @@ def flip_direction(angle):
 # get  the angle between two vectors in degress
 def get_angle(v1_x, v1_y, v2_x, v2_y):
     angle = math.degrees(math.atan2(v2_y, v2_x) - math.atan2(v1_y, v1_x))
+    angle = (angle + 180) % 360 - 180   # wrap to [-180, 180) so a bearing near north is not a head wind
     return round(angle)
 
 # get the dot product of two vectors
@@ -129,5 +133,74 @@ def test_cases():
     head_wind = get_head_wind(bike_mag, wind_mag, wind_deg, bike_deg)
     expected = -1.94
     assert abs(head_wind - expected) <= TOLERANCE, "4: Expected vel: " + str(expected) + " " + str(head_wind)
-        
-test_cases()
+
+#*---------------------------------------------------------------------------------------------
+#   Array versions of get_apparent, get_head_wind and get_head_wind2
+#   Accept numpy arrays (or anything np.asarray accepts) for the magnitudes and degrees,
+#   scalars are broadcast against the arrays.
+#
+#   The projection of the apparent wind on the bike heading reduces to
+#       head_wind = bike_mag + wind_mag * cos(wind_deg - bike_deg)
+#   and the cross component to wind_mag * sin(wind_deg - bike_deg), so a single cos / sin
+#   pair per point replaces the atan2 and angle rounding of the scalar functions.
+#   The head wind squared keeps the cos(angle) factor of get_head_wind2:
+#       W_a = head_wind * |head_wind| * |cos(angle)| = head_wind^3 / |v_app|
+#*---------------------------------------------------------------------------------------------
+def get_wind_components(bike_mag, wind_mag, wind_deg = 0, bike_deg = 0):
+    bike_mag = np.asarray(bike_mag, dtype = np.float64)
+    wind_mag = np.asarray(wind_mag, dtype = np.float64)
+    relative = np.radians(np.asarray(wind_deg, dtype = np.float64) - np.asarray(bike_deg, dtype = np.float64))
+
+    head_wind = bike_mag + wind_mag * np.cos(relative)
+    cross_wind = wind_mag * np.sin(relative)
+    apparent_mag = np.hypot(head_wind, cross_wind)
+
+    # head_wind is zero whenever the apparent magnitude is zero
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        head_wind2 = np.where(apparent_mag > 0, head_wind * head_wind * head_wind / apparent_mag, 0.0)
+    direction = np.sign(head_wind).astype(np.int8)   # 1: head wind, -1: tail wind, 0: cross wind
+    return head_wind, head_wind2, direction
+
+def get_apparent_array(wind_mag, wind_deg, bike_mag, bike_deg):
+    wind_rad = np.radians(flip_direction(np.asarray(wind_deg, dtype = np.float64)))
+    bike_rad = np.radians(flip_direction(np.asarray(bike_deg, dtype = np.float64)))
+    apparent_x = wind_mag * np.cos(wind_rad) + bike_mag * np.cos(bike_rad)
+    apparent_y = wind_mag * np.sin(wind_rad) + bike_mag * np.sin(bike_rad)
+    direction = get_wind_components(bike_mag, wind_mag, wind_deg, bike_deg)[2]
+    return apparent_x, apparent_y, direction
+
+def get_head_wind_array(bike_mag, wind_mag, wind_deg = 0, bike_deg = 0):
+    return get_wind_components(bike_mag, wind_mag, wind_deg, bike_deg)[0]
+
+def get_head_wind2_array(bike_mag, wind_mag, wind_deg = 0, bike_deg = 0):
+    return get_wind_components(bike_mag, wind_mag, wind_deg, bike_deg)[1]
+
+def test_arrays():
+    TOLERANCE = 0.5
+    bike_mag = np.array([6, 6, 6, 6, 0.5, 12])
+    wind_mag = np.array([8, 8, 8, 8, 0, 3])
+    wind_deg = np.array([0, 180, 220, 10, 45, 350])
+    bike_deg = np.array([0, 0, 170, 190, 45, 10])
+    expected = np.array([14, -2, 11.14, -1.94, 0.5, 14.82])
+    head_wind, head_wind2, direction = get_wind_components(bike_mag, wind_mag, wind_deg, bike_deg)
+    assert np.all(np.abs(head_wind - expected) <= TOLERANCE), "1: Expected vel: " + str(expected) + " " + str(head_wind)
+    assert np.array_equal(direction, [1, -1, 1, -1, 1, 1]), "2: Expected direction " + str(direction)
+
+    # compare against the scalar functions away from a pure cross wind, where they round the angle
+    for i in range(0, 360, 15):
+        for j in range(0, 360, 45):
+            scalar = get_head_wind(6, 8, i, j)
+            scalar2 = get_head_wind2(6, 8, i, j)
+            if (abs(scalar) < 0.5):
+                continue
+            assert abs(get_head_wind_array(6, 8, i, j) - scalar) <= 1e-6, "3: Head wind " + str(i) + " " + str(j)
+            assert abs(get_head_wind2_array(6, 8, i, j) - scalar2) <= 0.02 * abs(scalar2) + TOLERANCE, \
+                   "4: Head wind2 " + str(i) + " " + str(j)
+            apparent = get_apparent(8, i, 6, j)
+            apparent_array = get_apparent_array(8, i, 6, j)
+            assert abs(apparent_array[0] - apparent[0]) <= 1e-6 and abs(apparent_array[1] - apparent[1]) <= 1e-6, \
+                   "5: Apparent " + str(i) + " " + str(j)
+
+if __name__ == "__main__":
+    test_cases()
+    test_arrays()
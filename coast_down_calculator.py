@@ -6,7 +6,11 @@
 #
 # Fixed parameters
 #
+import statistics
 import sys
+import common
+
+np = common.lazy_import("numpy")
 
 M = 85.0 # kgs.
 g = 9.81
@@ -35,13 +39,248 @@ def get_time(c_r):
             return time
     return -1
 
+#*-----------------------------------------------------------------------------------------------
+#*- Least squares fit of recorded coast downs
+#*-
+#*- With the air speed u = v + wind, a coasting bike on the flat follows
+#*-     M du/dt = -(K_A * u * |u| + M * g * c_r)
+#*- which has the closed form, with a = g * c_r, b = K_A / M, s = sqrt(a * b), r = sqrt(a / b),
+#*-     u(t) = r * tan(atan(u0 / r) - s * t)         until u reaches 0 at T0 = atan(u0 / r) / s
+#*-     u(t) = -r * tanh(s * (t - T0))                after, when a tail wind pushes the bike
+#*- and from a negative u0 = -w0, u(t) = -r * tanh(s * t + atanh(w0 / r)), or coth when w0 > r.
+#*- c_r, K_A and the wind are shared by the traces of a fit, and each trace has its own initial
+#*- velocity. All fits of a batch are solved together with Levenberg-Marquardt steps.
+#*-----------------------------------------------------------------------------------------------
+C_R = 0     # parameter columns, followed by the initial velocity of each trace
+K_A_COLUMN = 1
+WIND = 2
+SHARED = 3
+
+#*-- velocity in m/s after t seconds of coasting from v0 m/s, the arguments are broadcast
+def coast_velocity(t, v0, c_r, K_A, wind = 0.0, mass = M):
+    a = g * np.maximum(c_r, 1e-12)
+    b = np.maximum(K_A, 1e-12) / mass
+    s = np.sqrt(a * b)
+    r = np.sqrt(a / b)
+    u0 = v0 + wind
+    phase = np.arctan(np.maximum(u0, 0.0) / r)
+    t_zero = phase / s
+    # a tail wind faster than the bike from the start pushes the air speed towards -r, from
+    # above with tanh or from below with coth
+    w0 = np.maximum(-u0, 0.0)
+    with np.errstate(over = 'ignore', invalid = 'ignore', divide = 'ignore'):
+        tail = np.where(w0 < r, -r * np.tanh(s * (t - t_zero) + np.arctanh(np.minimum(w0 / r, 1.0))), \
+                        -r / np.tanh(s * t + np.arctanh(np.minimum(r / np.maximum(w0, r), 1.0))))
+        u = np.where(t < t_zero, r * np.tan(phase - s * np.minimum(t, t_zero)), tail)
+    return u - wind
+
+#*-- pad a list of traces (times, speeds) of one fit, or a list of such lists, with nan
+def pad_traces(traces):
+    nested = not (len(traces) > 0 and np.ndim(traces[0][0]) == 1)
+    fits = traces if nested else [traces]
+    n_traces = max(len(fit) for fit in fits)
+    n_samples = max(len(times) for fit in fits for times, _ in fit)
+    times = np.full((len(fits), n_traces, n_samples), np.nan)
+    speeds = np.full((len(fits), n_traces, n_samples), np.nan)
+    for i, fit in enumerate(fits):
+        for j, (t, v) in enumerate(fit):
+            times[i, j, :len(t)] = t
+            speeds[i, j, :len(v)] = v
+    return (times, speeds) if nested else (times[0], speeds[0])
+
+#*-----------------------------------------------------------------------------------------------
+#*- Results of fit_coast_down, c_r, K_A and wind have one value per fit and v0 one per trace.
+#*- The intervals are (low, high) at the confidence of the fit from a normal approximation of
+#*- the parameter errors, with the covariance sigma^2 (J'J)^-1 at the solution.
+#*-----------------------------------------------------------------------------------------------
+class CoastDownFit:
+
+    def __init__(self, params, covariance, rms, samples, iterations, converged, fit_wind, confidence):
+        self.c_r = params[..., C_R]
+        self.K_A = params[..., K_A_COLUMN]
+        self.wind = params[..., WIND]
+        self.v0 = params[..., SHARED:]
+        self.covariance = covariance
+        self.rms = rms
+        self.samples = samples
+        self.iterations = iterations
+        self.converged = converged
+        self.fit_wind = fit_wind
+        self.confidence = confidence
+        error = np.sqrt(np.maximum(np.diagonal(covariance, axis1 = -2, axis2 = -1), 0.0))
+        self.c_r_error = error[..., C_R]
+        self.K_A_error = error[..., K_A_COLUMN]
+        self.wind_error = error[..., WIND] if fit_wind else np.zeros_like(self.wind)
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2.0)
+        self.c_r_interval = (self.c_r - z * self.c_r_error, self.c_r + z * self.c_r_error)
+        self.K_A_interval = (self.K_A - z * self.K_A_error, self.K_A + z * self.K_A_error)
+        self.wind_interval = (self.wind - z * self.wind_error, self.wind + z * self.wind_error)
+
+#*-----------------------------------------------------------------------------------------------
+#*- Fit c_r, K_A and optionally a head wind (m/s) to coast down traces. times (s) and speeds (m/s)
+#*- are arrays of shape (samples,) for one trace, (traces, samples) for traces fit together, or
+#*- (fits, traces, samples) for a batch of independent fits, padded with nan (see pad_traces).
+#*- Without fit_wind the wind is held at the given value.
+#*-----------------------------------------------------------------------------------------------
+def fit_coast_down(times, speeds, mass = M, fit_wind = False, wind = 0.0, confidence = 0.95, \
+                   max_iterations = 100, tolerance = 1e-10):
+    times = np.asarray(times, dtype = np.float64)
+    speeds = np.asarray(speeds, dtype = np.float64)
+    shape = times.shape[:-2] if times.ndim > 1 else ()
+    times = times.reshape((-1,) + (times.shape[-2:] if times.ndim > 1 else (1,) + times.shape))
+    speeds = speeds.reshape(times.shape)
+    n_fits, n_traces, _ = times.shape
+
+    # times from the first sample of each trace, missing samples have no weight
+    valid = np.isfinite(times) & np.isfinite(speeds)
+    start = np.nanmin(np.where(valid, times, np.nan), axis = -1, keepdims = True)
+    t = np.where(valid, times - np.nan_to_num(start), 0.0)
+    v = np.where(valid, speeds, 0.0)
+    has_trace = valid.any(axis = -1)
+    first = np.take_along_axis(v, np.argmax(valid, axis = -1)[..., None], axis = -1)[..., 0]
+
+    n_params = SHARED + n_traces
+    free = np.zeros((n_fits, n_params), dtype = bool)
+    free[:, C_R] = free[:, K_A_COLUMN] = True
+    free[:, WIND] = fit_wind
+    free[:, SHARED:] = has_trace
+    params = np.zeros((n_fits, n_params))
+    params[:, C_R] = 0.005
+    params[:, K_A_COLUMN] = 0.3
+    params[:, WIND] = wind
+    params[:, SHARED:] = first
+    scale = np.array([0.001, 0.01, 0.1] + [0.1] * n_traces)  # smallest parameter changes of interest
+
+    def residuals(p):
+        model = coast_velocity(t, p[:, SHARED:, None], p[:, C_R, None, None], p[:, K_A_COLUMN, None, None], \
+                               p[:, WIND, None, None], mass)
+        return np.where(valid, model - v, 0.0).reshape(n_fits, -1)
+
+    # central differences, the initial velocity of a trace moves only that trace so all of them
+    # are stepped together
+    def jacobian(p):
+        columns = []
+        for k in range(0, SHARED):
+            h = 1e-6 * np.maximum(np.abs(p[:, k]), scale[k])
+            step = np.zeros_like(p)
+            step[:, k] = h
+            columns.append((residuals(p + step) - residuals(p - step)) / (2.0 * h[:, None]))
+        h = 1e-6 * np.maximum(np.abs(p[:, SHARED:]), 0.1)
+        step = np.zeros_like(p)
+        step[:, SHARED:] = h
+        derivative = (residuals(p + step) - residuals(p - step)).reshape(t.shape) / (2.0 * h[..., None])
+        trace = np.eye(n_traces)[:, None, :] * derivative[..., None]
+        J = np.concatenate([np.stack(columns, axis = -1), trace.reshape(n_fits, -1, n_traces)], axis = -1)
+        return np.where(free[:, None, :], J, 0.0)
+
+    r = residuals(params)
+    cost = np.sum(r * r, axis = -1)
+    damping = np.full(n_fits, 1e-3)
+    iterations = np.zeros(n_fits, dtype = np.int32)
+    converged = np.zeros(n_fits, dtype = bool)
+    fixed = np.eye(n_params) * ~free[:, None, :]
+    for _ in range(0, max_iterations):
+        active = ~converged
+        if (not active.any()):
+            break
+        J = jacobian(params)
+        JTJ = np.einsum('fsi,fsj->fij', J, J)
+        gradient = np.einsum('fsi,fs->fi', J, r)
+        diagonal = np.diagonal(JTJ, axis1 = 1, axis2 = 2)
+        system = JTJ + damping[:, None, None] * diagonal[:, :, None] * np.eye(n_params) + fixed
+        delta = -np.linalg.solve(system, gradient[..., None])[..., 0] * active[:, None]
+        trial = params + delta
+        trial[:, C_R] = np.maximum(trial[:, C_R], 1e-9)
+        trial[:, K_A_COLUMN] = np.maximum(trial[:, K_A_COLUMN], 1e-9)
+        trial_r = residuals(trial)
+        trial_cost = np.sum(trial_r * trial_r, axis = -1)
+
+        better = active & (trial_cost <= cost)
+        converged |= better & (cost - trial_cost <= tolerance * np.maximum(cost, 1e-30))
+        converged |= active & (np.max(np.abs(delta) / scale, axis = -1) < 1e-9)
+        params = np.where(better[:, None], trial, params)
+        r = np.where(better[:, None], trial_r, r)
+        cost = np.where(better, trial_cost, cost)
+        damping = np.where(better, damping / 10.0, damping * 10.0)
+        iterations += active
+
+    # covariance of the free parameters at the solution
+    J = jacobian(params)
+    JTJ = np.einsum('fsi,fsj->fij', J, J)
+    samples = valid.reshape(n_fits, -1).sum(axis = -1)
+    dof = np.maximum(samples - free.sum(axis = -1), 1)
+    sigma2 = cost / dof
+    covariance = np.linalg.inv(JTJ + fixed) * sigma2[:, None, None] * (free[:, :, None] & free[:, None, :])
+    rms = np.sqrt(cost / np.maximum(samples, 1))
+
+    params = params.reshape(shape + (n_params,))
+    covariance = covariance.reshape(shape + (n_params, n_params))
+    return CoastDownFit(params, covariance, rms.reshape(shape), samples.reshape(shape), \
+                        iterations.reshape(shape), converged.reshape(shape), fit_wind, confidence)
+
+def test_fit():
+    rng = np.random.default_rng(8)
+    t = np.arange(0, 40, 0.5)
+
+    # a single trace, exact data
+    v = coast_velocity(t, 9.0, 0.006, 0.25)
+    fit = fit_coast_down(t, v)
+    assert fit.converged and abs(fit.c_r - 0.006) < 1e-6 and abs(fit.K_A - 0.25) < 1e-5, \
+           "1: Expected c_r and K_A " + str((fit.c_r, fit.K_A))
+    assert fit.v0.shape == (1,) and abs(fit.v0[0] - 9.0) < 1e-6, "2: Expected v0 " + str(fit.v0)
+
+    # the closed form against the Euler steps of get_time
+    euler = V_INITIAL
+    for _ in range(0, 100):
+        euler -= 0.01 * (K_A * (euler + V_HEAD) ** 2 + M * g * 0.005) / M
+    assert abs(coast_velocity(1.0, V_INITIAL, 0.005, K_A, V_HEAD) - euler) < 1e-3, "3: Expected Euler velocity"
+
+    # a tail wind faster than the bike, above and below the terminal air speed
+    for v0, wind in ((3.0, -4.0), (3.0, -9.0)):
+        euler = v0
+        for _ in range(0, 1000):
+            u = euler + wind
+            euler -= 0.001 * (K_A * u * abs(u) + M * g * 0.005) / M
+        velocity = coast_velocity(np.array([0.0, 1.0]), v0, 0.005, K_A, wind)
+        assert abs(velocity[0] - v0) < 1e-12 and abs(velocity[1] - euler) < 1e-3, "4: Expected tail wind " + str(wind)
+
+    # noisy traces from several speeds fit together with a head wind, within the intervals
+    traces = []
+    for v0 in (6.0, 8.0, 10.0, 12.0):
+        length = rng.integers(50, 80)
+        speed = coast_velocity(t[:length], v0, 0.005, 0.3, 1.2) + rng.normal(0, 0.02, length)
+        traces.append((t[:length] + 100.0, speed))
+    times, speeds = pad_traces(traces)
+    fit = fit_coast_down(times, speeds, fit_wind = True)
+    assert fit.converged, "5: Expected convergence"
+    for value, interval, expected in ((fit.c_r, fit.c_r_interval, 0.005), (fit.K_A, fit.K_A_interval, 0.3), \
+                                      (fit.wind, fit.wind_interval, 1.2)):
+        assert interval[0] < expected < interval[1], "6: " + str(expected) + " outside " + str(interval)
+    assert abs(fit.rms - 0.02) < 0.005, "7: Expected rms of the noise " + str(fit.rms)
+
+    # a batch of sessions, each fit on its own, matches fitting them one at a time
+    sessions = []
+    for c_r, K_A_true in ((0.004, 0.2), (0.008, 0.35), (0.006, 0.3)):
+        sessions.append([(t, coast_velocity(t, v0, c_r, K_A_true) + rng.normal(0, 0.02, t.size)) \
+                         for v0 in rng.uniform(6, 12, 3)])
+    times, speeds = pad_traces(sessions)
+    batch = fit_coast_down(times, speeds)
+    assert batch.c_r.shape == (3,) and batch.v0.shape == (3, 3) and batch.converged.all(), "8: Batch shape"
+    for i, session in enumerate(sessions):
+        single = fit_coast_down(*pad_traces(session))
+        assert abs(single.c_r - batch.c_r[i]) < 1e-8 and abs(single.K_A - batch.K_A[i]) < 1e-6, "9: Batch fit"
+        assert batch.c_r_interval[0][i] < batch.c_r[i] < batch.c_r_interval[1][i], "10: Interval"
+
 # Main section
-# Try a range of values for c_r
-# If none found, return a message
-for i in range (15):
-    c_r = i / 1000.0
-    estimated_time = get_time(c_r)
-    if abs(estimated_time - DURATION) < 1.0:
-        print ("Best c_r = " + str(c_r))
-        sys.exit()
-print ("Could not find a c_r")
+if __name__ == "__main__":
+    test_fit()
+
+    # Try a range of values for c_r
+    # If none found, return a message
+    for i in range (15):
+        c_r = i / 1000.0
+        estimated_time = get_time(c_r)
+        if abs(estimated_time - DURATION) < 1.0:
+            print ("Best c_r = " + str(c_r))
+            sys.exit()
+    print ("Could not find a c_r")
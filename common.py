@@ -1,5 +1,21 @@
 # common functions
 #
+import importlib.util
+import sys
+
+#*-- import a module on its first attribute access, for dependencies like numpy that only
+#*-- the array functions need, so that importing a calculator stays fast
+def lazy_import(name):
+    if (name in sys.modules):
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
 #*-- convert to meter per second from kmph
 def meter_per_second(kmph):
     return (kmph * 0.2777777777777777778)
@@ -0,0 +1,102 @@
+#
+# Performance and Physics of Bicycles
+# Copyright (c) 2020 Manu Konchady
+#
+# Single entry point to the calculators. The calculator modules are imported on their first use:
+#
+#   import cycle
+#   cycle.calc_velocity.calc_velocity(...)
+#
+# Run the test functions of every calculator with
+#
+#   python cycle.py selftest
+#
+import importlib
+import os
+import subprocess
+import sys
+import time
+
+MODULES = ("common", "instrumentation", "calc_wind", "calc_power", "calc_velocity", "calc_air_density", "atmosphere", \
+           "altitude_estimator", "calc_stopping_distance", "moments", "velocity_table", "ride_stream", "ride_archive", \
+           "virtual_elevation", "calc_spoke_length", "coast_down_calculator", "benchmark", "power_server", \
+           "route_simulator", "pacing", "wind_field", "stopping_monte_carlo")
+
+# cpu seconds to import the scalar calculators in a fresh interpreter, the best of IMPORT_RUNS.
+# The import takes 0.05-0.07 s, numpy alone would add about 0.1 s. The cpu
+# time of the interpreter is not stretched by other busy processes the way the wall time is.
+IMPORT_BUDGET = 0.1
+IMPORT_RUNS = 3
+
+#*-- import a calculator module on first access
+def __getattr__(name):
+    if (name in MODULES):
+        module = importlib.import_module(name)
+        globals()[name] = module
+        return module
+    raise AttributeError("module 'cycle' has no attribute " + repr(name))
+
+def __dir__():
+    return sorted(list(globals()) + list(MODULES))
+
+#*-- return the test functions of a module in the order they are defined
+def get_tests(module):
+    return [value for name, value in vars(module).items() \
+            if name.startswith("test") and callable(value) and getattr(value, "__module__", None) == module.__name__]
+
+#*----------------------------------------------------------------------------
+#*- run the test functions of the modules, print a line per test and return
+#*- the number of failures
+#*----------------------------------------------------------------------------
+def selftest(modules = MODULES + ("cycle",)):
+    failures = 0
+    for name in modules:
+        module = sys.modules[__name__] if name == "cycle" else importlib.import_module(name)
+        for test in get_tests(module):
+            start = time.perf_counter()
+            try:
+                test()
+                result = "ok"
+            except Exception as error:
+                failures += 1
+                result = "FAILED " + type(error).__name__ + ": " + str(error)
+            print (name + "." + test.__name__ + " " + "{:.3f}".format(time.perf_counter() - start) + "s " + result)
+    return failures
+
+#*-- measure the cpu time to import the scalar calculators in a new interpreter, the best of runs
+def get_import_time(runs = 1):
+    # numpy is only loaded when one of its submodules is
+    code = "import time, sys\n" \
+           "start = time.process_time()\n" \
+           "import cycle, calc_wind, calc_power, calc_velocity, calc_air_density, calc_stopping_distance, moments, " \
+           "altitude_estimator\n" \
+           "print(time.process_time() - start, any(name.startswith('numpy.') for name in sys.modules))\n"
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    numpy_loaded = False
+    for _ in range(0, runs):
+        elapsed, loaded = subprocess.check_output([sys.executable, "-c", code], env = env).split()
+        times.append(float(elapsed))
+        numpy_loaded |= loaded == b"True"
+    return min(times), numpy_loaded
+
+def test_import_time():
+    elapsed, numpy_loaded = get_import_time(IMPORT_RUNS)
+    assert not numpy_loaded, "1: numpy was loaded on import"
+    assert elapsed < IMPORT_BUDGET, "2: Import took " + str(elapsed) + "s, budget " + str(IMPORT_BUDGET) + "s"
+
+def test_lazy():
+    module = importlib.import_module("cycle")
+    assert callable(module.calc_wind.get_head_wind), "1: Expected calc_wind"
+    try:
+        module.no_such_module
+        assert False, "2: Expected AttributeError"
+    except AttributeError:
+        pass
+
+if __name__ == "__main__":
+    if (sys.argv[1:] != ["selftest"]):
+        print ("usage: python cycle.py selftest")
+        sys.exit(2)
+    sys.exit(1 if selftest() else 0)
@@ -0,0 +1,175 @@
+#
+# Solver instrumentation
+# Copyright (c) 2020 Manu Konchady
+#
+# The iterative solvers (calc_velocity, calc_dist, dist4, get_trajectory) record the work of
+# each call: Newton iterations or integration steps, the reason they stopped and the wall
+# time. Recording is off by default and costs one check of instrumentation.enabled per call.
+#
+#   import instrumentation
+#   instrumentation.enable()         # or set CYCLE_INSTRUMENT=1 before the first import
+#   ...
+#   instrumentation.snapshot()       # dict per solver
+#   instrumentation.to_prometheus()  # text exposition format for a local scrape
+#
+import bisect
+import os
+import threading
+import time
+
+enabled = os.environ.get("CYCLE_INSTRUMENT", "") not in ("", "0")
+
+# upper bounds of the histogram buckets, the last bucket is +Inf
+WORK_BUCKETS = (1, 2, 3, 4, 5, 7, 10, 15, 20, 30, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+TIME_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 0.01, 0.1, 1.0)
+
+class Histogram:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count = 1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    # cumulative counts per upper bound, as in the Prometheus buckets
+    def cumulative(self):
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def to_dict(self):
+        return dict(buckets = [(str(bound), count) for bound, count in self.cumulative()], sum = self.sum, \
+                    count = self.count)
+
+class SolverMetrics:
+
+    def __init__(self):
+        self.calls = 0
+        self.reasons = {}
+        self.work = Histogram(WORK_BUCKETS)
+        self.seconds = Histogram(TIME_BUCKETS)
+
+metrics = {}
+lock = threading.Lock()
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        metrics.clear()
+
+def start():
+    return time.perf_counter() if enabled else 0.0
+
+#*------------------------------------------------------------------------------
+#*- record a call of solver that began at start (time.perf_counter) and did work
+#*- iterations or steps, stopping for reason. count calls of an array solver
+#*- are recorded at once, work is then a dict of work -> number of elements.
+#*------------------------------------------------------------------------------
+def record(solver, start, work, reason, count = 1):
+    elapsed = time.perf_counter() - start
+    with lock:
+        solver_metrics = metrics.get(solver)
+        if (solver_metrics is None):
+            solver_metrics = metrics[solver] = SolverMetrics()
+        solver_metrics.calls += count
+        solver_metrics.seconds.observe(elapsed / count, count)
+        if (isinstance(work, dict)):
+            for value, elements in work.items():
+                solver_metrics.work.observe(value, elements)
+        else:
+            solver_metrics.work.observe(work, count)
+        if (isinstance(reason, dict)):
+            for name, elements in reason.items():
+                solver_metrics.reasons[name] = solver_metrics.reasons.get(name, 0) + elements
+        else:
+            solver_metrics.reasons[reason] = solver_metrics.reasons.get(reason, 0) + count
+
+def snapshot():
+    with lock:
+        return dict((solver, dict(calls = m.calls, reasons = dict(m.reasons), work = m.work.to_dict(), \
+                                  seconds = m.seconds.to_dict())) for solver, m in metrics.items())
+
+#*-- the metrics in the Prometheus text exposition format
+def to_prometheus(prefix = "cycle_solver"):
+    lines = []
+    with lock:
+        solvers = sorted(metrics.items())
+        lines.append("# HELP " + prefix + "_calls_total Solver calls by exit reason.")
+        lines.append("# TYPE " + prefix + "_calls_total counter")
+        for solver, m in solvers:
+            for reason, count in sorted(m.reasons.items()):
+                lines.append('%s_calls_total{solver="%s",reason="%s"} %d' % (prefix, solver, reason, count))
+        for name, help_text, attribute in (("work", "Newton iterations or integration steps per call.", "work"), \
+                                           ("seconds", "Wall time per call.", "seconds")):
+            lines.append("# HELP " + prefix + "_" + name + " " + help_text)
+            lines.append("# TYPE " + prefix + "_" + name + " histogram")
+            for solver, m in solvers:
+                histogram = getattr(m, attribute)
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_%s_bucket{solver="%s",le="%s"} %d' % (prefix, name, solver, bound, count))
+                lines.append('%s_%s_sum{solver="%s"} %r' % (prefix, name, solver, histogram.sum))
+                lines.append('%s_%s_count{solver="%s"} %d' % (prefix, name, solver, histogram.count))
+    return "\n".join(lines) + "\n"
+
+def test_instrumentation():
+    # the module the solvers record to, which is not __main__ when run as a script
+    import calc_stopping_distance
+    import calc_velocity
+    import instrumentation
+
+    was_enabled = instrumentation.enabled
+    instrumentation.disable()
+    instrumentation.reset()
+    calc_velocity.calc_velocity(0.2, 0, 0, 4, 200)
+    assert instrumentation.snapshot() == {}, "1: Expected nothing recorded while disabled"
+
+    instrumentation.enable()
+    try:
+        K_A = 0.5 * 0.388 * (1.293 - 0.00426 * 25)
+        TOTAL_WT = 80 * 9.8
+        calc_velocity.calc_velocity(K_A, 0, 0, 4, 200)
+        # a tail wind up a steep grade does not converge
+        assert calc_velocity.calc_velocity(K_A, 5.0, 180, 0.075 * TOTAL_WT, 50) == 0.0, "2: Expected no convergence"
+        calc_velocity.calc_velocity_array(K_A, [0, 3, 5], 0, 4, [100, 200, 300])
+        calc_stopping_distance.dist1(40, 0, 0, 0.5, False)
+        calc_stopping_distance.dist1(40, 0, 0, 0.5, False, method = calc_stopping_distance.RK45)
+        calc_stopping_distance.dist1(40, 0, -60, 0.1, False)  # downhill, the drag forces turn negative
+        calc_stopping_distance.dist4(40, 0, 0, 0.5, False, 0.7)
+        values = instrumentation.snapshot()
+        velocity = values["calc_velocity"]
+        assert velocity["calls"] == 2 and velocity["reasons"] == {"converged": 1, "max_iterations": 1}, \
+               "3: calc_velocity " + str(velocity["reasons"])
+        assert velocity["work"]["count"] == 2 and velocity["work"]["sum"] > 100, "4: Expected iterations"
+        assert values["calc_velocity_array"]["calls"] == 3, "5: Expected 3 elements"
+        assert values["calc_dist.euler"]["reasons"] == {"stopped": 1, "negative_drag": 1}, "6: " + \
+               str(values["calc_dist.euler"]["reasons"])
+        assert values["calc_dist.euler"]["work"]["sum"] > 20, "7: Expected Euler steps"
+        assert values["get_trajectory"]["reasons"] == {"stopped": 1}, "8: Expected an RK45 trajectory"
+        assert values["dist4"]["calls"] == 1, "9: Expected dist4"
+
+        text = instrumentation.to_prometheus()
+        assert 'cycle_solver_calls_total{solver="calc_velocity",reason="max_iterations"} 1' in text, "10: Text"
+        assert 'cycle_solver_work_bucket{solver="calc_velocity",le="+Inf"} 2' in text, "11: Buckets"
+        assert 'cycle_solver_seconds_count{solver="dist4"} 1' in text, "12: Seconds"
+    finally:
+        instrumentation.reset()
+        if (not was_enabled):
+            instrumentation.disable()
+
+if __name__ == "__main__":
+    test_instrumentation()
@@ -5,6 +5,10 @@
 #
 #  Bicycle front wheel to the left and rear wheel to the right
 #
+import common
+
+np = common.lazy_import("numpy")
+
 g = 9.81    # meters per second
 
 #*-----------------------------------------------------------------
@@ -128,3 +132,66 @@ def get_max_front_g (wheel_base, rear_crank_distance, com_height, mass, mu):
         #print (f_nf, mg, clock_wise_torque, anti_clock_wise_torque)
         return (mu * f_nf / mg)
 
+#*------------------------------------------------------------------------
+#*-  Exact versions of the functions above that accept numpy arrays (or
+#*-  scalars) of wheel base, rear crank distance, com height and mu.
+#*-  All distances in meters.
+#*-
+#*-  The rear normal force of get_normal_forces_1/2/3 is
+#*-       f_nr = mg * (wheel_base - rear_crank_distance - brake_g * com_height) / wheel_base
+#*-  so the rear wheel looses contact at brake_g = (wheel_base - rear_crank_distance) / com_height
+#*-  for any mass, while get_critical_g_* scan brake_g in steps of 0.01 up to 0.99.
+#*------------------------------------------------------------------------
+def get_critical_g_array(wheel_base, rear_crank_distance, com_height):
+    wheel_base = np.asarray(wheel_base, dtype = np.float64)
+    rear_crank_distance = np.asarray(rear_crank_distance, dtype = np.float64)
+    com_height = np.asarray(com_height, dtype = np.float64)
+    return (wheel_base - rear_crank_distance) / com_height
+
+#*------------------------------------------------------------------------
+#*-  max. g from the rear brake alone and from the front brake alone
+#*-  a front brake with mu * com_height >= wheel_base never slips, the rear
+#*-  wheel lifts first and the max. g is nan
+#*------------------------------------------------------------------------
+def get_max_rear_g_array(wheel_base, rear_crank_distance, com_height, mu):
+    wheel_base = np.asarray(wheel_base, dtype = np.float64)
+    return mu * (wheel_base - rear_crank_distance) / (wheel_base + mu * np.asarray(com_height, dtype = np.float64))
+
+def get_max_front_g_array(wheel_base, rear_crank_distance, com_height, mu):
+    denom = np.asarray(wheel_base, dtype = np.float64) - mu * np.asarray(com_height, dtype = np.float64)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(denom > 0, mu * np.asarray(rear_crank_distance, dtype = np.float64) / denom, np.nan)
+
+def test_critical_g():
+    TOLERANCE = 1e-9
+    mass = 80
+    wheel_base = np.array([1.01, 0.98, 1.05, 1.2])
+    rear_crank_distance = np.array([0.43, 0.40, 0.45, 0.5])
+    com_height = np.array([1.15, 1.05, 1.2, 0.9])
+    critical = get_critical_g_array(wheel_base, rear_crank_distance, com_height)
+
+    for i in range(0, wheel_base.size):
+        # the rear normal force vanishes at the critical g for all three moment points
+        for normal_forces in (get_normal_forces_1, get_normal_forces_2, get_normal_forces_3):
+            f_nf, f_nr = normal_forces(wheel_base[i], rear_crank_distance[i], com_height[i], mass, critical[i])
+            assert abs(f_nr) < TOLERANCE, "1: Expected zero rear normal force " + str(f_nr)
+        # the scan finds the next 0.01 step above the critical g
+        for critical_g in (get_critical_g_1, get_critical_g_2, get_critical_g_3):
+            scan = critical_g(wheel_base[i], rear_crank_distance[i], com_height[i], mass)
+            assert 0 < scan - critical[i] <= 0.01 + TOLERANCE, "2: Expected " + str(critical[i]) + " " + str(scan)
+
+        for mu in (0.35, 0.7):
+            rear = get_max_rear_g(wheel_base[i], rear_crank_distance[i], com_height[i], mass, mu)
+            front = get_max_front_g(wheel_base[i], rear_crank_distance[i], com_height[i], mass, mu)
+            assert abs(get_max_rear_g_array(wheel_base, rear_crank_distance, com_height, mu)[i] - rear) < TOLERANCE, \
+                   "3: Expected rear g " + str(rear)
+            assert abs(get_max_front_g_array(wheel_base, rear_crank_distance, com_height, mu)[i] - front) < TOLERANCE, \
+                   "4: Expected front g " + str(front)
+
+    # a catalog of geometries broadcast against rider positions
+    com_height = np.linspace(0.9, 1.3, 5).reshape(-1, 1)
+    assert get_critical_g_array(wheel_base, rear_crank_distance, com_height).shape == (5, 4), "5: Expected (5, 4)"
+    assert np.isnan(get_max_front_g_array(1.0, 0.4, 1.2, 1.0)), "6: Expected nan"
+
+if __name__ == "__main__":
+    test_critical_g()
@@ -0,0 +1,261 @@
+#
+# Pacing optimizer
+# Copyright (c) 2020 Manu Konchady
+#
+# The power per segment of a route (route_simulator.Route) that minimizes the total time at
+# steady speeds, under a budget on the time weighted average power or on the normalized power
+# (the 4th power mean of the segment powers, the segments being longer than the 30 s rolling
+# average of the usual definition).
+#
+# The power of a segment is explicit in its speed, as in calc_power,
+#       P(v) = v * (K_A * W_A(v) + other_resistance) / 0.95
+# so the sensitivities are analytic: with t = length / v,
+#       dt/dP = -length / (v^2 * dP/dv)
+# With the budget as the constraint  G = sum of t * (P^k - B^k) <= 0  (k = 1 for the average,
+# 4 for the normalized power), the Lagrangian  sum of t * (1 + lambda * (P^k - B^k))  is separable
+# and each segment is stationary where
+#       h(v) = lambda * k * P^(k - 1) * v * dP/dv - 1 - lambda * (P^k - B^k) = 0
+# solved for all segments at once by safeguarded Newton steps between the speeds at the power
+# limits. The multiplier lambda is bisected until the budget is met, so no evaluation solves
+# calc_velocity.
+#
+import math
+import time
+import numpy as np
+import calc_velocity
+import route_simulator
+
+EFFICIENCY = 0.95
+AVERAGE = 1         # exponent k of the budget
+NORMALIZED = 4
+MAX_POWER = 1000.0  # watts
+TOLERANCE = 1e-6    # relative error of the budget
+MAX_ITERATIONS = 200
+
+#*------------------------------------------------------------------------------------------
+#*- the power of each segment of a route as a function of its speed, with the first and
+#*- second derivatives. With h = v + wind_along and c the square of the cross wind
+#*-     W_A   = h^3 / |v_app|
+#*-     W_A'  = h^2 * (2 h^2 + 3 c) / |v_app|^3
+#*-     W_A'' = h * (2 h^4 + 5 c h^2 + 6 c^2) / |v_app|^5
+#*------------------------------------------------------------------------------------------
+class PowerCurve:
+
+    def __init__(self, route, K_A, wind_mag = 0.0, wind_deg = 0.0):
+        relative = np.radians(np.asarray(wind_deg, dtype = np.float64) - route.heading)
+        self.wind_along = np.asarray(wind_mag, dtype = np.float64) * np.cos(relative)
+        self.wind_across2 = np.square(np.asarray(wind_mag, dtype = np.float64) * np.sin(relative))
+        self.route = route
+        self.K_A = K_A
+
+    #*-- the power at the speeds v of the segments at index
+    def get_power(self, v, index = slice(None)):
+        head = v + self.wind_along[index]
+        app = np.maximum(np.sqrt(head * head + self.wind_across2[index]), 1e-300)
+        return v * (self.K_A * head * head * head / app + self.route.other_resistance[index]) / EFFICIENCY
+
+    #*-- the power and its first and second derivatives by the speed
+    def get_derivatives(self, v, index = slice(None)):
+        head = v + self.wind_along[index]
+        head2 = head * head
+        c = self.wind_across2[index]
+        app = np.maximum(np.sqrt(head2 + c), 1e-300)
+        app2 = app * app
+        W_A = head2 * head / app
+        dW_A = head2 * (2.0 * head2 + 3.0 * c) / (app2 * app)
+        d2W_A = head * (2.0 * head2 * head2 + 5.0 * c * head2 + 6.0 * c * c) / (app2 * app2 * app)
+        force = self.K_A * W_A + self.route.other_resistance[index]
+        power = v * force / EFFICIENCY
+        dpower = (force + v * self.K_A * dW_A) / EFFICIENCY
+        d2power = (2.0 * self.K_A * dW_A + v * self.K_A * d2W_A) / EFFICIENCY
+        return power, dpower, d2power
+
+    #*-- d time / d power of each segment at the speeds v
+    def get_sensitivity(self, v):
+        return -self.route.length / (v * v * self.get_derivatives(v)[1])
+
+class PacingPlan:
+
+    def __init__(self, route, curve, speed, multiplier, budget, exponent, iterations, converged):
+        self.speed = speed
+        self.power = curve.get_power(speed)
+        self.time = route.length / speed
+        self.sensitivity = curve.get_sensitivity(speed)   # d time / d power, s/W
+        self.multiplier = multiplier
+        self.budget = budget
+        self.exponent = exponent
+        self.iterations = iterations
+        self.converged = converged
+
+    @property
+    def total_time(self):
+        return float(np.sum(self.time))
+
+    @property
+    def average_power(self):
+        return float(np.sum(self.time * self.power) / np.sum(self.time))
+
+    @property
+    def normalized_power(self):
+        return float(np.sum(self.time * self.power ** 4) / np.sum(self.time)) ** 0.25
+
+#*-- the power mean of exponent k weighted by the segment times
+def get_power_mean(time, power, exponent):
+    return float(np.sum(time * power ** exponent) / np.sum(time)) ** (1.0 / exponent)
+
+#*------------------------------------------------------------------------------------------
+#*- speeds in [low, high] where each segment is stationary for the multiplier, starting from
+#*- speed. Segments at a limit stay there when h does not change sign.
+#*------------------------------------------------------------------------------------------
+def solve_segments(curve, multiplier, budget, exponent, low, high, speed):
+    def stationary(v, index = slice(None)):
+        power, dpower, d2power = curve.get_derivatives(v, index)
+        power_k1 = power ** (exponent - 1)
+        h = multiplier * exponent * power_k1 * v * dpower - 1.0 - multiplier * (power_k1 * power - budget ** exponent)
+        dh = power_k1 * d2power
+        if (exponent > 1):
+            dh = dh + (exponent - 1) * power ** (exponent - 2) * dpower * dpower
+        return h, multiplier * exponent * v * dh
+
+    h_low = stationary(low)[0]
+    h_high = stationary(high)[0]
+    speed = np.where(h_low >= 0, low, np.where(h_high <= 0, high, np.clip(speed, low, high)))
+    active = np.flatnonzero((h_low < 0) & (h_high > 0))
+    low = low[active]
+    high = high[active]
+    v = speed[active]
+    for _ in range(0, MAX_ITERATIONS):
+        if (v.size == 0):
+            break
+        h, dh = stationary(v, active)
+        low = np.where(h < 0, v, low)
+        high = np.where(h > 0, v, high)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            new_v = v - h / dh
+        outside = ~((new_v > low) & (new_v < high))
+        new_v = np.where(outside, 0.5 * (low + high), new_v)
+        done = (np.abs(new_v - v) < 1e-10 * v) | (h == 0)
+        speed[active] = new_v
+        keep = ~done
+        active, low, high, v = active[keep], low[keep], high[keep], new_v[keep]
+    return speed
+
+#*------------------------------------------------------------------------------------------
+#*- the pacing plan of a route for a budget in watts on the average (exponent = AVERAGE) or
+#*- normalized power (exponent = NORMALIZED) with the segment powers in [min_power, max_power].
+#*- A budget below the power of the lowest speeds returns them with converged False.
+#*------------------------------------------------------------------------------------------
+def optimize_pacing(route, K_A, budget, exponent = AVERAGE, wind_mag = 0.0, wind_deg = 0.0, min_power = 0.0, \
+                    max_power = MAX_POWER, tolerance = TOLERANCE):
+    curve = PowerCurve(route, K_A, wind_mag, wind_deg)
+    speed_limits = []
+    for power in (min_power, max_power):
+        speed = calc_velocity.calc_velocity_array(K_A, wind_mag, wind_deg, route.other_resistance, power, \
+                                                  route.heading, tolerance = 1e-9)[0]
+        speed_limits.append(np.maximum(np.nan_to_num(speed, nan = 0.0), route_simulator.MIN_SPEED))
+    low, high = speed_limits[0], np.maximum(speed_limits[1], speed_limits[0])
+    low = np.where(curve.get_power(low) > max_power, high, low)  # walking needs more than max_power
+
+    def mean_power(speed):
+        return get_power_mean(route.length / speed, curve.get_power(speed), exponent)
+
+    # within budget at the maximum power
+    if (mean_power(high) <= budget):
+        return PacingPlan(route, curve, high, 0.0, budget, exponent, 0, True)
+    # over budget even at the lowest speeds, ride them and report that the budget was not met
+    if (mean_power(low) > budget):
+        return PacingPlan(route, curve, low, math.inf, budget, exponent, 0, False)
+
+    # bracket the multiplier, then bisect it on a log scale
+    lower, upper = 0.0, 1.0 / budget ** exponent
+    speed = solve_segments(curve, upper, budget, exponent, low, high, 0.5 * (low + high))
+    iterations = 1
+    while (mean_power(speed) > budget and iterations < MAX_ITERATIONS):
+        lower, upper = upper, 4.0 * upper
+        speed = solve_segments(curve, upper, budget, exponent, low, high, speed)
+        iterations += 1
+    converged = False
+    multiplier = upper
+    while (iterations < MAX_ITERATIONS):
+        multiplier = math.sqrt(lower * upper) if lower > 0 else 0.5 * upper
+        speed = solve_segments(curve, multiplier, budget, exponent, low, high, speed)
+        iterations += 1
+        mean = mean_power(speed)
+        if (mean > budget):
+            lower = multiplier
+        else:
+            upper = multiplier
+        if (abs(mean - budget) <= tolerance * budget):
+            converged = True
+            break
+    return PacingPlan(route, curve, speed, multiplier, budget, exponent, iterations, converged)
+
+def test_pacing():
+    K_A = 0.5 * 0.388 * (1.293 - 0.00426 * 25)
+    rng = np.random.default_rng(17)
+    n = 200
+    route = route_simulator.Route(rng.uniform(100, 800, n), np.clip(np.cumsum(rng.normal(0, 1.5, n)), -8, 9), \
+                                  rng.uniform(0, 360, n))
+    curve = PowerCurve(route, K_A, 4.0, 30)
+
+    # the power curve against calc_power and its derivatives against differences
+    v = rng.uniform(2, 15, n)
+    power, dpower, d2power = curve.get_derivatives(v)
+    assert np.allclose(power, curve.get_power(v)), "1: Expected power"
+    step = 1e-5
+    assert np.allclose(dpower, (curve.get_power(v + step) - curve.get_power(v - step)) / (2 * step), rtol = 1e-5), \
+           "2: Expected dP/dv"
+    assert np.allclose(d2power, (curve.get_derivatives(v + step)[1] - curve.get_derivatives(v - step)[1]) / \
+                       (2 * step), rtol = 1e-4), "3: Expected d2P/dv2"
+    velocity = calc_velocity.calc_velocity_array(K_A, 4.0, 30, route.other_resistance, np.maximum(power, 1.0), \
+                                                 route.heading, tolerance = 1e-9)[0]
+    positive = power > 1.0
+    assert np.allclose(velocity[positive], v[positive], atol = 1e-6), "4: Expected the velocity of the power"
+
+    for exponent in (AVERAGE, NORMALIZED):
+        plan = optimize_pacing(route, K_A, 250, exponent, 4.0, 30, max_power = 600)
+        mean = plan.average_power if exponent == AVERAGE else plan.normalized_power
+        assert plan.converged and abs(mean - 250) < 1e-3, "5: Expected budget " + str(mean)
+        assert np.all(plan.power >= -1e-6) and np.all(plan.power <= 600 + 1e-6), "6: Expected power limits"
+
+        # faster than an even effort with the same budget
+        even = route.simulate(250, K_A, 4.0, 30)
+        assert plan.total_time < even.total_time, "7: Expected faster than even " + str(plan.total_time)
+
+        # moving power between interior segments at the same budget does not help
+        interior = np.flatnonzero((plan.power > 1) & (plan.power < 599))
+        i, j = interior[0], interior[1]
+        for delta in (-5.0, 5.0):
+            power = plan.power.copy()
+            # keep sum of t * P^k fixed to first order with the analytic sensitivities
+            dG = plan.sensitivity * (power ** exponent - 250 ** exponent) + plan.time * exponent * \
+                 power ** (exponent - 1)
+            power[i] += delta
+            power[j] -= delta * dG[i] / dG[j]
+            speed = calc_velocity.calc_velocity_array(K_A, 4.0, 30, route.other_resistance, power, route.heading, \
+                                                      tolerance = 1e-9)[0]
+            assert np.sum(route.length / speed) > plan.total_time - 1e-6, "8: Expected an optimum " + str(delta)
+
+    # a generous budget rides at the maximum power
+    plan = optimize_pacing(route, K_A, 2000, max_power = 400)
+    assert plan.multiplier == 0.0 and np.allclose(plan.power, 400), "9: Expected maximum power"
+
+    # a budget below the power of the lowest speeds is not met
+    steep = route_simulator.Route([500, 500, 500], [10, 12, 8])
+    for budget, min_power in ((20, 0.0), (200, 250)):
+        plan = optimize_pacing(steep, K_A, budget, min_power = min_power)
+        assert not plan.converged and plan.multiplier == math.inf, "10: Expected infeasible " + str(budget)
+        assert plan.average_power > budget, "11: Expected lowest speeds " + str(plan.average_power)
+
+    # 10k segments
+    n = 10000
+    route = route_simulator.Route(rng.uniform(20, 200, n), np.clip(np.cumsum(rng.normal(0, 0.5, n)), -10, 12), \
+                                  rng.uniform(0, 360, n))
+    start = time.perf_counter()
+    plan = optimize_pacing(route, K_A, 280, NORMALIZED, 3.0, 200, max_power = 700)
+    elapsed = time.perf_counter() - start
+    assert plan.converged and abs(plan.normalized_power - 280) < 1e-3, "12: Expected budget"
+    assert elapsed < 5.0, "13: 10k segments took " + str(elapsed) + "s"
+
+if __name__ == "__main__":
+    test_pacing()
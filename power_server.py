@@ -0,0 +1,309 @@
+#
+# Local power and velocity service
+# Copyright (c) 2020 Manu Konchady
+#
+# An asyncio HTTP/JSON server for calc_power and calc_velocity queries. Requests that arrive
+# within window seconds of each other are evaluated as one micro batch with the array
+# calculators and the results are sent back to each client.
+#
+#   POST /power     {"K_A": 0.23, "v_bike": 30, "v_wind": 10, "wind_deg": 0, "other_resistance": 4}
+#                   -> {"power": ...}                     velocities in kmph, power in watts
+#   POST /velocity  {"K_A": 0.23, "wind_mag": 2.8, "wind_deg": 0, "other_resistance": 4, "power": 200}
+#                   -> {"velocity": ..., "converged": ...}  velocities in m/s
+#   GET /metrics    queue depth, batch size and latency in the Prometheus text format
+#   GET /stats      the same as JSON
+#
+# The server only listens on a loopback address.
+#
+#   python power_server.py [--port 8642] [--window-ms 2]
+#
+import argparse
+import asyncio
+import ipaddress
+import json
+import socket
+import time
+import numpy as np
+import calc_power
+import calc_velocity
+import calc_wind
+import instrumentation
+
+HOST = "127.0.0.1"
+PORT = 8642
+WINDOW = 0.002      # seconds to collect a batch
+MAX_BATCH = 4096
+MAX_BODY = 65536
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+LATENCY_BUCKETS = (1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 0.01, 0.02, 0.05, 0.1, 0.5, 1.0)
+
+POWER_FIELDS = ("K_A", "v_bike", "v_wind", "wind_deg", "other_resistance")
+VELOCITY_FIELDS = ("K_A", "wind_mag", "wind_deg", "other_resistance", "power")
+
+#*-- power in watts for arrays of the POWER_FIELDS, the array form of calc_power.calc_air_res and calc_power
+def get_power_array(K_A, v_bike, v_wind, wind_deg, other_resistance):
+    air_res = K_A * calc_wind.get_head_wind2_array(v_bike * 0.277778, v_wind * 0.277778, wind_deg, 0)
+    return calc_power.calc_power(other_resistance + air_res, v_bike)
+
+def get_velocity_array(K_A, wind_mag, wind_deg, other_resistance, power):
+    velocity, _, converged = calc_velocity.calc_velocity_array(K_A, wind_mag, wind_deg, other_resistance, power)
+    return velocity, converged
+
+#*------------------------------------------------------------------------------
+#*- collect the queries of concurrent requests and evaluate them together.
+#*- function takes one array per field and returns an array (or a tuple of
+#*- arrays) with one value per query.
+#*------------------------------------------------------------------------------
+class MicroBatcher:
+
+    def __init__(self, name, function, fields, window = WINDOW, max_batch = MAX_BATCH):
+        self.name = name
+        self.function = function
+        self.fields = fields
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = []
+        self.wakeup = None
+        self.task = None
+        self.requests = 0
+        self.max_queue_depth = 0
+        self.batch_size = instrumentation.Histogram(BATCH_BUCKETS)
+        self.latency = instrumentation.Histogram(LATENCY_BUCKETS)
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    #*-- queue a query (a dict of the fields) and wait for its result
+    async def submit(self, query):
+        values = tuple(float(query[field]) for field in self.fields)
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((values, future, time.perf_counter()))
+        self.requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        self.wakeup.set()
+        return await future
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            if (len(self.queue) < self.max_batch):
+                await asyncio.sleep(self.window)
+            batch = self.queue[:self.max_batch]
+            del self.queue[:self.max_batch]
+            if (not self.queue):
+                self.wakeup.clear()
+            if (batch):
+                self.evaluate(batch)
+
+    def evaluate(self, batch):
+        columns = np.array([values for values, _, _ in batch], dtype = np.float64).T
+        try:
+            results = self.function(*columns)
+        except Exception as error:
+            for _, future, _ in batch:
+                if (not future.done()):
+                    future.set_exception(error)
+            return
+        if (not isinstance(results, tuple)):
+            results = (results,)
+        results = [result.tolist() for result in results]
+        now = time.perf_counter()
+        self.batch_size.observe(len(batch))
+        for i, (_, future, queued) in enumerate(batch):
+            self.latency.observe(now - queued)
+            if (not future.done()):
+                future.set_result(tuple(result[i] for result in results))
+
+    def stats(self):
+        return dict(requests = self.requests, queue_depth = len(self.queue), max_queue_depth = self.max_queue_depth, \
+                    batch_size = self.batch_size.to_dict(), latency = self.latency.to_dict())
+
+class PowerServer:
+
+    def __init__(self, host = HOST, port = PORT, window = WINDOW, max_batch = MAX_BATCH):
+        if (not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback):
+            raise ValueError("The server only listens on a loopback address, not " + host)
+        self.host = host
+        self.port = port
+        self.batchers = dict(power = MicroBatcher("power", get_power_array, POWER_FIELDS, window, max_batch), \
+                             velocity = MicroBatcher("velocity", get_velocity_array, VELOCITY_FIELDS, window, \
+                                                     max_batch))
+        self.server = None
+
+    async def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    def stats(self):
+        return dict((name, batcher.stats()) for name, batcher in self.batchers.items())
+
+    def to_prometheus(self, prefix = "cycle_server"):
+        lines = ["# TYPE " + prefix + "_requests_total counter", "# TYPE " + prefix + "_queue_depth gauge"]
+        for name, batcher in self.batchers.items():
+            lines.append('%s_requests_total{endpoint="%s"} %d' % (prefix, name, batcher.requests))
+            lines.append('%s_queue_depth{endpoint="%s"} %d' % (prefix, name, len(batcher.queue)))
+        for metric, attribute in (("batch_size", "batch_size"), ("latency_seconds", "latency")):
+            lines.append("# TYPE " + prefix + "_" + metric + " histogram")
+            for name, batcher in self.batchers.items():
+                histogram = getattr(batcher, attribute)
+                for bound, count in histogram.cumulative():
+                    lines.append('%s_%s_bucket{endpoint="%s",le="%s"} %d' % (prefix, metric, name, bound, count))
+                lines.append('%s_%s_sum{endpoint="%s"} %r' % (prefix, metric, name, histogram.sum))
+                lines.append('%s_%s_count{endpoint="%s"} %d' % (prefix, metric, name, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    #*-- return the status, content type and body for a request
+    async def respond(self, method, path, body):
+        if (method == "GET" and path == "/metrics"):
+            return 200, "text/plain; version=0.0.4", self.to_prometheus()
+        if (method == "GET" and path == "/stats"):
+            return 200, "application/json", json.dumps(self.stats())
+        name = path.strip("/")
+        if (method != "POST" or name not in self.batchers):
+            return 404, "application/json", json.dumps(dict(error = "not found: " + method + " " + path))
+        try:
+            query = json.loads(body)
+            result = await self.batchers[name].submit(query)
+        except (ValueError, KeyError, TypeError) as error:
+            return 400, "application/json", json.dumps(dict(error = type(error).__name__ + ": " + str(error)))
+        if (name == "power"):
+            return 200, "application/json", json.dumps(dict(power = result[0]))
+        converged = bool(result[1])
+        return 200, "application/json", json.dumps(dict(velocity = result[0] if converged else None, \
+                                                        converged = converged))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if (not request_line):
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if (not line):
+                        break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if (length > MAX_BODY):
+                    break
+                body = await reader.readexactly(length) if length else b""
+                try:
+                    status, content_type, text = await self.respond(method, path.split("?")[0], body)
+                except Exception as error:
+                    # any other failure of the calculators still gets a reply
+                    status, content_type = 500, "application/json"
+                    text = json.dumps(dict(error = type(error).__name__ + ": " + str(error)))
+                data = text.encode()
+                writer.write(("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n" % \
+                              (status, "OK" if status == 200 else "Error", content_type, len(data))).encode() + data)
+                await writer.drain()
+                if (headers.get("connection", "").lower() == "close"):
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host = HOST, port = PORT, window = WINDOW):
+    server = PowerServer(host, port, window)
+    await server.start()
+    print ("Listening on http://" + host + ":" + str(server.port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+#*-- send one request on a new connection and return the status and body
+async def request(port, method, path, query = None, host = HOST):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(query).encode() if query is not None else b""
+    writer.write(("%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % \
+                  (method, path, host, len(body))).encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, text = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), text.decode()
+
+def test_server():
+    K_A = 0.5 * 0.388 * (1.293 - 0.00426 * 25)
+    rng = np.random.default_rng(6)
+    power_queries = [dict(K_A = K_A, v_bike = float(v), v_wind = float(w), wind_deg = float(d), \
+                          other_resistance = 4.0) \
+                     for v, w, d in zip(rng.uniform(10, 45, 60), rng.uniform(0, 20, 60), rng.uniform(0, 360, 60))]
+    velocity_queries = [dict(K_A = K_A, wind_mag = float(w), wind_deg = 0.0, other_resistance = 4.0, power = float(p)) \
+                        for w, p in zip(rng.uniform(0, 5, 40), rng.uniform(50, 400, 40))]
+
+    async def run():
+        server = PowerServer(port = 0, window = 0.005)
+        await server.start()
+        try:
+            power = await asyncio.gather(*[request(server.port, "POST", "/power", q) for q in power_queries])
+            velocity = await asyncio.gather(*[request(server.port, "POST", "/velocity", q) for q in velocity_queries])
+            missing = await request(server.port, "POST", "/power", dict(K_A = 1))
+            unknown = await request(server.port, "GET", "/nothing")
+            metrics = await request(server.port, "GET", "/metrics")
+            stats = await request(server.port, "GET", "/stats")
+            server.batchers["power"].function = lambda *columns: 1 / 0
+            failed = await request(server.port, "POST", "/power", power_queries[0])
+        finally:
+            await server.stop()
+        return power, velocity, missing, unknown, metrics, stats, failed
+
+    power, velocity, missing, unknown, metrics, stats, failed = asyncio.run(run())
+    for query, (status, text) in zip(power_queries, power):
+        expected = calc_power.calc_power(query["other_resistance"] + calc_power.calc_air_res(query["K_A"], \
+                                         query["v_bike"], query["v_wind"], query["wind_deg"]), query["v_bike"])
+        # the array head wind skips the angle rounding of the scalar get_head_wind2
+        assert status == 200 and abs(json.loads(text)["power"] - expected) < 0.01 * expected + 1e-6, \
+               "1: Expected power " + str(expected) + " " + text
+    for query, (status, text) in zip(velocity_queries, velocity):
+        expected = calc_velocity.calc_velocity(query["K_A"], query["wind_mag"], query["wind_deg"], \
+                                               query["other_resistance"], query["power"])
+        result = json.loads(text)
+        assert status == 200 and result["converged"] and abs(result["velocity"] - expected) < 0.1, \
+               "2: Expected velocity " + str(expected) + " " + text
+    assert missing[0] == 400 and unknown[0] == 404 and failed[0] == 500 and \
+           "ZeroDivisionError" in json.loads(failed[1])["error"], "3: Expected errors " + str((missing, unknown, failed))
+
+    stats = json.loads(stats[1])
+    assert stats["power"]["requests"] == 60 and stats["velocity"]["requests"] == 40, "4: Requests " + str(stats)
+    assert stats["power"]["batch_size"]["count"] < 60, "5: Expected batches " + str(stats["power"]["batch_size"])
+    assert stats["power"]["latency"]["count"] == 60 and stats["power"]["queue_depth"] == 0, "6: Latency"
+    assert 'cycle_server_requests_total{endpoint="velocity"} 40' in metrics[1], "7: Expected metrics"
+    try:
+        PowerServer(host = "192.0.2.1")
+        assert False, "8: Expected only loopback addresses"
+    except ValueError:
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog = "power_server.py", description = "Local power and velocity service")
+    parser.add_argument("--host", default = HOST)
+    parser.add_argument("--port", type = int, default = PORT)
+    parser.add_argument("--window-ms", type = float, default = WINDOW * 1000.0)
+    options = parser.parse_args()
+    try:
+        asyncio.run(serve(options.host, options.port, options.window_ms / 1000.0))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,203 @@
+#
+# Columnar ride archive
+# Copyright (c) 2020 Manu Konchady
+#
+# A ride archive stores per point columns (time, speed, altitude, temperature, ...) as fixed
+# width float32 / float64 arrays, one after the other, behind a small header:
+#
+#   magic "CYCARCH1", rows (uint64), columns (uint32), index stride (uint32), index size (uint64)
+#   per column: name (32 bytes), numpy dtype (8 bytes), byte offset of the data (uint64)
+#   index: the time of every index stride'th row (float64)
+#
+# Column data starts on a page boundary so the columns are opened as numpy memory maps and
+# slices are passed to the array calculators without copies. Rows are in time order and a
+# time range is found from the index and a binary search of one block of the time column.
+#
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+import calc_air_density
+import calc_wind
+import common
+
+MAGIC = b"CYCARCH1"
+HEADER = struct.Struct("<8sQIIQ")
+COLUMN = struct.Struct("<32s8sQ")
+PAGE = 4096
+INDEX_STRIDE = 4096
+
+# column types, float64 for time and position and float32 for the measurements
+DTYPES = {"time": "<f8", "lat": "<f8", "lon": "<f8", "distance": "<f8"}
+DEFAULT_DTYPE = "<f4"
+
+def align(offset):
+    return (offset + PAGE - 1) // PAGE * PAGE
+
+#*----------------------------------------------------------------------------------------------
+#*- write an archive from chunks (dicts of equal length arrays) such as those of
+#*- ride_stream.stream_ride. Each column is spooled to a temporary file while the chunks
+#*- arrive, so memory does not grow with the number of rows.
+#*----------------------------------------------------------------------------------------------
+class ArchiveWriter:
+
+    def __init__(self, file_name, columns, index_stride = INDEX_STRIDE):
+        if ("time" not in columns):
+            raise ValueError("An archive needs a time column")
+        self.file_name = file_name
+        self.columns = list(columns)
+        self.dtypes = dict((name, np.dtype(DTYPES.get(name, DEFAULT_DTYPE))) for name in self.columns)
+        self.index_stride = index_stride
+        self.rows = 0
+        self.index = []
+        self.last_time = -np.inf
+        self.directory = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(file_name)))
+        self.spools = dict((name, open(os.path.join(self.directory, str(i)), "wb")) \
+                           for i, name in enumerate(self.columns))
+
+    def append(self, chunk):
+        time = np.asarray(chunk["time"], dtype = np.float64)
+        if (time.size == 0):
+            return
+        if (time[0] < self.last_time or np.any(np.diff(time) < 0)):
+            raise ValueError("Archive rows must be in time order")
+        self.last_time = time[-1]
+        first = -self.rows % self.index_stride
+        self.index.extend(time[first::self.index_stride].tolist())
+        for name in self.columns:
+            self.spools[name].write(np.ascontiguousarray(chunk[name], dtype = self.dtypes[name]).tobytes())
+        self.rows += time.size
+
+    def close(self):
+        header_size = HEADER.size + COLUMN.size * len(self.columns) + 8 * len(self.index)
+        offsets = []
+        offset = align(header_size)
+        for name in self.columns:
+            offsets.append(offset)
+            offset = align(offset + self.rows * self.dtypes[name].itemsize)
+
+        with open(self.file_name, "wb") as output:
+            output.write(HEADER.pack(MAGIC, self.rows, len(self.columns), self.index_stride, len(self.index)))
+            for name, column_offset in zip(self.columns, offsets):
+                output.write(COLUMN.pack(name.encode(), self.dtypes[name].str.encode(), column_offset))
+            output.write(np.asarray(self.index, dtype = "<f8").tobytes())
+            for name, column_offset in zip(self.columns, offsets):
+                self.spools[name].close()
+                output.seek(column_offset)
+                with open(self.spools[name].name, "rb") as spool:
+                    shutil.copyfileobj(spool, output)
+            output.truncate(offset)
+        shutil.rmtree(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if (exc_type is None):
+            self.close()
+        else:
+            for spool in self.spools.values():
+                spool.close()
+            shutil.rmtree(self.directory)
+
+#*-- write the chunks of a ride stream to an archive with the given columns
+def write_archive(file_name, chunks, columns):
+    with ArchiveWriter(file_name, columns) as writer:
+        for chunk in chunks:
+            writer.append(chunk)
+
+#*----------------------------------------------------------------------------------------------
+#*- read only access to an archive, columns are numpy memory maps
+#*----------------------------------------------------------------------------------------------
+class RideArchive:
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as archive:
+            magic, self.rows, n_columns, self.index_stride, n_index = HEADER.unpack(archive.read(HEADER.size))
+            if (magic != MAGIC):
+                raise ValueError("Not a ride archive: " + file_name)
+            self.layout = {}
+            for _ in range(0, n_columns):
+                name, dtype, offset = COLUMN.unpack(archive.read(COLUMN.size))
+                self.layout[name.rstrip(b"\0").decode()] = (np.dtype(dtype.rstrip(b"\0").decode()), offset)
+            self.index = np.frombuffer(archive.read(8 * n_index), dtype = "<f8")
+        self.maps = {}
+
+    @property
+    def columns(self):
+        return list(self.layout)
+
+    def column(self, name):
+        if (name not in self.maps):
+            dtype, offset = self.layout[name]
+            if (self.rows == 0):  # an empty file can not be memory mapped
+                return np.empty(0, dtype = dtype)
+            self.maps[name] = np.memmap(self.file_name, dtype = dtype, mode = "r", offset = offset, \
+                                        shape = (self.rows,))
+        return self.maps[name]
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    #*-- first row with time >= t (side left) or > t (side right)
+    def find_row(self, t, side = "left"):
+        block = int(np.searchsorted(self.index, t, side = side))
+        start = max(block - 1, 0) * self.index_stride
+        end = min(block * self.index_stride + 1, self.rows) if block < self.index.size else self.rows
+        return start + int(np.searchsorted(self.column("time")[start:end], t, side = side))
+
+    #*-- rows with start_time <= time < end_time as memory mapped slices of the columns
+    def select(self, start_time, end_time, columns = None):
+        first = self.find_row(start_time, "left")
+        last = self.find_row(end_time, "left")
+        return dict((name, self.column(name)[first:last]) for name in (columns or self.columns))
+
+def test_archive():
+    rows = 100000
+    rng = np.random.default_rng(5)
+    time = np.cumsum(rng.uniform(0.5, 1.5, rows))
+    data = dict(time = time, speed = rng.uniform(10, 40, rows), altitude = rng.uniform(0, 2000, rows), \
+                temp = rng.uniform(-5, 35, rows), rh = rng.uniform(10, 90, rows), heading = rng.uniform(0, 360, rows), \
+                power = rng.uniform(0, 400, rows))
+    columns = list(data)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "rides.arc")
+        chunks = (dict((name, values[i:i + 7000]) for name, values in data.items()) for i in range(0, rows, 7000))
+        write_archive(file_name, chunks, columns)
+        assert os.listdir(directory) == ["rides.arc"], "1: Spool files left behind " + str(os.listdir(directory))
+
+        archive = RideArchive(file_name)
+        assert archive.columns == columns and archive.rows == rows, "2: Header " + str(archive.columns)
+        assert archive["time"].dtype == np.float64 and archive["speed"].dtype == np.float32, "3: Column types"
+        assert np.array_equal(archive["time"], time), "4: Expected time"
+        assert np.array_equal(archive["power"], data["power"].astype(np.float32)), "5: Expected power"
+
+        # time ranges against a linear scan
+        for start_time, end_time in ((0, 10), (1000.3, 2000.7), (time[4095], time[4096]), (time[-1], time[-1] + 1), \
+                                     (time[50000], time[50000])):
+            selection = archive.select(start_time, end_time)
+            expected = (time >= start_time) & (time < end_time)
+            assert np.array_equal(selection["time"], time[expected]), "6: Range " + str((start_time, end_time))
+            if (expected.any()):
+                assert isinstance(selection["speed"], np.memmap), "7: Expected a memory map"
+                assert np.shares_memory(selection["speed"], archive["speed"]), "8: Expected no copy"
+
+        # the array calculators read the column slices directly
+        selection = archive.select(1000, 5000)
+        head_wind = calc_wind.get_head_wind_array(common.meter_per_second(selection["speed"]), 3.0, \
+                                                  calc_wind.bearingToDegrees(90.0), \
+                                                  calc_wind.bearingToDegrees(selection["heading"]))
+        i = 17
+        expected = calc_wind.get_head_wind(common.meter_per_second(float(selection["speed"][i])), 3.0, \
+                                           calc_wind.bearingToDegrees(90.0), \
+                                           calc_wind.bearingToDegrees(float(selection["heading"][i])))
+        assert abs(head_wind[i] - expected) < 1e-3, "9: Expected head wind " + str(expected)
+        density = calc_air_density.get_density(float(selection["altitude"][i]), float(selection["temp"][i]), \
+                                               float(selection["rh"][i]))
+        assert 0.8 < density < 1.5, "10: Expected density " + str(density)
+
+if __name__ == "__main__":
+    test_archive()
@@ -0,0 +1,280 @@
+#
+# Streaming ride ingestion
+# Copyright (c) 2020 Manu Konchady
+#
+# Read GPX, TCX or CSV track files point by point, derive speed, grade and heading from
+# consecutive points, and estimate the resistance and power of every point. The points
+# are emitted in chunks of numpy arrays, so the memory used does not grow with the file.
+#
+# Units: time in seconds, distances and altitude in meters, speed in kmph, grade in percent,
+# headings as bearings (0 is North, clockwise), forces in newtons and power in watts.
+#
+import csv
+import math
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from datetime import datetime, timezone
+import numpy as np
+import calc_air_density
+import calc_power
+import calc_wind
+import common
+
+G_ACCEL = 9.81
+EARTH_RADIUS = 6371008.8 # meters
+CHUNK_SIZE = 4096
+
+# defaults for the rider and the weather when the track does not record them
+TOTAL_MASS = 80         # rider and bicycle kgs.
+ROLL_V = 0.005          # Clinchers: 0.005, Tubular: 0.004, MTB: 0.012
+C_D_AREA = 0.388        # Hoods: 0.388  Bartops: 0.445  Barends: 0.42  Drops: 0.3 Aerobar: 0.233
+TEMP = 25               # centigrade
+RH = 50                 # relative humidity percentage
+
+# distance is the cumulative distance recorded by the device, nan when not recorded
+TrackPoint = namedtuple("TrackPoint", "time lat lon altitude distance temp rh pressure power")
+
+# columns of a chunk
+COLUMNS = ("time", "lat", "lon", "altitude", "distance", "speed", "grade", "heading", "temp", "rh", "density", \
+           "head_wind", "rolling_res", "grade_res", "air_res", "total_res", "power", "measured_power")
+
+#*-- seconds since the epoch from an ISO 8601 time or a number of seconds
+def parse_time(text):
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if (text.endswith("Z")):
+        text = text[:-1] + "+00:00"
+    return datetime.fromisoformat(text).timestamp()
+
+def local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+#*-- float of the first descendant with a local name in names, or nan
+def find_value(element, names):
+    for child in element.iter():
+        if (local_name(child.tag) in names and child.text):
+            return float(child.text)
+    return math.nan
+
+#*----------------------------------------------------------------------------
+#*- iterate over the elements with local name tag, each element is removed
+#*- from its parent after it is read so the tree does not grow with the file
+#*----------------------------------------------------------------------------
+def iter_elements(file_name, tag):
+    stack = []
+    for event, element in ET.iterparse(file_name, events = ("start", "end")):
+        if (event == "start"):
+            stack.append(element)
+            continue
+        stack.pop()
+        if (local_name(element.tag) == tag):
+            yield element
+            if (stack):
+                stack[-1].remove(element)
+
+def read_gpx(file_name):
+    for point in iter_elements(file_name, "trkpt"):
+        time = math.nan
+        for child in point:
+            if (local_name(child.tag) == "time"):
+                time = parse_time(child.text)
+        yield TrackPoint(time, float(point.get("lat")), float(point.get("lon")), find_value(point, ("ele",)), \
+                         math.nan, find_value(point, ("atemp", "temp")), find_value(point, ("humidity",)), \
+                         math.nan, find_value(point, ("power", "Watts")))
+
+def read_tcx(file_name):
+    for point in iter_elements(file_name, "Trackpoint"):
+        time = math.nan
+        for child in point:
+            if (local_name(child.tag) == "Time"):
+                time = parse_time(child.text)
+        yield TrackPoint(time, find_value(point, ("LatitudeDegrees",)), find_value(point, ("LongitudeDegrees",)), \
+                         find_value(point, ("AltitudeMeters",)), find_value(point, ("DistanceMeters",)), \
+                         math.nan, math.nan, math.nan, find_value(point, ("Watts",)))
+
+#*-- CSV with a header of time, lat, lon, altitude and optional distance, temp, rh, pressure, power
+def read_csv(file_name):
+    with open(file_name, newline = "") as csv_file:
+        for row in csv.DictReader(csv_file):
+            def value(name):
+                text = row.get(name)
+                return float(text) if text not in (None, "") else math.nan
+            yield TrackPoint(parse_time(row["time"]), value("lat"), value("lon"), value("altitude"), value("distance"), \
+                             value("temp"), value("rh"), value("pressure"), value("power"))
+
+READERS = {".gpx": read_gpx, ".tcx": read_tcx, ".csv": read_csv}
+
+def read_points(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    if (extension not in READERS):
+        raise ValueError("Unknown track file type: " + file_name)
+    return READERS[extension](file_name)
+
+#*-- distance in meters and initial bearing in degrees between arrays of points
+def get_distance_bearing(lat1, lon1, lat2, lon2):
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(lon2 - lon1)
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    distance = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    y = np.sin(d_lambda) * np.cos(phi2)
+    x = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(d_lambda)
+    bearing = np.degrees(np.arctan2(y, x)) % 360
+    return distance, bearing
+
+#*----------------------------------------------------------------------------------------------
+#*- estimate the resistance and power of a chunk of points. previous is the last point of the
+#*- preceding chunk (or None) and is used for the differences of the first point.
+#*- wind_mag is in m/s and wind_bearing is the bearing the wind comes from. A wind_field
+#*- (wind_field.WindField) replaces them with the wind at the time and place of each point.
+#*----------------------------------------------------------------------------------------------
+def process_chunk(points, previous, wind_mag, wind_bearing, total_mass, roll_v, c_d_area, temp, rh, \
+                  wind_field = None):
+    data = np.array(points, dtype = np.float64)
+    if (previous is not None):
+        data = np.vstack([np.array([previous], dtype = np.float64), data])
+    time, lat, lon, altitude, distance, temp_c, rh_c, pressure, measured_power = data.T
+
+    # differences between consecutive points, the first point of a ride has no motion
+    step, heading = get_distance_bearing(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    recorded = np.diff(distance)
+    step = np.where(np.isfinite(recorded), recorded, step)
+    dt = np.diff(time)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        speed = np.where(dt > 0, common.kmph(step / dt), 0.0)
+        grade = np.where(step > 0, 100.0 * np.diff(altitude) / step, 0.0)
+    grade = np.nan_to_num(grade)
+    if (previous is None):
+        speed = np.concatenate([[0.0], speed])
+        grade = np.concatenate([[0.0], grade])
+        heading = np.concatenate([heading[:1] if heading.size else [0.0], heading])
+        step = np.concatenate([[0.0], step])
+    else:
+        time, lat, lon, altitude, distance, temp_c, rh_c, pressure, measured_power = data[1:].T
+
+    temp_c = np.where(np.isfinite(temp_c), temp_c, temp)
+    rh_c = np.where(np.isfinite(rh_c), rh_c, rh)
+    altitude = np.nan_to_num(altitude)
+    density = calc_air_density.get_density_array(altitude, temp_c, rh_c, pressure)
+
+    # apparent wind projected on the heading, in the x, y degrees of calc_wind
+    if (wind_field is not None):
+        wind_mag, wind_bearing = wind_field.get_wind(time, lat, lon)
+    v_bike = common.meter_per_second(speed)
+    head_wind, W_A, direction = calc_wind.get_wind_components(v_bike, wind_mag, \
+                                                              calc_wind.bearingToDegrees(wind_bearing), \
+                                                              calc_wind.bearingToDegrees(heading))
+    K_A = 0.5 * c_d_area * density
+    weight = total_mass * G_ACCEL
+    rolling_res = np.where(speed > 0, roll_v * weight, 0.0)
+    grade_res = weight * grade / 100.0
+    air_res = K_A * W_A
+    total_res = rolling_res + grade_res + air_res
+    power = np.maximum(calc_power.calc_power(total_res, speed), 0.0)
+
+    return dict(time = time, lat = lat, lon = lon, altitude = altitude, distance = np.cumsum(step), speed = speed, \
+                grade = grade, heading = heading, temp = temp_c, rh = rh_c, density = density, head_wind = head_wind, \
+                rolling_res = rolling_res, grade_res = grade_res, air_res = air_res, total_res = total_res, \
+                power = power, measured_power = measured_power)
+
+#*----------------------------------------------------------------------------------------------
+#*- stream the points of a track file in chunks of chunk_size points, each chunk is a dict of
+#*- numpy arrays with the keys in COLUMNS. The distance is cumulative over the ride.
+#*----------------------------------------------------------------------------------------------
+def stream_ride(file_name, chunk_size = CHUNK_SIZE, wind_mag = 0.0, wind_bearing = 0.0, total_mass = TOTAL_MASS, \
+                roll_v = ROLL_V, c_d_area = C_D_AREA, temp = TEMP, rh = RH, wind_field = None):
+    previous = None
+    ride_distance = 0.0
+    points = []
+    for point in read_points(file_name):
+        points.append(point)
+        if (len(points) == chunk_size):
+            chunk = process_chunk(points, previous, wind_mag, wind_bearing, total_mass, roll_v, c_d_area, temp, rh, \
+                                  wind_field)
+            chunk["distance"] += ride_distance
+            ride_distance = chunk["distance"][-1]
+            previous = points[-1]
+            points = []
+            yield chunk
+    if (points):
+        chunk = process_chunk(points, previous, wind_mag, wind_bearing, total_mass, roll_v, c_d_area, temp, rh, \
+                              wind_field)
+        chunk["distance"] += ride_distance
+        yield chunk
+
+#*-- stream several rides one after the other, yields the file name with each chunk
+def stream_rides(file_names, chunk_size = CHUNK_SIZE, **options):
+    for file_name in file_names:
+        for chunk in stream_ride(file_name, chunk_size, **options):
+            yield file_name, chunk
+
+#*-- write a straight ride heading east at a constant speed, used by the tests
+def write_test_ride(file_name, points, speed, grade, step_time = 1.0):
+    step = common.meter_per_second(speed) * step_time
+    d_lon = math.degrees(step / EARTH_RADIUS)
+    rows = [(i * step_time, 0.0, i * d_lon, 100.0 + i * step * grade / 100.0) for i in range(0, points)]
+    extension = os.path.splitext(file_name)[1]
+    with open(file_name, "w") as output:
+        if (extension == ".csv"):
+            output.write("time,lat,lon,altitude,temp,rh\n")
+            for t, lat, lon, alt in rows:
+                output.write("%.1f,%.9f,%.9f,%.6f,20,60\n" % (t, lat, lon, alt))
+        elif (extension == ".gpx"):
+            output.write('<?xml version="1.0"?>\n<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+            for t, lat, lon, alt in rows:
+                output.write('<trkpt lat="%.9f" lon="%.9f"><ele>%.6f</ele><time>%s</time></trkpt>\n' % \
+                             (lat, lon, alt, datetime.fromtimestamp(1600000000 + t, timezone.utc).isoformat()))
+            output.write("</trkseg></trk></gpx>\n")
+        else:
+            output.write('<?xml version="1.0"?>\n<TrainingCenterDatabase ' \
+                         'xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"><Activities><Activity>' \
+                         '<Lap><Track>\n')
+            for t, lat, lon, alt in rows:
+                output.write('<Trackpoint><Time>%s</Time><Position><LatitudeDegrees>%.9f</LatitudeDegrees>' \
+                             '<LongitudeDegrees>%.9f</LongitudeDegrees></Position><AltitudeMeters>%.6f' \
+                             '</AltitudeMeters><Extensions><TPX><Watts>150</Watts></TPX></Extensions></Trackpoint>\n' % \
+                             (datetime.fromtimestamp(1600000000 + t, timezone.utc).isoformat(), lat, lon, alt))
+            output.write("</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n")
+
+def test_stream():
+    TOLERANCE = 0.01
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = [os.path.join(directory, "ride" + extension) for extension in (".csv", ".gpx", ".tcx")]
+        for file_name in file_names:
+            write_test_ride(file_name, 1000, 30.0, 2.0)
+
+        for file_name in file_names:
+            chunks = list(stream_ride(file_name, chunk_size = 256, wind_mag = 3.0, wind_bearing = 90.0))
+            assert [len(chunk["time"]) for chunk in chunks] == [256, 256, 256, 232], "1: Chunk sizes " + file_name
+            speed = np.concatenate([chunk["speed"] for chunk in chunks])[1:]
+            grade = np.concatenate([chunk["grade"] for chunk in chunks])[1:]
+            heading = np.concatenate([chunk["heading"] for chunk in chunks])[1:]
+            assert np.all(np.abs(speed - 30.0) < TOLERANCE), "2: Expected speed 30 " + str(speed.min())
+            assert np.all(np.abs(grade - 2.0) < TOLERANCE), "3: Expected grade 2 " + str(grade.min())
+            assert np.all(np.abs(heading - 90.0) < TOLERANCE), "4: Expected heading 90 " + str(heading.min())
+            distance = chunks[-1]["distance"][-1]
+            assert abs(distance - 999 * common.meter_per_second(30.0)) < 0.5, "5: Expected distance " + str(distance)
+
+            # the scalar calculators for one point, wind from the east is a head wind for a rider going east
+            chunk = chunks[1]
+            temp = 20 if file_name.endswith(".csv") else TEMP
+            rh = 60 if file_name.endswith(".csv") else RH
+            density = calc_air_density.get_density(chunk["altitude"][10], temp, rh)
+            K_A = 0.5 * C_D_AREA * density
+            air_res = K_A * calc_wind.get_head_wind2(common.meter_per_second(chunk["speed"][10]), 3.0)
+            total_res = ROLL_V * TOTAL_MASS * G_ACCEL + TOTAL_MASS * G_ACCEL * chunk["grade"][10] / 100.0 + air_res
+            expected = calc_power.calc_power(total_res, chunk["speed"][10])
+            assert abs(chunk["density"][10] - density) < 1e-9, "6: Expected density " + str(density)
+            assert abs(chunk["power"][10] - expected) < 1e-6, "7: Expected power " + str(expected)
+
+        assert np.all(chunks[0]["measured_power"] == 150), "8: Expected TCX power"
+        assert sum(1 for _ in stream_rides(file_names, chunk_size = 500)) == 6, "9: Expected 6 chunks"
+
+if __name__ == "__main__":
+    test_stream()
@@ -0,0 +1,274 @@
+#
+# Route time simulator
+# Copyright (c) 2020 Manu Konchady
+#
+# Predict the segment speeds, split times and total time of a route from its segments
+# (length in m, grade in percent, heading in degrees), the wind and a power plan (watts per
+# segment). The resistances of a route are computed once and every segment speed is solved in
+# one call of calc_velocity.calc_velocity_array.
+#
+# Steady state: each segment is ridden at the speed where the drive balances the resistance.
+#
+# Kinetic energy carry over: a segment is entered at the exit speed of the one before. With the
+# drive D = 0.95 * power and the resistance F(v) = K_A * W_A(v) + other_resistance, the speed
+# over the distance x follows
+#       m * v * dv/dx = D / v - F(v) = g(v)
+# Every segment is solved at once (see SegmentDynamics) for its exit speed as a function of the
+# entry speed. The chain of segments is a recurrence v_out[i] = f_i(v_out[i - 1]); each pass
+# linearizes the f_i about the current entry speeds and solves the affine recurrence with a
+# parallel prefix scan in log2(segments) steps, a Newton step on the whole route.
+#
+import math
+import numpy as np
+import calc_velocity
+
+G_ACCEL = 9.81
+ROLL_V = 0.005
+EFFICIENCY = 0.95   # drive train efficiency used by calc_velocity
+MIN_SPEED = 1.0     # m/s, walking pace when the power cannot move the bike
+PASSES = 2          # Newton steps on the speeds carried over between segments
+NEWTON_STEPS = 3    # Newton steps on the exit speed of a segment
+NODES = 6           # Gauss-Legendre nodes of the integrals over a segment
+
+#*-- the affine maps v -> a * v + b composed from the first element, a parallel prefix scan
+def scan_affine(a, b):
+    a = a.copy()
+    b = b.copy()
+    step = 1
+    while (step < a.size):
+        b[step:] = a[step:] * b[:-step] + b[step:]
+        a[step:] = a[step:] * a[:-step]
+        step *= 2
+    return a, b
+
+class RouteTimes:
+
+    def __init__(self, length, speed, entry_speed, exit_speed, seconds, converged):
+        self.speed = speed                  # steady speed of each segment in m/s
+        self.entry_speed = entry_speed
+        self.exit_speed = exit_speed
+        self.time = seconds                 # seconds per segment
+        self.splits = np.cumsum(seconds)    # seconds at the end of each segment
+        self.distance = np.cumsum(length)
+        self.converged = converged          # False where the speed was set to MIN_SPEED
+
+    @property
+    def total_time(self):
+        return float(self.splits[-1]) if self.splits.size else 0.0
+
+    @property
+    def average_speed(self):
+        return float(self.distance[-1]) / self.total_time if self.splits.size else 0.0
+
+#*------------------------------------------------------------------------------------------
+#*- the speed of each segment from its entry speed, with the net force
+#*-     g(v) = D / v - K_A * W_A(v) - other_resistance
+#*- and m * v * dv/dx = g(v), so the distance between two speeds is the integral of
+#*- m * v / g(v) dv. Near the steady speed v_s the integrand is c / (v - v_s) with the residue
+#*- c = m * v_s / g'(v_s); the rest is smooth and integrated with Gauss-Legendre nodes.
+#*- Segments that did not converge are walked at MIN_SPEED.
+#*------------------------------------------------------------------------------------------
+class SegmentDynamics:
+
+    def __init__(self, route, speed, converged, drive, K_A, wind_mag, wind_deg):
+        relative = np.radians(np.asarray(wind_deg, dtype = np.float64) - route.heading)
+        self.wind_along = np.asarray(wind_mag, dtype = np.float64) * np.cos(relative)
+        self.wind_across2 = np.square(np.asarray(wind_mag, dtype = np.float64) * np.sin(relative))
+        self.route = route
+        self.speed = speed
+        self.moving = converged
+        self.drive = drive
+        self.K_A = K_A
+        self.nodes, self.weights = np.polynomial.legendre.leggauss(NODES)
+        self.residue = route.mass * speed / np.minimum(self.get_force(speed, True)[1], -1e-9)
+
+    #*-- the net force at the speeds v, and its slope with slope
+    def get_force(self, v, slope = False):
+        head = v + self.wind_along
+        app = np.maximum(np.sqrt(head * head + self.wind_across2), 1e-300)   # head is 0 when app is
+        g = self.drive / v - self.K_A * head * head * head / app - self.route.other_resistance
+        if (not slope):
+            return g
+        dW_A = head * head * (2.0 * head * head + 3.0 * self.wind_across2) / (app * app * app)
+        return g, -self.drive / (v * v) - self.K_A * dW_A
+
+    #*-- integral of f(v, g(v)) from v_in to v_out
+    def integrate(self, f, v_in, v_out):
+        half = 0.5 * (v_out - v_in)
+        total = np.zeros(v_in.size)
+        for node, weight in zip(self.nodes, self.weights):
+            v = v_in + half * (node + 1.0)
+            total += weight * f(v, self.get_force(v))
+        return half * total
+
+    # m * v / g(v) less its pole at the steady speed
+    def remainder(self, v, g):
+        deviation = v - self.speed
+        near = (np.abs(deviation) < 1e-12 * self.speed) | (g == 0)
+        return np.where(near, 0.0, self.route.mass * v / np.where(near, 1.0, g) - \
+                        self.residue / np.where(near, 1.0, deviation))
+
+    #*------------------------------------------------------------------------------
+    #*- the exit speeds of the segments entered at v_in and their derivatives by
+    #*- v_in. With v_out = v_s + (v_in - v_s) * exp(u), u solves
+    #*-     c * u + integral of the remainder from v_in to v_out = length
+    #*- by Newton steps from the exponential approach u = length / c.
+    #*------------------------------------------------------------------------------
+    def get_exit_speed(self, v_in):
+        deviation = v_in - self.speed
+        steady = ~self.moving | (np.abs(deviation) < 1e-9)
+        u = self.route.length / self.residue
+        for _ in range(0, NEWTON_STEPS):
+            v_out = self.speed + deviation * np.exp(u)
+            error = self.residue * u + self.integrate(self.remainder, v_in, v_out) - self.route.length
+            g_out = self.get_force(v_out)
+            near = steady | (np.abs(v_out - self.speed) < 1e-9) | (g_out == 0)
+            step = error / np.where(near, self.residue, self.route.mass * v_out * (v_out - self.speed) / \
+                                    np.where(near, 1.0, g_out))
+            u = np.clip(u - step, -60.0, 0.0)
+        v_out = self.speed + deviation * np.exp(u)
+        g_in = self.get_force(v_in)
+        g_out = self.get_force(v_out)
+        near = steady | (g_in == 0)
+        derivative = np.where(near, np.exp(self.route.length / self.residue), \
+                              v_in * g_out / (v_out * np.where(near, 1.0, g_in)))
+        v_out = np.where(self.moving, v_out, MIN_SPEED)
+        return v_out, np.where(self.moving, derivative, 0.0)
+
+    #*------------------------------------------------------------------------------
+    #*- seconds to ride the segments from v_in to v_out
+    #*-     time = length / v_s + (m / v_s) * integral of (v_s - v) / g(v) dv
+    #*- smooth through v_s where (v_s - v) / g(v) tends to -1 / g'(v_s)
+    #*------------------------------------------------------------------------------
+    def get_time(self, v_in, v_out):
+        def excess(v, g):
+            near = np.abs(g) < 1e-9
+            return np.where(near, -self.residue / (self.route.mass * self.speed), \
+                            (self.speed - v) / np.where(near, 1.0, g))
+        seconds = (self.route.length + self.route.mass * self.integrate(excess, v_in, v_out)) / self.speed
+        return np.where(self.moving, seconds, self.route.length / MIN_SPEED)
+
+class Route:
+
+    def __init__(self, length, grade, heading = 0.0, mass = 80.0, roll_v = ROLL_V):
+        self.length = np.asarray(length, dtype = np.float64)
+        self.grade = np.broadcast_to(np.asarray(grade, dtype = np.float64), self.length.shape)
+        self.heading = np.broadcast_to(np.asarray(heading, dtype = np.float64), self.length.shape)
+        self.mass = mass
+        self.roll_v = roll_v
+        self.other_resistance = (roll_v + self.grade / 100.0) * mass * G_ACCEL
+
+    def __len__(self):
+        return self.length.size
+
+    #*------------------------------------------------------------------------------
+    #*- return the RouteTimes of a power plan (watts, a scalar or one per segment)
+    #*- wind_mag in m/s, wind_deg the bearing the wind comes from (scalars or per
+    #*- segment). With kinetic the speed carries over between segments starting
+    #*- from start_speed (m/s, the first steady speed when None).
+    #*------------------------------------------------------------------------------
+    def simulate(self, power, K_A, wind_mag = 0.0, wind_deg = 0.0, kinetic = False, start_speed = None, \
+                 passes = PASSES):
+        power = np.broadcast_to(np.asarray(power, dtype = np.float64), self.length.shape)
+        speed, _, converged = calc_velocity.calc_velocity_array(K_A, wind_mag, wind_deg, self.other_resistance, \
+                                                                power, self.heading, tolerance = 1e-6)
+        converged = converged & (speed >= MIN_SPEED)
+        speed = np.where(converged, speed, MIN_SPEED)
+        if (not kinetic or self.length.size == 0):
+            return RouteTimes(self.length, speed, speed, speed, self.length / speed, converged)
+
+        dynamics = SegmentDynamics(self, speed, converged, EFFICIENCY * power, K_A, wind_mag, wind_deg)
+        start = speed[0] if start_speed is None else max(start_speed, MIN_SPEED)
+
+        # exponential approach to the steady speed to start, then Newton steps on the recurrence
+        a = np.where(converged, np.exp(self.length / dynamics.residue), 0.0)
+        b = (1.0 - a) * speed
+        for p in range(0, passes + 1):
+            a, b = scan_affine(a, b)
+            exit_speed = np.maximum(a * start + b, MIN_SPEED)
+            entry_speed = np.concatenate(([start], exit_speed[:-1]))
+            if (p == passes):
+                break
+            exit_speed, a = dynamics.get_exit_speed(entry_speed)
+            b = exit_speed - a * entry_speed
+        seconds = dynamics.get_time(entry_speed, exit_speed)
+        return RouteTimes(self.length, speed, entry_speed, exit_speed, seconds, converged)
+
+#*-- integrate m * v * dv/dx = g(v) over each segment with RK4 steps of at most step m and return
+#*-- the segment times and exit speeds, for the tests
+def integrate_route(route, power, K_A, wind_mag = 0.0, wind_deg = 0.0, start_speed = MIN_SPEED, step = 1.0):
+    def g(v, index):
+        relative = math.radians(wind_deg - route.heading[index])
+        head = v + wind_mag * math.cos(relative)
+        app = math.hypot(head, wind_mag * math.sin(relative))
+        W_A = head * head * head / app if app > 0 else 0.0
+        return (EFFICIENCY * power[index] / v - K_A * W_A - route.other_resistance[index]) / (route.mass * v)
+
+    v = start_speed
+    segment_times = []
+    exit_speeds = []
+    for index in range(0, len(route)):
+        steps = max(1, int(math.ceil(route.length[index] / step)))
+        h = route.length[index] / steps
+        t = 0.0
+        for _ in range(0, steps):
+            k1 = g(v, index)
+            k2 = g(v + 0.5 * h * k1, index)
+            k3 = g(v + 0.5 * h * k2, index)
+            k4 = g(v + h * k3, index)
+            v_next = v + h * (k1 + 2 * k2 + 2 * k3 + k4) / 6.0
+            t += h * 0.5 * (1.0 / v + 1.0 / v_next)
+            v = v_next
+        segment_times.append(t)
+        exit_speeds.append(v)
+    return np.array(segment_times), np.array(exit_speeds)
+
+def test_route():
+    K_A = 0.5 * 0.388 * (1.293 - 0.00426 * 25)
+    MASS = 80
+
+    # steady speeds against the scalar solver, as in calc_velocity.test_cases
+    route = Route([1000, 1000, 1000], [0, 7, -3], [0, 90, 180], MASS)
+    result = route.simulate(200, K_A, 2.8, 0)
+    for i in range(0, 3):
+        expected = calc_velocity.calc_velocity(K_A, 2.8, 0, route.other_resistance[i], 200, route.heading[i])
+        assert abs(result.speed[i] - expected) < 0.1, "1: Expected vel: " + str(expected) + " " + str(result.speed[i])
+    assert abs(result.total_time - np.sum(1000 / result.speed)) < 1e-9, "2: Expected total time"
+    assert np.allclose(result.splits, np.cumsum(result.time)) and result.distance[-1] == 3000, "3: Splits"
+
+    # a rolling route with kinetic energy carry over against an RK4 integration
+    rng = np.random.default_rng(11)
+    n = 60
+    length = rng.uniform(20, 400, n)
+    grade = np.clip(np.cumsum(rng.normal(0, 2, n)), -8, 10)
+    route = Route(length, grade, rng.uniform(0, 360, n), MASS)
+    power = rng.uniform(120, 320, n)
+    result = route.simulate(power, K_A, 3.0, 45, kinetic = True, start_speed = 5.0)
+    times, exit_speed = integrate_route(route, power, K_A, 3.0, 45, start_speed = 5.0)
+    error = abs(result.total_time - times.sum()) / times.sum()
+    assert error < 1e-4, "4: Total time " + str(result.total_time) + " " + str(times.sum())
+    assert np.max(np.abs(result.time - times) / times) < 0.002, "5: Segment times"
+    assert np.max(np.abs(result.exit_speed - exit_speed)) < 1e-4, "6: Exit speeds"
+    steady = route.simulate(power, K_A, 3.0, 45)
+    assert abs(steady.total_time - times.sum()) > abs(result.total_time - times.sum()), "7: Expected carry over"
+
+    # long segments reach the steady speed
+    route = Route([5000, 5000], [5, 0], 0, MASS)
+    result = route.simulate(250, K_A, kinetic = True, start_speed = 15.0)
+    assert abs(result.exit_speed[0] - result.speed[0]) < 1e-3, "8: Expected steady speed"
+    assert result.entry_speed[1] == result.exit_speed[0], "9: Expected carry over"
+
+    # no power up a climb is walked
+    result = Route([100, 100], [15, 0], 0, MASS).simulate([0, 200], K_A, kinetic = True)
+    assert not result.converged[0] and result.time[0] == 100 / MIN_SPEED, "10: Expected walking " + str(result.time)
+    assert result.converged[1] and result.exit_speed[1] > result.entry_speed[1], "11: Expected acceleration"
+
+    # 100k segments, the time is tracked by the workload.route_simulator benchmark
+    n = 100000
+    route = Route(rng.uniform(10, 100, n), np.clip(np.cumsum(rng.normal(0, 0.5, n)), -10, 12), \
+                  rng.uniform(0, 360, n), MASS)
+    result = route.simulate(rng.uniform(100, 350, n), K_A, 3.0, 200, kinetic = True)
+    assert np.all(np.isfinite(result.time)) and np.all(result.time > 0), "12: Expected finite times"
+
+if __name__ == "__main__":
+    test_route()
@@ -0,0 +1,367 @@
+#
+# Monte Carlo stopping distance
+# Copyright (c) 2020 Manu Konchady
+#
+# Propagates the uncertainty of the braking parameters to the stopping distance and time. Each
+# parameter is a constant or a distribution of numpy's Generator:
+#
+#   C_SF           coefficient of static friction of the rear tire   ('normal', 0.7, 0.05)
+#   com_height     height of the center of mass (m)                  ('normal', 1.15, 0.05)
+#   rider_mass     (kgs.)                                            ('normal', 70, 10)
+#   reaction_time  perception-reaction time before braking (s)       ('triangular', 0.5, 1.0, 2.5)
+#
+# A sample brakes with the closed form of get_exact_stop after riding reaction_time seconds at
+# V_BIKE, past the point where a tail wind overtakes the bike with get_overtaken_stops. The samples
+# are drawn and evaluated in shards of SHARD_SIZE on a process pool, every shard has its own seed
+# spawned from seed, so the results do not depend on the number of processes. A shard returns
+# running aggregates (count, mean, variance and a log spaced histogram for the percentiles) that
+# are merged in shard order, the samples themselves are never kept.
+#
+#   result = stopping_monte_carlo.monte_carlo_stopping(40, GRADE = -5, samples = 1000000)
+#   result.percentiles('distance')
+#   result.exceedance('distance')
+#
+import collections
+import concurrent.futures
+import math
+import numbers
+import os
+import numpy as np
+import calc_stopping_distance
+import common
+import moments
+
+SHARD_SIZE = 1 << 16        # samples per shard
+PERCENTILES = (5, 50, 95, 99)
+HISTOGRAM_LOW = 1e-3        # lower edge of the histogram, smaller values share the first bin
+BINS_PER_DECADE = 1000      # percentiles are within 0.25% of the sample percentiles
+DECADES = 7
+DISTRIBUTIONS = ('normal', 'uniform', 'triangular', 'lognormal')
+QUANTITIES = ('distance', 'time', 'braking_distance', 'aashto_distance')
+
+PARAMETERS = dict(C_SF = ('normal', 0.7, 0.05), com_height = ('normal', 1.15, 0.05), \
+                  rider_mass = ('normal', 70, 10), reaction_time = ('triangular', 0.5, 1.0, 2.5))
+
+#*-- size samples of a constant or a (distribution, args...) tuple
+def draw(rng, spec, size):
+    if (isinstance(spec, numbers.Real)):
+        return np.full(size, float(spec))
+    name = spec[0]
+    if (name not in DISTRIBUTIONS):
+        raise ValueError("Unknown distribution " + repr(name) + ", expected one of " + str(DISTRIBUTIONS))
+    return getattr(rng, name)(*spec[1:], size = size)
+
+#*-- a dict of samples per parameter, drawn in the order of PARAMETERS
+def sample_parameters(rng, parameters, size):
+    return dict((name, draw(rng, parameters[name], size)) for name in PARAMETERS)
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- Mergeable aggregates of a stream of values: count, mean and the sum of squared deviations
+#*-- (Chan et al.), the extremes, counts above each threshold and a histogram with BINS_PER_DECADE
+#*-- log spaced bins from HISTOGRAM_LOW, with an underflow and an overflow bin.
+#*-----------------------------------------------------------------------------------------------------
+class RunningStats:
+
+    edges = HISTOGRAM_LOW * 10.0 ** (np.arange(BINS_PER_DECADE * DECADES + 1) / BINS_PER_DECADE)
+
+    def __init__(self, thresholds = ()):
+        self.thresholds = tuple(thresholds)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.exceed = np.zeros(len(self.thresholds), dtype = np.int64)
+        self.bins = np.zeros(len(self.edges) + 1, dtype = np.int64)
+
+    def add(self, values):
+        values = np.asarray(values, dtype = np.float64).ravel()
+        if (values.size == 0):
+            return
+        other = RunningStats(self.thresholds)
+        other.count = values.size
+        other.mean = float(values.mean())
+        other.m2 = float(np.sum((values - other.mean) ** 2))
+        other.minimum = float(values.min())
+        other.maximum = float(values.max())
+        other.exceed = np.array([np.count_nonzero(values > threshold) for threshold in self.thresholds], \
+                                dtype = np.int64)
+        other.bins = np.bincount(np.searchsorted(self.edges, values, side = 'right'), minlength = len(self.bins))
+        self.merge(other)
+
+    def merge(self, other):
+        if (other.thresholds != self.thresholds):
+            raise ValueError("Cannot merge aggregates with different thresholds")
+        count = self.count + other.count
+        if (other.count == 0):
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.exceed += other.exceed
+        self.bins += other.bins
+        return self
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    #*-- the q-th percentile, interpolated linearly within its histogram bin
+    def percentile(self, q):
+        if (self.count == 0):
+            return math.nan
+        rank = q / 100.0 * self.count
+        cumulative = np.cumsum(self.bins)
+        index = min(int(np.searchsorted(cumulative, rank, side = 'left')), len(self.bins) - 1)
+        below = cumulative[index] - self.bins[index]
+        low = self.edges[index - 1] if index > 0 else self.minimum
+        high = self.edges[index] if index < len(self.edges) else self.maximum
+        low = min(max(low, self.minimum), self.maximum)
+        high = min(max(high, self.minimum), self.maximum)
+        fraction = (rank - below) / self.bins[index] if self.bins[index] > 0 else 0.0
+        return float(low + (high - low) * min(max(fraction, 0.0), 1.0))
+
+    #*-- fraction of the values above each threshold
+    def exceedance(self):
+        return dict((threshold, int(count) / self.count if self.count else math.nan) \
+                    for threshold, count in zip(self.thresholds, self.exceed))
+
+    def to_dict(self, percentiles = PERCENTILES):
+        return dict(count = self.count, mean = self.mean, std = self.std, min = self.minimum, max = self.maximum, \
+                    percentiles = dict((q, self.percentile(q)) for q in percentiles), exceedance = self.exceedance())
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- stopping distance (m) and time (s) of each sample, V_BIKE and V_WIND in kmph., GRADE in percent.
+#*-- Returns the total and braking distance, the total time, the AASHTO distance of dist3 with f =
+#*-- C_SF and a mask of the samples that stop. A sample does not stop when the rear brake slips or
+#*-- the drag forces are negative, its values are nan.
+#*-----------------------------------------------------------------------------------------------------
+def evaluate(V_BIKE, V_WIND, GRADE, G_FRAC, rear_frac, samples, config = None):
+    if (config is None):
+        config = calc_stopping_distance.default_config()
+    C_SF = samples['C_SF']
+    com_height = samples['com_height']
+    reaction_time = samples['reaction_time']
+    total_mass = samples['rider_mass'] + config.bicycle_mass
+    total_wt = total_mass * calc_stopping_distance.G_ACCEL
+    K_A = config.K_A
+
+    # velocity independent terms of Braking for every sample
+    cos_theta = 1.0 - GRADE / 100.0
+    f_nf, f_nr = moments.get_normal_forces_1(config.wheel_base, config.rear_crank_distance, com_height, \
+                                             total_mass * cos_theta, G_FRAC)
+    valid = ~(G_FRAC * calc_stopping_distance.G_ACCEL * rear_frac * total_mass > C_SF * f_nr)
+    constant_res = (G_FRAC + GRADE / 100.0) * total_wt + config.roll_v * total_wt
+    v_wind = common.meter_per_second(V_WIND)
+    u0 = common.meter_per_second(V_BIKE) + v_wind
+    u1 = common.meter_per_second(1.0) + v_wind
+
+    if (V_BIKE <= 1.0):
+        braking_distance = np.zeros(C_SF.shape)
+        braking_time = np.zeros(C_SF.shape)
+    elif (u1 < 0):
+        # a tail wind overtakes the bike, the air pushes it once the air speed changes sign
+        valid &= (constant_res > 0) & (constant_res - K_A * u1 * u1 > 0)
+        C = np.where(valid, constant_res, 1.0)
+        braking_distance, braking_time = calc_stopping_distance.get_overtaken_stops(u0, u1, v_wind, C, K_A, \
+                                                                                    total_mass)
+    else:
+        valid &= constant_res + K_A * u1 * u1 > 0
+        C = np.where(valid, constant_res, 1.0)
+        braking_distance, braking_time = calc_stopping_distance.get_exact_stops(u0, u1, v_wind, C, K_A, total_mass)
+
+    braking_distance = np.where(valid, braking_distance, np.nan)
+    distance = common.meter_per_second(V_BIKE) * reaction_time + braking_distance
+    time = reaction_time + np.where(valid, braking_time, np.nan)
+    aashto_distance = calc_stopping_distance.dist3(reaction_time, V_BIKE, GRADE, C_SF)
+    return dict(distance = distance, time = time, braking_distance = braking_distance, \
+                aashto_distance = aashto_distance), valid
+
+#*-- draw and evaluate the samples of one shard, return the aggregates and the number of samples that do not stop
+def run_shard(seed, size, scenario, parameters, thresholds, config):
+    samples = sample_parameters(np.random.default_rng(seed), parameters, size)
+    values, valid = evaluate(*scenario, samples, config = config)
+    aggregates = {}
+    for name in QUANTITIES:
+        aggregates[name] = RunningStats(thresholds.get(name, ()))
+        aggregates[name].add(values[name][valid])
+    return aggregates, size - int(np.count_nonzero(valid))
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- Aggregates per quantity of QUANTITIES over the samples that stop. slips is the number of samples
+#*-- where the rear brake slips or the bike does not stop.
+#*-----------------------------------------------------------------------------------------------------
+class StoppingUncertainty:
+
+    def __init__(self, samples, slips, aggregates):
+        self.samples = samples
+        self.slips = slips
+        self.aggregates = aggregates
+
+    @property
+    def slip_probability(self):
+        return self.slips / self.samples
+
+    def percentiles(self, quantity = 'distance', percentiles = PERCENTILES):
+        return dict((q, self.aggregates[quantity].percentile(q)) for q in percentiles)
+
+    #*-- probability of exceeding each threshold among the samples that stop
+    def exceedance(self, quantity = 'distance'):
+        return self.aggregates[quantity].exceedance()
+
+    def to_dict(self, percentiles = PERCENTILES):
+        return dict(samples = self.samples, slips = self.slips, slip_probability = self.slip_probability, \
+                    **dict((name, stats.to_dict(percentiles)) for name, stats in self.aggregates.items()))
+
+#*-----------------------------------------------------------------------------------------------------
+#*-- Monte Carlo stopping distance and time from V_BIKE (kmph) braking at G_FRAC with rear_frac on the
+#*-- rear brake. parameters updates PARAMETERS, thresholds maps a quantity to the values whose
+#*-- exceedance probabilities are counted (by default 10 m steps for the distances and 1 s steps for
+#*-- the time). processes = 0 runs the shards in this process, None uses a process per cpu.
+#*-----------------------------------------------------------------------------------------------------
+def monte_carlo_stopping(V_BIKE, V_WIND = 0, GRADE = 0, G_FRAC = 0.3, samples = 100000, parameters = None, \
+                         rear_frac = 0.3, thresholds = None, seed = 0, processes = None, shard_size = SHARD_SIZE, \
+                         config = None):
+    if (samples <= 0):
+        raise ValueError("Expected a positive number of samples, got " + str(samples))
+    if (config is None):
+        config = calc_stopping_distance.default_config()
+    spec = dict(PARAMETERS)
+    spec.update(parameters or {})
+    unknown = set(spec) - set(PARAMETERS)
+    if (unknown):
+        raise ValueError("Unknown parameters " + str(sorted(unknown)))
+    if (thresholds is None):
+        distances = tuple(range(10, 110, 10))
+        thresholds = dict(distance = distances, braking_distance = distances, aashto_distance = distances, \
+                          time = tuple(range(1, 11)))
+    scenario = (V_BIKE, V_WIND, GRADE, G_FRAC, rear_frac)
+    shards = (samples + shard_size - 1) // shard_size
+    seeds = np.random.SeedSequence(seed).spawn(shards)
+    tasks = [(seeds[i], min(shard_size, samples - i * shard_size), scenario, spec, thresholds, config) \
+             for i in range(shards)]
+
+    aggregates = dict((name, RunningStats(thresholds.get(name, ()))) for name in QUANTITIES)
+    slips = 0
+    def merge(result):
+        nonlocal slips
+        for name, stats in result[0].items():
+            aggregates[name].merge(stats)
+        slips += result[1]
+
+    if (processes == 0 or shards <= 1):
+        for task in tasks:
+            merge(run_shard(*task))
+    else:
+        processes = min(processes or os.cpu_count() or 1, shards)
+        # keep a few shards per process in flight and merge in shard order, so the sums do not
+        # depend on which process finishes first
+        with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(executor.submit(run_shard, *task))
+                if (len(pending) >= 2 * processes):
+                    merge(pending.popleft().result())
+            while (pending):
+                merge(pending.popleft().result())
+    return StoppingUncertainty(samples, slips, aggregates)
+
+def test_aggregates():
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(3.0, 0.5, 100000)
+    whole = RunningStats((10, 20, 40))
+    whole.add(values)
+    merged = RunningStats((10, 20, 40))
+    for part in np.array_split(values, 7):
+        part_stats = RunningStats((10, 20, 40))
+        part_stats.add(part)
+        merged.merge(part_stats)
+    for stats in (whole, merged):
+        assert stats.count == values.size, "1: Count " + str(stats.count)
+        assert abs(stats.mean - values.mean()) < 1e-9 * values.mean(), "2: Mean " + str(stats.mean)
+        assert abs(stats.std - values.std(ddof = 1)) < 1e-9 * values.std(), "3: Std " + str(stats.std)
+        for q in (0, 1, 50, 99, 100):
+            expected = np.percentile(values, q)
+            assert abs(stats.percentile(q) - expected) < 0.0025 * expected, "4: Percentile " + str(q)
+        for threshold, probability in stats.exceedance().items():
+            assert probability == np.mean(values > threshold), "5: Exceedance " + str(threshold)
+    assert np.array_equal(whole.bins, merged.bins), "6: Histogram"
+
+def test_samples():
+    # the vectorized samples against get_exact_stop for each sample, and RK45 with a tail wind
+    rng = np.random.default_rng(2)
+    parameters = dict(PARAMETERS, C_SF = ('uniform', 0.4, 0.8))
+    samples = sample_parameters(rng, parameters, 200)
+    config = calc_stopping_distance.default_config()
+    for V_WIND, GRADE, G_FRAC in ((0, 0, 0.3), (10, -5, 0.35), (-10, 0, 0.3), (-40, -3, 0.25)):
+        values, valid = evaluate(30, V_WIND, GRADE, G_FRAC, 0.3, samples)
+        assert 0 < np.count_nonzero(valid) and (G_FRAC < 0.35 or not valid.all()), "1: Slips " + str(G_FRAC)
+        for i in range(0, 200, 7):
+            sample_config = config.replace(com_height = samples['com_height'][i], \
+                                           rider_mass = samples['rider_mass'][i])
+            if (V_WIND < 0):
+                trajectory = calc_stopping_distance.get_trajectory(30, V_WIND, GRADE, G_FRAC, 0.3, samples['C_SF'][i], \
+                                                                   tolerance = 1e-10, config = sample_config)
+                expected = (-1, -1) if trajectory is None else (trajectory.stop_dist, trajectory.stop_time)
+            else:
+                expected = calc_stopping_distance.get_exact_stop(30, V_WIND, GRADE, G_FRAC, 0.3, samples['C_SF'][i], \
+                                                                 config = sample_config)
+            if (expected[0] == -1):
+                assert not valid[i], "2: Expected slip " + str(i)
+                continue
+            reaction = common.meter_per_second(30) * samples['reaction_time'][i]
+            assert abs(values['braking_distance'][i] - expected[0]) < 1e-7, "3: Braking distance " + str(i)
+            assert abs(values['distance'][i] - reaction - expected[0]) < 1e-7, "4: Distance " + str(i)
+            assert abs(values['time'][i] - samples['reaction_time'][i] - expected[1]) < 1e-7, "5: Time " + str(i)
+            aashto = calc_stopping_distance.dist3(samples['reaction_time'][i], 30, GRADE, samples['C_SF'][i])
+            assert abs(values['aashto_distance'][i] - aashto) < 1e-9, "6: AASHTO " + str(i)
+
+def test_monte_carlo():
+    # the same shards give the same aggregates inline and on a pool
+    args = dict(V_BIKE = 40, GRADE = -5, G_FRAC = 0.35, samples = 50000, shard_size = 8192, seed = 7)
+    inline = monte_carlo_stopping(processes = 0, **args).to_dict()
+    pooled = monte_carlo_stopping(processes = 2, **args).to_dict()
+    assert inline == pooled, "1: Expected the same results inline and on a pool"
+    assert inline['samples'] == 50000 and 0 < inline['slips'] < 50000, "2: Slips " + str(inline['slips'])
+    stopped = inline['distance']['count']
+    assert stopped + inline['slips'] == 50000, "3: Count " + str(stopped)
+    assert inline != monte_carlo_stopping(processes = 0, **dict(args, seed = 8)).to_dict(), "4: Seed"
+
+    # the shards together draw the samples of their seeds
+    seeds = np.random.SeedSequence(7).spawn(7)
+    distances = []
+    for i, seed in enumerate(seeds):
+        samples = sample_parameters(np.random.default_rng(seed), PARAMETERS, min(8192, 50000 - i * 8192))
+        values, valid = evaluate(40, 0, -5, 0.35, 0.3, samples)
+        distances.append(values['distance'][valid])
+    distances = np.concatenate(distances)
+    assert distances.size == stopped, "5: Stopped " + str(distances.size)
+    assert abs(inline['distance']['mean'] - distances.mean()) < 1e-9, "6: Mean"
+    for q, value in inline['distance']['percentiles'].items():
+        assert abs(value - np.percentile(distances, q)) < 0.0025 * value, "7: Percentile " + str(q)
+    for threshold, probability in inline['distance']['exceedance'].items():
+        assert probability == np.mean(distances > threshold), "8: Exceedance " + str(threshold)
+
+    # constant parameters
+    result = monte_carlo_stopping(30, samples = 1000, processes = 0, parameters = dict(C_SF = 0.7, com_height = 1.15, \
+                                  rider_mass = 70, reaction_time = 1.0))
+    expected = calc_stopping_distance.get_exact_stop(30, 0, 0, 0.3, 0.3)
+    assert result.slips == 0 and result.aggregates['distance'].std < 1e-9, "9: Constant"
+    assert abs(result.percentiles()[50] - expected[0] - 30 / 3.6) < 1e-6, "10: Constant distance"
+    result = monte_carlo_stopping(30, samples = 10, processes = 0, parameters = dict(rider_mass = np.float32(70), \
+                                  C_SF = np.int64(1)))
+    assert result.slips == 0 and result.aggregates['distance'].count == 10, "11: numpy constants"
+    for kwargs in (dict(parameters = dict(C_SF = ('beta', 1, 1))), dict(samples = 0)):
+        try:
+            monte_carlo_stopping(30, **dict(dict(samples = 10), **kwargs))
+            assert False, "12: Expected ValueError " + str(kwargs)
+        except ValueError:
+            pass
+
+if __name__ == "__main__":
+    test_aggregates()
+    test_samples()
+    test_monte_carlo()
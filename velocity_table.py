@@ -0,0 +1,172 @@
+import math
+import os
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import calc_velocity
+
+# Velocity lookup tables
+#
+# Solve calc_velocity once over a grid of power x grade x head wind for one rider profile
+# (K_A, mass and rolling resistance) and answer later queries by multilinear interpolation.
+# Power in watts, grade in percent, head wind in kmph (negative for a tail wind), velocity in m/s.
+#
+
+G_ACCEL = 9.81
+ROLL_V = 0.005
+
+# default grid, dashboards ask for power 50-600 W, grade -10 to 15 %, and wind 0-40 kmph
+POWERS = np.linspace(50, 600, 56)
+GRADES = np.linspace(-10, 15, 51)
+WINDS = np.linspace(0, 40, 21)
+
+#*-- solve the steady state velocity for broadcast power, grade and head wind arrays
+def solve_velocity(K_A, mass, roll_v, power, grade, wind):
+    power, grade, wind = np.broadcast_arrays(power, grade, wind)
+    other_resistance = (roll_v + grade / 100.0) * mass * G_ACCEL
+    wind_mag = np.abs(wind) * 0.2777777777777777778
+    wind_deg = np.where(wind < 0, 180, 0)
+    return calc_velocity.calc_velocity_array(K_A, wind_mag, wind_deg, other_resistance, power, tolerance = 1e-6)[0]
+
+#*-- return the file name key for a rider profile
+def table_key(K_A, mass, roll_v):
+    return "velocity_%.6f_%.3f_%.6f" % (K_A, mass, roll_v)
+
+class VelocityTable:
+
+    def __init__(self, K_A, mass, roll_v, powers, grades, winds, velocity, max_error):
+        self.K_A = K_A
+        self.mass = mass
+        self.roll_v = roll_v
+        self.axes = (np.asarray(powers, dtype = np.float64), np.asarray(grades, dtype = np.float64), \
+                     np.asarray(winds, dtype = np.float64))
+        self.velocity = np.asarray(velocity, dtype = np.float64)
+        self.max_error = max_error  # estimate of the largest error in m/s, see build
+
+    #*--------------------------------------------------------------------------------
+    #*- build a table for a rider profile. The error is estimated at the center, the
+    #*- face centers and the edge midpoints of each cell, where the error of multilinear
+    #*- interpolation is usually the largest. It is sampled, not a bound.
+    #*--------------------------------------------------------------------------------
+    @classmethod
+    def build(cls, K_A, mass, roll_v = ROLL_V, powers = POWERS, grades = GRADES, winds = WINDS):
+        p, gr, w = np.meshgrid(powers, grades, winds, indexing = 'ij')
+        velocity = solve_velocity(K_A, mass, roll_v, p, gr, w)
+        table = cls(K_A, mass, roll_v, powers, grades, winds, velocity, 0.0)
+
+        # each axis refined with the midpoints of its intervals, the grid points are exact
+        refined = [np.sort(np.concatenate((axis, 0.5 * (axis[1:] + axis[:-1])))) for axis in table.axes]
+        p, gr, w = np.meshgrid(*refined, indexing = 'ij')
+        exact = solve_velocity(K_A, mass, roll_v, p, gr, w)
+        table.max_error = float(np.nanmax(np.abs(table.lookup(p, gr, w) - exact)))
+        return table
+
+    #*--------------------------------------------------------------------------------
+    #*- interpolate the velocity for power, grade and head wind arrays (or scalars)
+    #*- queries outside the grid return nan
+    #*--------------------------------------------------------------------------------
+    def lookup(self, power, grade, wind):
+        points = np.broadcast_arrays(*[np.asarray(x, dtype = np.float64) for x in (power, grade, wind)])
+        shape = points[0].shape
+        outside = np.zeros(shape, dtype = bool)
+        indices = []
+        weights = []
+        for axis, x in zip(self.axes, points):
+            outside |= (x < axis[0]) | (x > axis[-1])
+            i = np.clip(np.searchsorted(axis, x, side = 'right') - 1, 0, axis.size - 2)
+            indices.append(i)
+            weights.append(np.clip((x - axis[i]) / (axis[i + 1] - axis[i]), 0.0, 1.0))
+
+        # weighted sum over the 8 corners of the cell
+        velocity = np.zeros(shape)
+        for corner in range(0, 8):
+            weight = np.ones(shape)
+            index = []
+            for d in range(0, 3):
+                bit = (corner >> d) & 1
+                weight = weight * (weights[d] if bit else 1.0 - weights[d])
+                index.append(indices[d] + bit)
+            velocity += weight * self.velocity[tuple(index)]
+        return np.where(outside, np.nan, velocity)
+
+    def save(self, file_name):
+        np.savez(file_name, K_A = self.K_A, mass = self.mass, roll_v = self.roll_v, powers = self.axes[0], \
+                 grades = self.axes[1], winds = self.axes[2], velocity = self.velocity, max_error = self.max_error)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            return cls(float(data['K_A']), float(data['mass']), float(data['roll_v']), data['powers'], \
+                       data['grades'], data['winds'], data['velocity'], float(data['max_error']))
+
+#*--------------------------------------------------------------------------------
+#*- keep the tables of several rider profiles in memory, evicting the least recently
+#*- used table beyond max_tables. Tables are read from and written to the directory
+#*- when one is given.
+#*--------------------------------------------------------------------------------
+class VelocityTableCache:
+
+    def __init__(self, max_tables = 4, directory = None):
+        self.max_tables = max_tables
+        self.directory = directory
+        self.tables = OrderedDict()
+
+    def get(self, K_A, mass, roll_v = ROLL_V):
+        key = table_key(K_A, mass, roll_v)
+        if (key in self.tables):
+            self.tables.move_to_end(key)
+            return self.tables[key]
+
+        file_name = None
+        if (self.directory is not None):
+            file_name = os.path.join(self.directory, key + ".npz")
+        if (file_name is not None and os.path.exists(file_name)):
+            table = VelocityTable.load(file_name)
+        else:
+            table = VelocityTable.build(K_A, mass, roll_v)
+            if (file_name is not None):
+                table.save(file_name)
+
+        self.tables[key] = table
+        if (len(self.tables) > self.max_tables):
+            self.tables.popitem(last = False)
+        return table
+
+    def lookup(self, K_A, mass, power, grade, wind, roll_v = ROLL_V):
+        return self.get(K_A, mass, roll_v).lookup(power, grade, wind)
+
+def test_table():
+    DENSITY = 1.293 - 0.00426 * 25
+    K_A = 0.5 * 0.388 * DENSITY
+    TOTAL_MASS = 80
+
+    table = VelocityTable.build(K_A, TOTAL_MASS)
+    assert table.max_error < 0.05, "1: Error estimate " + str(table.max_error)
+
+    # grid points are exact, random points are within the estimate
+    velocity = table.lookup(200, 0, 0)
+    expected = calc_velocity.calc_velocity_exact(K_A, 0, 0, ROLL_V * TOTAL_MASS * G_ACCEL, 200)
+    assert abs(velocity - expected) < 1e-6, "2: Expected vel: " + str(expected) + " " + str(velocity)
+    rng = np.random.default_rng(1)
+    power = rng.uniform(50, 600, 1000)
+    grade = rng.uniform(-10, 15, 1000)
+    wind = rng.uniform(0, 40, 1000)
+    error = np.abs(table.lookup(power, grade, wind) - solve_velocity(K_A, TOTAL_MASS, ROLL_V, power, grade, wind))
+    assert error.max() <= table.max_error + 1e-9, "3: Error " + str(error.max()) + " above " + str(table.max_error)
+    assert math.isnan(table.lookup(700, 0, 0)), "4: Expected nan outside the grid"
+
+    # persistence and eviction
+    with tempfile.TemporaryDirectory() as directory:
+        cache = VelocityTableCache(max_tables = 2, directory = directory)
+        first = cache.get(K_A, TOTAL_MASS)
+        assert os.path.exists(os.path.join(directory, table_key(K_A, TOTAL_MASS, ROLL_V) + ".npz")), "5: Not saved"
+        cache.get(K_A, TOTAL_MASS + 10)
+        cache.get(K_A, TOTAL_MASS)
+        cache.get(K_A, TOTAL_MASS + 20)
+        assert list(cache.tables) == [table_key(K_A, TOTAL_MASS, ROLL_V), table_key(K_A, TOTAL_MASS + 20, ROLL_V)], \
+               "6: Expected the least recently used table to be evicted"
+        loaded = VelocityTableCache(directory = directory).get(K_A, TOTAL_MASS)
+        assert np.array_equal(loaded.velocity, first.velocity) and loaded.max_error == first.max_error, "7: Load"
+
+if __name__ == "__main__":
+    test_table()
@@ -0,0 +1,231 @@
+#
+# Field CdA and Crr estimation
+# Copyright (c) 2020 Manu Konchady
+#
+# Recover the drag area (C_D * A) and the rolling resistance coefficient from logged power,
+# speed and altitude with the virtual elevation (energy balance) method. Over an interval of
+# dt seconds at v m/s the wheel energy goes into potential and kinetic energy and the rolling
+# and air resistances of calc_power:
+#
+#   EFFICIENCY * P * dt = m g dh + m d(v^2) / 2 + Crr m g v dt + CdA rho / 2 * W_A * v dt
+#
+# where W_A is calc_wind.get_head_wind2 of the apparent wind (v^2 in still air). Divided by
+# m g every term is a height, so for the intervals of a segment (segment_time seconds)
+#
+#   sum(EFFICIENCY * P * dt / (m g) - dh - d(v^2) / (2 g)) = Crr * sum(v dt) + CdA * sum(rho W_A v dt / (2 m g))
+#
+# is one row of a linear regression whose residuals are the virtual elevation errors in meters.
+# Only the sums of the regression (X'X, X'y, y'y and counts) are kept, so a new ride updates the
+# estimate without refitting, and the statistics of separate runs are merged with +.
+#
+# Units as in ride_stream: time in seconds, speed in kmph, altitude in meters, power in watts.
+#
+import math
+import os
+import tempfile
+import numpy as np
+import calc_power
+import calc_wind
+import common
+import ride_stream
+
+G_ACCEL = 9.81
+SEGMENT_TIME = 60.0  # seconds of riding per regression row
+MAX_GAP = 10.0       # seconds, longer intervals (pauses, lost signal) are skipped
+
+#*----------------------------------------------------------------------------------------------
+#*- sufficient statistics of the regression of the segment heights y on the distance (Crr)
+#*- and air (CdA) columns
+#*----------------------------------------------------------------------------------------------
+class VirtualElevationStats:
+
+    def __init__(self, xtx = None, xty = None, yty = 0.0, segments = 0, rides = 0):
+        self.xtx = np.zeros((2, 2)) if xtx is None else np.array(xtx, dtype = np.float64)
+        self.xty = np.zeros(2) if xty is None else np.array(xty, dtype = np.float64)
+        self.yty = float(yty)
+        self.segments = int(segments)
+        self.rides = int(rides)
+
+    def add_rows(self, x, y):
+        self.xtx += x.T @ x
+        self.xty += x.T @ y
+        self.yty += float(y @ y)
+        self.segments += y.size
+
+    def __add__(self, other):
+        return VirtualElevationStats(self.xtx + other.xtx, self.xty + other.xty, self.yty + other.yty, \
+                                     self.segments + other.segments, self.rides + other.rides)
+
+    #*-- return (Crr, CdA, standard errors of both, rms virtual elevation error per segment in m)
+    def solve(self):
+        if (self.segments < 3 or np.linalg.det(self.xtx) <= 1e-12 * np.trace(self.xtx) ** 2):
+            return math.nan, math.nan, math.nan, math.nan, math.nan
+        inverse = np.linalg.inv(self.xtx)
+        beta = inverse @ self.xty
+        rss = max(self.yty - 2.0 * beta @ self.xty + beta @ self.xtx @ beta, 0.0)
+        sigma2 = rss / (self.segments - 2)
+        errors = np.sqrt(np.diag(inverse) * sigma2)
+        return float(beta[0]), float(beta[1]), float(errors[0]), float(errors[1]), math.sqrt(rss / self.segments)
+
+    def to_dict(self):
+        return dict(xtx = self.xtx.tolist(), xty = self.xty.tolist(), yty = self.yty, segments = self.segments, \
+                    rides = self.rides)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values["xtx"], values["xty"], values["yty"], values["segments"], values["rides"])
+
+#*----------------------------------------------------------------------------------------------
+#*- stream rides in chunks into the statistics. The last point of a chunk and the sums of the
+#*- unfinished segment are carried to the next chunk, end_ride closes the ride.
+#*----------------------------------------------------------------------------------------------
+class VirtualElevationEstimator:
+
+    def __init__(self, total_mass, stats = None, segment_time = SEGMENT_TIME, max_gap = MAX_GAP, \
+                 efficiency = calc_power.EFFICIENCY):
+        self.total_mass = total_mass
+        self.stats = VirtualElevationStats() if stats is None else stats
+        self.segment_time = segment_time
+        self.max_gap = max_gap
+        self.efficiency = efficiency
+        self.previous = None
+        self.end_ride()
+
+    #*------------------------------------------------------------------------------------------
+    #*- add the points of a ride, speed is the average over the interval ending at each point
+    #*- (as in ride_stream) and W_A the apparent head wind squared in (m/s)^2, v^2 if not given
+    #*------------------------------------------------------------------------------------------
+    def add(self, time, speed, altitude, power, density, W_A = None):
+        v = common.meter_per_second(np.asarray(speed, dtype = np.float64))
+        W_A = v * v if W_A is None else np.asarray(W_A, dtype = np.float64)
+        columns = [np.asarray(c, dtype = np.float64) for c in (time, v, altitude, power, density, W_A)]
+        if (self.previous is not None):
+            columns = [np.concatenate([[p], c]) for p, c in zip(self.previous, columns)]
+        time, v, altitude, power, density, W_A = columns
+        if (time.size == 0):
+            return
+        if (self.start is None):
+            self.start = time[0]
+        self.previous = [c[-1] for c in columns]
+        if (time.size < 2):
+            return
+
+        weight = self.total_mass * G_ACCEL
+        dt = np.diff(time)
+        distance = v[1:] * dt
+        y = self.efficiency * power[1:] * dt / weight - np.diff(altitude) - np.diff(v * v) / (2.0 * G_ACCEL)
+        air = density[1:] * W_A[1:] * distance / (2.0 * weight)
+        valid = (dt > 0) & (dt <= self.max_gap) & np.isfinite(y) & np.isfinite(air) & np.isfinite(distance)
+
+        # sum the intervals of each segment, the last one may continue in the next chunk
+        segment = np.floor((time[1:] - self.start) / self.segment_time).astype(np.int64)
+        first = min(segment[0], self.segment) if self.segment is not None else segment[0]
+        index = segment - first
+        sums = np.zeros((index[-1] + 1, 3))
+        for k, column in enumerate((distance, air, y)):
+            sums[:, k] = np.bincount(index[valid], column[valid], minlength = index[-1] + 1)
+        if (self.segment is not None):
+            sums[self.segment - first] += self.pending
+        self.add_segments(sums[:-1])
+        self.segment = first + index[-1]
+        self.pending = sums[-1]
+
+    #*-- add a chunk of ride_stream.stream_ride, wind as given to stream_ride
+    def add_chunk(self, chunk, wind_mag = 0.0, wind_bearing = 0.0, power_column = "measured_power"):
+        v_bike = common.meter_per_second(chunk["speed"])
+        _, W_A, _ = calc_wind.get_wind_components(v_bike, wind_mag, calc_wind.bearingToDegrees(wind_bearing), \
+                                                  calc_wind.bearingToDegrees(chunk["heading"]))
+        self.add(chunk["time"], chunk["speed"], chunk["altitude"], chunk[power_column], chunk["density"], W_A)
+
+    def add_segments(self, sums):
+        used = sums[:, 0] > 0
+        self.stats.add_rows(sums[used, :2], sums[used, 2])
+
+    #*-- close the current ride, its unfinished segment is added to the statistics
+    def end_ride(self):
+        if (self.previous is not None):
+            self.add_segments(self.pending[None, :])
+            self.stats.rides += 1
+        self.previous = None
+        self.start = None
+        self.segment = None
+        self.pending = np.zeros(3)
+
+    def add_ride(self, chunks, **options):
+        for chunk in chunks:
+            self.add_chunk(chunk, **options)
+        self.end_ride()
+
+    def solve(self):
+        return self.stats.solve()
+
+#*-- a synthetic ride with power from the energy balance, used by the tests
+def make_test_ride(rng, points, c_d_area, roll_v, total_mass, density = 1.2, noise = 0.0):
+    time = np.arange(0, points, 1.0)
+    speed = 25 + 10 * np.sin(time / 90.0) + rng.normal(0, 0.5, points)
+    grade = 4 * np.sin(time / 150.0 + rng.uniform(0, 6))
+    v = common.meter_per_second(speed)
+    altitude = 100 + np.cumsum(v * grade / 100.0)
+    power = np.zeros(points)
+    weight = total_mass * G_ACCEL
+    power[1:] = (weight * np.diff(altitude) + total_mass * np.diff(v * v) / 2.0 + \
+                 (roll_v * weight + 0.5 * c_d_area * density * v[1:] ** 2) * v[1:]) / calc_power.EFFICIENCY
+    return time, speed, altitude, power + rng.normal(0, noise, points), np.full(points, density)
+
+def test_estimator():
+    C_D_AREA = 0.32
+    ROLL_V = 0.0045
+    TOTAL_MASS = 78
+    rng = np.random.default_rng(4)
+    rides = [make_test_ride(rng, 3600, C_D_AREA, ROLL_V, TOTAL_MASS, noise = 20.0) for _ in range(0, 4)]
+
+    # one ride at a time in chunks, against all of the rides at once
+    estimator = VirtualElevationEstimator(TOTAL_MASS)
+    for ride in rides:
+        for i in range(0, 3600, 500):
+            estimator.add(*[column[i:i + 500] for column in ride])
+        estimator.end_ride()
+    crr, cda, crr_error, cda_error, rms = estimator.solve()
+    assert abs(cda - C_D_AREA) < 3 * cda_error + 1e-3 and abs(crr - ROLL_V) < 3 * crr_error + 1e-4, \
+           "1: Expected CdA and Crr " + str((cda, crr, cda_error, crr_error))
+    assert estimator.stats.rides == 4 and estimator.stats.segments == 4 * 60, "2: Segments " + \
+           str(estimator.stats.segments)
+    whole = VirtualElevationEstimator(TOTAL_MASS)
+    for ride in rides:
+        whole.add(*ride)
+        whole.end_ride()
+    assert np.allclose(whole.stats.xtx, estimator.stats.xtx) and np.allclose(whole.stats.xty, estimator.stats.xty), \
+           "3: Expected the same statistics"
+
+    # statistics of separate runs merge, and survive a round trip through a dict
+    first = VirtualElevationEstimator(TOTAL_MASS)
+    second = VirtualElevationEstimator(TOTAL_MASS)
+    for i, ride in enumerate(rides):
+        (first if i < 2 else second).add(*ride)
+        (first if i < 2 else second).end_ride()
+    merged = VirtualElevationStats.from_dict((first.stats + second.stats).to_dict())
+    assert np.allclose(merged.solve(), whole.solve()) and merged.rides == 4, "4: Expected merged statistics"
+
+    # exact power recovers the coefficients
+    exact = VirtualElevationEstimator(TOTAL_MASS)
+    exact.add(*make_test_ride(rng, 1800, C_D_AREA, ROLL_V, TOTAL_MASS))
+    exact.end_ride()
+    crr, cda, _, _, rms = exact.solve()
+    assert abs(cda - C_D_AREA) < 1e-6 and abs(crr - ROLL_V) < 1e-7 and rms < 1e-6, "5: Exact " + str((cda, crr))
+
+    # the power of ride_stream at two speeds and grades, with a wind. The first point of a stream
+    # has no speed, and its power does not include the start from rest
+    with tempfile.TemporaryDirectory() as directory:
+        streamed = VirtualElevationEstimator(ride_stream.TOTAL_MASS)
+        for speed, grade in ((20.0, 3.0), (35.0, -1.0)):
+            file_name = os.path.join(directory, "ride.csv")
+            ride_stream.write_test_ride(file_name, 600, speed, grade)
+            chunks = list(ride_stream.stream_ride(file_name, chunk_size = 128, wind_mag = 2.0, wind_bearing = 60.0))
+            chunks[0] = dict((name, values[1:]) for name, values in chunks[0].items())
+            streamed.add_ride(chunks, wind_mag = 2.0, wind_bearing = 60.0, power_column = "power")
+        crr, cda, _, _, _ = streamed.solve()
+        assert abs(cda - ride_stream.C_D_AREA) < 1e-3 and abs(crr - ride_stream.ROLL_V) < 1e-4, \
+               "6: Expected ride_stream CdA and Crr " + str((cda, crr))
+
+if __name__ == "__main__":
+    test_estimator()
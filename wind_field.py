@@ -0,0 +1,363 @@
+#
+# Wind fields
+# Copyright (c) 2020 Manu Konchady
+#
+# Wind that varies in space and time, from local files, interpolated at a batch of track points
+# (time in seconds, lat and lon in degrees) and fed to the head wind and power calculators.
+#
+#   Gridded  .npz with the arrays times (T), lats (NY), lons (NX) and the wind as u, v or as
+#            wind_mag, wind_bearing, each of shape (T, NY, NX). Interpolated linearly in
+#            time, lat and lon.
+#   Stations .csv with a header of time, station, lat, lon, wind_mag, wind_bearing. Stations
+#            are interpolated linearly in time and by inverse distance weighting of the
+#            NEIGHBORS nearest stations in space.
+#
+# wind_mag is in m/s and wind_bearing the bearing the wind comes from, as in ride_stream. The
+# wind is interpolated as its u (east) and v (north) components, in the direction it blows to.
+# Points outside the grid or the time axis take the values at the edge.
+#
+import csv
+import math
+import os
+import tempfile
+import numpy as np
+import calc_power
+import calc_wind
+import ride_stream
+
+CHUNK_SIZE = 1 << 20    # points per batch of a query
+NEIGHBORS = 4           # stations weighted at each point
+CANDIDATES = 8          # nearest stations of an index cell, the neighbors are chosen from these
+INDEX_CELLS = 256       # cells along each side of the station index
+
+#*-- u, v components of the wind blowing from wind_bearing and back
+def get_components(wind_mag, wind_bearing):
+    bearing = np.radians(wind_bearing)
+    return -wind_mag * np.sin(bearing), -wind_mag * np.cos(bearing)
+
+def get_mag_bearing(u, v):
+    return np.hypot(u, v), np.degrees(np.arctan2(-u, -v)) % 360
+
+#*-- the spacing of an evenly spaced axis, or None
+def get_spacing(axis):
+    if (axis.size < 2):
+        return None
+    step = (axis[-1] - axis[0]) / (axis.size - 1)
+    return step if np.allclose(np.diff(axis), step, rtol = 1e-9, atol = 0) else None
+
+#*-- the lower index of the cell of axis holding each x and the fraction of the cell, clamped to
+#*-- the axis. An evenly spaced axis is indexed without a binary search.
+def get_cell(axis, x, spacing = None):
+    if (axis.size == 1):
+        return np.zeros(x.shape, dtype = np.intp), np.zeros(x.shape)
+    if (spacing is not None):
+        position = (x - axis[0]) / spacing
+        index = np.clip(position.astype(np.intp), 0, axis.size - 2)
+        return index, np.clip(position - index, 0.0, 1.0)
+    index = np.clip(np.searchsorted(axis, x, side = 'right') - 1, 0, axis.size - 2)
+    fraction = np.clip((x - axis[index]) / (axis[index + 1] - axis[index]), 0.0, 1.0)
+    return index, fraction
+
+class WindField:
+
+    #*-- wind_mag and wind_bearing at the points
+    def get_wind(self, time, lat, lon):
+        u, v = self.get_uv(time, lat, lon)
+        return get_mag_bearing(u, v)
+
+    #*-- u and v at the points, in chunks of CHUNK_SIZE
+    def get_uv(self, time, lat, lon):
+        time, lat, lon = np.broadcast_arrays(*[np.asarray(x, dtype = np.float64) for x in (time, lat, lon)])
+        shape = time.shape
+        time, lat, lon = time.ravel(), lat.ravel(), lon.ravel()
+        u = np.empty(time.size)
+        v = np.empty(time.size)
+        for start in range(0, time.size, CHUNK_SIZE):
+            part = slice(start, start + CHUNK_SIZE)
+            u[part], v[part] = self.interpolate(time[part], lat[part], lon[part])
+        return u.reshape(shape), v.reshape(shape)
+
+    #*-- calc_wind.get_head_wind2_array of bikes at bike_mag (m/s) on heading (a bearing) at the points
+    def get_head_wind2(self, time, lat, lon, bike_mag, heading):
+        wind_mag, wind_bearing = self.get_wind(time, lat, lon)
+        return calc_wind.get_head_wind2_array(bike_mag, wind_mag, calc_wind.bearingToDegrees(wind_bearing), \
+                                              calc_wind.bearingToDegrees(heading))
+
+    #*-- calc_power.calc_power at the points for v_bike in kmph, other_resistance in newtons
+    def get_power(self, time, lat, lon, v_bike, heading, K_A, other_resistance):
+        W_A = self.get_head_wind2(time, lat, lon, v_bike * 0.277778, heading)
+        return calc_power.calc_power(other_resistance + K_A * W_A, v_bike)
+
+class WindGrid(WindField):
+
+    def __init__(self, times, lats, lons, u, v):
+        times, lats, lons = [np.asarray(axis, dtype = np.float64) for axis in (times, lats, lons)]
+        u = np.asarray(u, dtype = np.float64).reshape(times.size, lats.size, lons.size)
+        v = np.asarray(v, dtype = np.float64).reshape(times.size, lats.size, lons.size)
+        # ascending axes for the binary searches
+        axes = [times, lats, lons]
+        for axis in range(0, 3):
+            values = axes[axis]
+            if (values.size > 1 and values[0] > values[-1]):
+                u, v = np.flip(u, axis), np.flip(v, axis)
+                values = values[::-1]
+            if (np.any(np.diff(values) <= 0)):
+                raise ValueError("Grid axis " + str(axis) + " is not strictly monotonic")
+            axes[axis] = values
+        self.times, self.lats, self.lons = axes
+        self.spacing = [get_spacing(axis) for axis in axes]
+        # u + i v, one gather per corner
+        self.uv = np.ascontiguousarray(u + 1j * v).ravel()
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            if ("u" in data):
+                u, v = data["u"], data["v"]
+            else:
+                u, v = get_components(data["wind_mag"], data["wind_bearing"])
+            return cls(data["times"], data["lats"], data["lons"], u, v)
+
+    def save(self, file_name):
+        shape = (self.times.size, self.lats.size, self.lons.size)
+        np.savez(file_name, times = self.times, lats = self.lats, lons = self.lons, u = self.uv.real.reshape(shape), \
+                 v = self.uv.imag.reshape(shape))
+
+    def interpolate(self, time, lat, lon):
+        it, ft = get_cell(self.times, time, self.spacing[0])
+        iy, fy = get_cell(self.lats, lat, self.spacing[1])
+        ix, fx = get_cell(self.lons, lon, self.spacing[2])
+        nx = self.lons.size
+        step_t = self.lats.size * nx if self.times.size > 1 else 0
+        step_y = nx if self.lats.size > 1 else 0
+        step_x = 1 if nx > 1 else 0
+        base = (it * self.lats.size + iy) * nx + ix
+        uv = np.zeros(time.size, dtype = np.complex128)
+        for dt, wt in ((0, 1.0 - ft), (step_t, ft)):
+            for dy, wy in ((0, 1.0 - fy), (step_y, fy)):
+                wty = wt * wy
+                for dx, wx in ((0, 1.0 - fx), (step_x, fx)):
+                    uv += (wty * wx) * self.uv[base + (dt + dy + dx)]
+        return uv.real, uv.imag
+
+#*------------------------------------------------------------------------------------------
+#*- station observations on a common time axis, u and v of shape (times, stations) with nan
+#*- where a station did not report. A raster over the stations holds the CANDIDATES nearest
+#*- stations of each cell, the NEIGHBORS nearest of those are weighted by inverse squared
+#*- distance (degrees, with the longitude scaled by the cosine of the mean latitude).
+#*------------------------------------------------------------------------------------------
+class WindStations(WindField):
+
+    def __init__(self, times, lats, lons, u, v, neighbors = NEIGHBORS, cells = INDEX_CELLS):
+        times = np.asarray(times, dtype = np.float64)
+        order = np.argsort(times)
+        self.times = times[order]
+        self.spacing = get_spacing(self.times)
+        u = np.asarray(u, dtype = np.float64)[order]
+        v = np.asarray(v, dtype = np.float64)[order]
+
+        # fill the gaps of each station by linear interpolation in time, drop silent stations
+        reported = np.isfinite(u) & np.isfinite(v)
+        keep = reported.any(axis = 0)
+        if (not keep.any()):
+            raise ValueError("No station reported a wind")
+        for station in np.flatnonzero(keep & ~reported.all(axis = 0)):
+            known = reported[:, station]
+            u[:, station] = np.interp(self.times, self.times[known], u[known, station])
+            v[:, station] = np.interp(self.times, self.times[known], v[known, station])
+        self.lats = np.asarray(lats, dtype = np.float64)[keep]
+        self.lons = np.asarray(lons, dtype = np.float64)[keep]
+        self.uv = np.ascontiguousarray(u[:, keep] + 1j * v[:, keep]).ravel()
+        self.neighbors = min(neighbors, self.lats.size)
+        self.scale = math.cos(math.radians(float(np.mean(self.lats))))
+        self.build_index(cells)
+
+    def build_index(self, cells):
+        stations = self.lats.size
+        margin = 0.01
+        self.index_lats = np.linspace(self.lats.min() - margin, self.lats.max() + margin, cells)
+        self.index_lons = np.linspace(self.lons.min() - margin, self.lons.max() + margin, cells)
+        lat, lon = np.meshgrid(self.index_lats, self.index_lons, indexing = 'ij')
+        lat, lon = lat.ravel(), lon.ravel()
+        count = min(CANDIDATES, stations)
+        self.candidates = np.empty((lat.size, count), dtype = np.intp)
+        rows = max(1, CHUNK_SIZE // (4 * stations))
+        for start in range(0, lat.size, rows):
+            part = slice(start, start + rows)
+            distance = self.get_distance2(lat[part, None], lon[part, None], self.lats[None, :], self.lons[None, :])
+            if (count < stations):
+                self.candidates[part] = np.argpartition(distance, count - 1, axis = 1)[:, :count]
+            else:
+                self.candidates[part] = np.arange(stations)
+
+    def get_distance2(self, lat1, lon1, lat2, lon2):
+        return (lat1 - lat2) ** 2 + ((lon1 - lon2) * self.scale) ** 2
+
+    @classmethod
+    def load(cls, file_name, neighbors = NEIGHBORS):
+        rows = []
+        with open(file_name, newline = "") as csv_file:
+            for row in csv.DictReader(csv_file):
+                rows.append((ride_stream.parse_time(row["time"]), row["station"], float(row["lat"]), \
+                             float(row["lon"]), float(row["wind_mag"]), float(row["wind_bearing"])))
+        times = sorted(set(row[0] for row in rows))
+        names = sorted(set(row[1] for row in rows))
+        time_index = dict((t, i) for i, t in enumerate(times))
+        station_index = dict((name, i) for i, name in enumerate(names))
+        lats = np.zeros(len(names))
+        lons = np.zeros(len(names))
+        u = np.full((len(times), len(names)), np.nan)
+        v = np.full((len(times), len(names)), np.nan)
+        for t, name, lat, lon, wind_mag, wind_bearing in rows:
+            i, j = time_index[t], station_index[name]
+            lats[j], lons[j] = lat, lon
+            u[i, j], v[i, j] = get_components(wind_mag, wind_bearing)
+        field = cls(times, lats, lons, u, v, neighbors)
+        field.names = [name for name, kept in zip(names, np.isfinite(u).any(axis = 0)) if kept]
+        return field
+
+    def interpolate(self, time, lat, lon):
+        # points without a position (gaps in the GPS) have no nearest stations and get nan
+        located = np.isfinite(lat) & np.isfinite(lon)
+        if (not located.all()):
+            lat, lon = np.where(located, lat, self.lats[0]), np.where(located, lon, self.lons[0])
+        it, ft = get_cell(self.times, time, self.spacing)
+        cells = self.index_lats.size
+        iy = np.clip(np.rint((lat - self.index_lats[0]) / (self.index_lats[1] - self.index_lats[0])), 0, cells - 1)
+        ix = np.clip(np.rint((lon - self.index_lons[0]) / (self.index_lons[1] - self.index_lons[0])), 0, cells - 1)
+        candidates = self.candidates[(iy * cells + ix).astype(np.intp)]
+
+        # the nearest neighbors among the candidates
+        distance = self.get_distance2(lat[:, None], lon[:, None], self.lats[candidates], self.lons[candidates])
+        if (self.neighbors < candidates.shape[1]):
+            nearest = np.argpartition(distance, self.neighbors - 1, axis = 1)[:, :self.neighbors]
+            candidates = np.take_along_axis(candidates, nearest, axis = 1)
+            distance = np.take_along_axis(distance, nearest, axis = 1)
+        weight = 1.0 / (distance + 1e-12)
+        weight /= weight.sum(axis = 1, keepdims = True)
+
+        stations = self.lats.size
+        step_t = stations if self.times.size > 1 else 0
+        base = it[:, None] * stations + candidates
+        uv = np.sum(weight * ((1.0 - ft)[:, None] * self.uv[base] + ft[:, None] * self.uv[base + step_t]), axis = 1)
+        uv[~located] = complex(np.nan, np.nan)
+        return uv.real, uv.imag
+
+LOADERS = {".npz": WindGrid.load, ".csv": WindStations.load}
+
+def load_wind_field(file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    if (extension not in LOADERS):
+        raise ValueError("Unknown wind file type: " + file_name)
+    return LOADERS[extension](file_name)
+
+def test_grid():
+    rng = np.random.default_rng(21)
+    times = np.arange(0, 6) * 3600.0
+    lats = np.linspace(45.0, 46.0, 11)
+    lons = np.linspace(7.0, 8.5, 16)
+    t, y, x = np.meshgrid(times, lats, lons, indexing = 'ij')
+    # linear fields are interpolated exactly
+    u = 2.0 + 1e-4 * t + 3.0 * (y - 45) - 2.0 * (x - 7)
+    v = -1.0 - 2e-4 * t + 1.5 * (x - 7)
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "wind.npz")
+        np.savez(file_name, times = times, lats = lats[::-1], lons = lons, u = u[:, ::-1], v = v[:, ::-1])
+        field = load_wind_field(file_name)
+        field.save(file_name)
+        field = WindGrid.load(file_name)
+
+    n = 1000
+    qt, qy, qx = rng.uniform(0, 5 * 3600, n), rng.uniform(45, 46, n), rng.uniform(7, 8.5, n)
+    gu, gv = field.get_uv(qt, qy, qx)
+    assert np.allclose(gu, 2.0 + 1e-4 * qt + 3.0 * (qy - 45) - 2.0 * (qx - 7)), "1: Expected u"
+    assert np.allclose(gv, -1.0 - 2e-4 * qt + 1.5 * (qx - 7)), "2: Expected v"
+
+    # edges are clamped, and a wind from the north blows south
+    assert np.allclose(field.get_uv(-100, 44, 6)[0], field.get_uv(0, 45, 7)[0]), "3: Expected clamping"
+    wind_mag, wind_bearing = get_mag_bearing(*get_components(5.0, 0.0))
+    assert abs(wind_mag - 5.0) < 1e-12 and abs(wind_bearing % 360) < 1e-9, "4: Expected a north wind"
+    assert np.allclose(get_components(5.0, 0.0), (0.0, -5.0)), "5: Expected a southward wind"
+
+    # head wind and power against the scalar calculators at one point
+    wind_mag, wind_bearing = field.get_wind(qt[:5], qy[:5], qx[:5])
+    heading = np.array([0, 45, 90, 200, 300])
+    W_A = field.get_head_wind2(qt[:5], qy[:5], qx[:5], 28.8 * 0.277778, heading)
+    power = field.get_power(qt[:5], qy[:5], qx[:5], 28.8, heading, 0.2, 4.0)
+    for i in range(0, 5):
+        expected = calc_wind.get_head_wind2(28.8 * 0.277778, wind_mag[i], calc_wind.bearingToDegrees(wind_bearing[i]), \
+                                            calc_wind.bearingToDegrees(heading[i]))
+        assert abs(W_A[i] - expected) < 0.02 * abs(expected) + 0.05, "6: Expected W_A " + str(expected)
+        expected = calc_power.calc_power(4.0 + 0.2 * W_A[i], 28.8)
+        assert abs(power[i] - expected) < 1e-9, "7: Expected power " + str(expected)
+
+def test_stations():
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "stations.csv")
+        with open(file_name, "w") as output:
+            output.write("time,station,lat,lon,wind_mag,wind_bearing\n")
+            for t in (0, 3600, 7200):
+                output.write("%d,A,45.0,7.0,%f,0\n" % (t, 2.0 + t / 3600.0))
+                output.write("%d,B,45.0,7.2,4.0,90\n" % t)
+                if (t != 3600):   # missing report
+                    output.write("%d,C,45.3,7.1,6.0,180\n" % t)
+            output.write("0,D,46.0,8.0,nan,nan\n")   # never reported
+        field = load_wind_field(file_name)
+    assert field.names == ["A", "B", "C"], "1: Expected 3 stations " + str(field.names)
+
+    # at a station and in time between its reports
+    wind_mag, wind_bearing = field.get_wind([1800, 3600], [45.0, 45.3], [7.0, 7.1])
+    assert abs(wind_mag[0] - 2.5) < 1e-6 and abs(wind_bearing[0] % 360) < 1e-6, "2: Expected station A"
+    assert abs(wind_mag[1] - 6.0) < 1e-6 and abs(wind_bearing[1] - 180) < 1e-6, "3: Expected the gap filled"
+
+    # half way between A and B with C further away
+    u, v = field.get_uv(0, 45.0, 7.1)
+    ua, va = get_components(2.0, 0.0)
+    ub, vb = get_components(4.0, 90.0)
+    uc, vc = get_components(6.0, 180.0)
+    scale = math.cos(math.radians(45.1))
+    w = np.array([1 / (0.1 * scale) ** 2, 1 / (0.1 * scale) ** 2, 1 / 0.3 ** 2])
+    w /= w.sum()
+    assert abs(u - (w[0] * ua + w[1] * ub + w[2] * uc)) < 1e-6, "4: Expected u " + str(u)
+    assert abs(v - (w[0] * va + w[1] * vb + w[2] * vc)) < 1e-6, "5: Expected v " + str(v)
+
+    # many stations: the index against a brute force search
+    rng = np.random.default_rng(22)
+    stations = 300
+    lats, lons = rng.uniform(44, 47, stations), rng.uniform(6, 10, stations)
+    u, v = rng.normal(0, 4, (24, stations)), rng.normal(0, 4, (24, stations))
+    field = WindStations(np.arange(0, 24) * 3600.0, lats, lons, u, v)
+    n = 2000
+    qt, qy, qx = rng.uniform(0, 23 * 3600, n), rng.uniform(44, 47, n), rng.uniform(6, 10, n)
+    gu, gv = field.get_uv(qt, qy, qx)
+    distance = field.get_distance2(qy[:, None], qx[:, None], lats[None, :], lons[None, :])
+    nearest = np.argsort(distance, axis = 1)[:, :NEIGHBORS]
+    weight = 1.0 / (np.take_along_axis(distance, nearest, axis = 1) + 1e-12)
+    weight /= weight.sum(axis = 1, keepdims = True)
+    it = np.minimum((qt // 3600).astype(int), 22)
+    ft = qt / 3600.0 - it
+    expected = np.sum(weight * ((1 - ft)[:, None] * u[it[:, None], nearest] + \
+                                ft[:, None] * u[it[:, None] + 1, nearest]), axis = 1)
+    assert np.mean(np.abs(gu - expected) < 1e-9) > 0.99, "6: Expected the nearest stations"
+
+    # points without a position
+    gu, gv = field.get_uv(qt[:3], np.array([qy[0], np.nan, qy[2]]), np.array([qx[0], qx[1], np.inf]))
+    assert np.isnan(gu[1:]).all() and np.isnan(gv[1:]).all(), "7: Expected nan without a position"
+    assert gu[0] == field.get_uv(qt[:1], qy[:1], qx[:1])[0][0], "8: Expected the located point"
+
+def test_stream():
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "ride.csv")
+        ride_stream.write_test_ride(file_name, 600, 30.0, 1.0)
+        u, v = get_components(3.0, 45.0)
+        field = WindGrid([0, 3600], [-1, 1], [-1, 1], np.full((2, 2, 2), u), np.full((2, 2, 2), v))
+        chunks = list(ride_stream.stream_ride(file_name, chunk_size = 256, wind_field = field))
+        expected = list(ride_stream.stream_ride(file_name, chunk_size = 256, wind_mag = 3.0, wind_bearing = 45.0))
+    for chunk, other in zip(chunks, expected):
+        assert np.allclose(chunk["head_wind"], other["head_wind"]), "1: Expected the head wind of the field"
+        assert np.allclose(chunk["power"], other["power"]), "2: Expected the power of the field"
+
+if __name__ == "__main__":
+    test_grid()
+    test_stations()
+    test_stream()